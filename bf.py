@@ -2,6 +2,7 @@
 
 """Blenderfarm command-line tool."""
 
+import os
 import sys
 
 import blenderfarm
@@ -265,7 +266,7 @@ class ServerAction(Action):
         super().__init__()
         self.name = 'server'
         self.description = 'starts the blenderfarm server'
-        self.options = ['?host=0.0.0.0', '?port=44363']
+        self.options = ['?host=0.0.0.0', '?port=44363', '?download_limit', '?upload_limit']
 
     def help(self, options):
         """Prints out help text for the `server` action."""
@@ -276,6 +277,8 @@ class ServerAction(Action):
 
         print('accepts two arguments: [host] and [port].')
         print('If omitted, the defaults of "0.0.0.0" and "44363" are used.')
+        print('[download_limit] and [upload_limit] cap the bandwidth of every render node,')
+        print('overriding their own limits; see "bf.py node run help".')
 
     def invoke(self, options):
         """Invokes the `server` action."""
@@ -291,8 +294,17 @@ class ServerAction(Action):
             print('! invalid port number "' + port + '"')
             return
 
+        for key in ('download_limit', 'upload_limit'):
+            try:
+                blenderfarm.bandwidth.Limit(options[key])
+            except ValueError as exception:
+                print('! invalid ' + key + ': ' + str(exception))
+                return
+
         # Create the blenderfarm `Server`.
         server = blenderfarm.server.Server(host=host, port=port)
+        server.download_limit = options['download_limit'] or ''
+        server.upload_limit = options['upload_limit'] or ''
 
         # Print out a nice message, containing the host and port.
         print('starting blenderfarm server at ' + host + ' (' + str(port) + ')...')
@@ -300,6 +312,53 @@ class ServerAction(Action):
         # And start the server.
         server.start()
 
+class RelayAction(Action):
+    """Starts a site-local relay server."""
+
+    def __init__(self):
+        super().__init__()
+        self.name = 'relay'
+        self.description = 'starts a relay server for a remote pool of render nodes'
+        self.options = ['username', 'key', 'upstream_host', '?upstream_port=44363', '?host=0.0.0.0', '?port=44363',
+                        '?batch=16']
+
+    def help(self, options):
+        """Prints out help text for the `relay` action."""
+
+        print(self.get_help_usage())
+        print()
+        print('connects to the blenderfarm server at <upstream_host> and [upstream_port] as')
+        print('<username>, then serves render nodes at [host] and [port] on its behalf.')
+        print('up to [batch] tasks are leased upstream ahead of the local nodes; job files')
+        print('are mirrored into "blobs", so each one is only downloaded once. local nodes')
+        print('authenticate against the users in this directory (see "admin user add").')
+
+    def invoke(self, options):
+        """Invokes the `relay` action."""
+
+        try:
+            upstream_port, port, batch = int(options['upstream_port']), int(options['port']), int(options['batch'])
+        except ValueError:
+            print('! invalid port or batch size')
+            return
+
+        # The blenderfarm server itself only speaks plain HTTP.
+        upstream = blenderfarm.client.Client(host=options['upstream_host'], port=upstream_port, insecure=True,
+                                             is_node=True)
+
+        try:
+            upstream.connect(options['username'], options['key'])
+        except blenderfarm.error.Error as exception:
+            print('! ' + str(exception))
+            return
+
+        relay = blenderfarm.relay.Relay(upstream, host=options['host'], port=port, batch=batch)
+
+        print('connected to ' + upstream.get_host_port() + ' as node ' + upstream.node_id)
+        print('starting blenderfarm relay at ' + options['host'] + ' (' + str(port) + ')...')
+
+        relay.start()
+
 class AdminUserAddAction(Action):
     """Adds a blenderfarm user."""
 
@@ -459,18 +518,30 @@ class JobAddAction(Action):
         super().__init__()
         self.name = 'add'
         self.description = 'Adds a new job.'
-        self.options = ['url', '?start=0', '?end=1']
+        self.options = ['url', '?start=0', '?end=1', '?preview=0', '?hash', '?min_cores=0', '?min_memory=0',
+                        '?blender_version']
 
     def help(self, options):
         print(self.get_help_usage())
         print()
-        print('lists existing users on this blenderfarm server')
-        print('if the optional parameter [username] is present, only lists that user')
+        print('adds a render job for the .blend file at <url>, rendering frames [start] to [end]-1')
+        print('if <url> is a local file, it is stored in the server\'s blob store in "blobs";')
+        print('only the parts of it the store does not hold yet are written')
+        print('if [preview] is 1, a fast low-resolution preview of every frame is rendered first')
+        print('[hash] is the SHA-256 hex digest of the file; nodes verify downloads against it')
+        print('and share a single cached copy between jobs with the same file')
+        print('tasks are only handed to nodes with at least [min_cores] cores, [min_memory]')
+        print('megabytes of memory and blender [blender_version] (such as 2.79)')
 
     def invoke(self, options):
         """Invokes the `job add` action."""
 
-        start, end = int(options['start']), int(options['end'])
+        try:
+            start, end = int(options['start']), int(options['end'])
+            min_cores, min_memory = int(options['min_cores']), int(options['min_memory'])
+        except ValueError:
+            print('! invalid frame range, core count or memory size')
+            return
 
         jobs_db = blenderfarm.job.JobList()
 
@@ -478,6 +549,21 @@ class JobAddAction(Action):
         
         job_info.file_url = options['url']
         job_info.frame_range = [start, end]
+        job_info.preview = options['preview'] == '1'
+        job_info.file_hash = (options['hash'] or '').lower()
+
+        job_info.min_cores = min_cores
+        job_info.min_memory = min_memory * 1024 * 1024
+        job_info.blender_version = options['blender_version'] or ''
+
+        if os.path.isfile(options['url']):
+            manifest = blenderfarm.blob.BlobStore().ingest(options['url'])
+
+            job_info.file_url = ''
+            job_info.file_hash = manifest['hash']
+            job_info.file_size = manifest['size']
+
+            print('stored "' + options['url'] + '" as ' + manifest['hash'] + ' (' + str(manifest['size']) + ' bytes)')
         
         job = blenderfarm.job.Job(job_info)
         
@@ -487,8 +573,6 @@ class JobAddAction(Action):
 
         print(job.get_job_line())
 
-        jobs_db.save()
-
 
 class JobListAction(Action):
     """Add a new job."""
@@ -512,7 +596,113 @@ class JobListAction(Action):
         else:
             print('no jobs')
 
-            
+
+class JobPauseAction(Action):
+    """Pauses a job."""
+
+    def __init__(self):
+        super().__init__()
+        self.name = 'pause'
+        self.description = 'pauses a job'
+        self.options = ['job_id']
+
+    def help(self, options):
+        print(self.get_help_usage())
+        print()
+        print('stops handing out tasks of the job <job_id>; nodes working on it stop rendering')
+        print('and pick up other work. the running server picks the change up within a second')
+
+    def invoke(self, options):
+        """Invokes the `job pause` action."""
+
+        jobs_db = blenderfarm.job.JobList()
+
+        job = jobs_db.get_job(options['job_id'])
+
+        if not job:
+            print('! that job does not exist')
+            return
+
+        if job.status == blenderfarm.job.Job.STATUS_CANCELLED:
+            print('! that job was cancelled')
+            return
+
+        def pause(saved_job):
+            if saved_job.status != blenderfarm.job.Job.STATUS_CANCELLED:
+                saved_job.status = blenderfarm.job.Job.STATUS_PAUSED
+
+        job = jobs_db.set_status(options['job_id'], pause)
+
+        print(job.get_job_line())
+
+
+class JobResumeAction(Action):
+    """Resumes a paused job."""
+
+    def __init__(self):
+        super().__init__()
+        self.name = 'resume'
+        self.description = 'resumes a paused job'
+        self.options = ['job_id']
+
+    def invoke(self, options):
+        """Invokes the `job resume` action."""
+
+        jobs_db = blenderfarm.job.JobList()
+
+        job = jobs_db.get_job(options['job_id'])
+
+        if not job:
+            print('! that job does not exist')
+            return
+
+        if job.status != blenderfarm.job.Job.STATUS_PAUSED:
+            print('! that job is not paused')
+            return
+
+        def resume(saved_job):
+            if saved_job.status == blenderfarm.job.Job.STATUS_PAUSED:
+                saved_job.resume()
+
+        job = jobs_db.set_status(options['job_id'], resume)
+
+        print(job.get_job_line())
+
+
+class JobCancelAction(Action):
+    """Cancels a job."""
+
+    def __init__(self):
+        super().__init__()
+        self.name = 'cancel'
+        self.description = 'cancels a job'
+        self.options = ['job_id']
+
+    def help(self, options):
+        print(self.get_help_usage())
+        print()
+        print('stops handing out tasks of the job <job_id> for good; nodes working on it stop')
+        print('rendering and pick up other work. frames already rendered are kept')
+
+    def invoke(self, options):
+        """Invokes the `job cancel` action."""
+
+        jobs_db = blenderfarm.job.JobList()
+
+        job = jobs_db.get_job(options['job_id'])
+
+        if not job:
+            print('! that job does not exist')
+            return
+
+        def cancel(saved_job):
+            saved_job.status = blenderfarm.job.Job.STATUS_CANCELLED
+
+        job = jobs_db.set_status(options['job_id'], cancel)
+
+        print(job.get_job_line())
+
+
 class JobAction(ActionList):
     """`ActionList` for job actions."""
 
@@ -523,7 +713,157 @@ class JobAction(ActionList):
 
         self.actions = [
             JobAddAction(),
-            JobListAction()
+            JobListAction(),
+            JobPauseAction(),
+            JobResumeAction(),
+            JobCancelAction()
+        ]
+
+class NodeListAction(Action):
+    """List registered render nodes."""
+
+    def __init__(self):
+        super().__init__()
+        self.name = 'list'
+        self.description = 'lists registered render nodes'
+
+    def invoke(self, options):
+        """Invokes the `node list` action."""
+
+        nodes_db = blenderfarm.node.NodeList()
+
+        nodes = nodes_db.get_nodes()
+
+        if not nodes:
+            print('no nodes')
+            return
+
+        for node in nodes:
+            print(node.get_node_line())
+
+
+class NodeCalibrateAction(Action):
+    """Runs the calibration benchmark on this render node."""
+
+    def __init__(self):
+        super().__init__()
+        self.name = 'calibrate'
+        self.description = 'measures the speed of this render node'
+        self.options = ['?renderer=blender', '?blender=blender']
+
+    def help(self, options):
+        print(self.get_help_usage())
+        print()
+        print('runs a standardized micro-render and saves the score in "node.json";')
+        print('the score is reported to the server the next time this node connects.')
+        print('[renderer] is "blender" (using the executable [blender]) or "stub", a')
+        print('pure-Python stand-in for machines without Blender.')
+
+    def invoke(self, options):
+        """Invokes the `node calibrate` action."""
+
+        if options['renderer'] == 'stub':
+            benchmark = blenderfarm.benchmark.StubBenchmark()
+        elif options['renderer'] == 'blender':
+            benchmark = blenderfarm.benchmark.BlenderBenchmark(options['blender'])
+        else:
+            print('! no such renderer "' + options['renderer'] + '"')
+            return
+
+        print('calibrating...')
+
+        try:
+            score = benchmark.calibrate()
+        except blenderfarm.error.Error as exception:
+            print('! ' + str(exception))
+            return
+
+        config = blenderfarm.client.NodeConfig()
+        config.calibration = score
+        config.save()
+
+        print('calibration score: ' + str(round(score, 3)))
+
+
+class NodeRunAction(Action):
+    """Runs this machine as a render node."""
+
+    def __init__(self):
+        super().__init__()
+        self.name = 'run'
+        self.description = 'runs this machine as a render node'
+        self.options = ['username', 'key', '?host=localhost', '?port=44363', '?slots=0', '?renderer=blender',
+                        '?lookahead=1', '?cache_size=0', '?peer_port=0', '?download_limit', '?upload_limit']
+
+    def help(self, options):
+        print(self.get_help_usage())
+        print()
+        print('connects to the blenderfarm server at [host] and [port] as <username>,')
+        print('then renders tasks in [slots] render slots at once (0 picks a count')
+        print('from the cores and memory of this machine) until interrupted.')
+        print('[renderer] is "blender" or "stub", which renders placeholder images.')
+        print('[lookahead] tasks beyond one per slot are leased and downloaded in advance.')
+        print('job files are cached in "cache", limited to [cache_size] megabytes (0 for no')
+        print('limit); the least recently used files are removed to make room.')
+        print('if [peer_port] is not 0, cached job files are shared with other render')
+        print('nodes on that port, so the server doesn\'t have to send them to every node.')
+        print('[download_limit] and [upload_limit] cap the bandwidth this node uses, in bytes')
+        print('per second (with a K, M or G suffix); comma-separated "HH:MM-HH:MM=<rate>"')
+        print('entries set the limit for a time of day, such as "09:00-18:00=2M,0" (no limit')
+        print('outside working hours). limits set by the server take precedence.')
+
+    def invoke(self, options):
+        """Invokes the `node run` action."""
+
+        try:
+            port, slots, lookahead = int(options['port']), int(options['slots']), int(options['lookahead'])
+            cache_size, peer_port = int(options['cache_size']), int(options['peer_port'])
+        except ValueError:
+            print('! invalid port, slot count, lookahead, cache size or peer port')
+            return
+
+        command = None
+
+        if options['renderer'] == 'stub':
+            command = blenderfarm.render.RenderExecutor.get_stub_command
+        elif options['renderer'] != 'blender':
+            print('! no such renderer "' + options['renderer'] + '"')
+            return
+
+        # The blenderfarm server itself only speaks plain HTTP.
+        client = blenderfarm.client.Client(host=options['host'], port=port, insecure=True, is_node=True)
+        client.cache_size = cache_size * 1024 * 1024
+        client.peer_port = peer_port
+
+        try:
+            client.set_bandwidth_limits(options['download_limit'], options['upload_limit'])
+        except ValueError as exception:
+            print('! invalid bandwidth limit: ' + str(exception))
+            return
+
+        try:
+            client.connect(options['username'], options['key'])
+        except blenderfarm.error.Error as exception:
+            print('! ' + str(exception))
+            return
+
+        print('connected to ' + client.get_host_port() + ' as node ' + client.node_id)
+
+        blenderfarm.runner.NodeRunner(client, slots, command, lookahead).run()
+
+
+class NodeAction(ActionList):
+    """`ActionList` for render node actions."""
+
+    def __init__(self):
+        super().__init__()
+        self.name = 'node'
+        self.description = 'render node commands'
+
+        self.actions = [
+            NodeCalibrateAction(),
+            NodeListAction(),
+            NodeRunAction()
         ]
 
 # First, we define a list of actions.
@@ -533,9 +873,11 @@ ACTIONS = [
     VersionAction(),
 
     ServerAction(),
+    RelayAction(),
     AdminUserAction(),
     AdminAction(),
-    JobAction()
+    JobAction(),
+    NodeAction()
 ]
 
 ACTIONS.sort()
@@ -3,9 +3,22 @@
 
 from . import job
 from . import task
+from . import node
 from . import server
 from . import client
 from . import error
 from . import db
+from . import benchmark
+from . import render
+from . import events
+from . import wire
+from . import compression
+from . import bandwidth
+from . import blob
+from . import cache
+from . import peer
+from . import tracker
+from . import runner
+from . import relay
 
 from .version import __version__, __version_info__
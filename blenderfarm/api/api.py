@@ -1,13 +1,78 @@
 
 """API handler."""
 
+import email.message
+import io
+import re
 import sys
+import threading
 import urllib.parse
 
 # Used for interfacing with the server. This is built into Blender so
 # there aren't any problems when this is used as an addon.
 import requests
 
+class Route:
+
+    """A route: `handler` answers `method` requests for `path`. Segments
+of `path` in braces, as in `/job/{job_id}/tasks.json`, are parameters,
+which match any text up to the next `/`. At most `limit` requests are
+handled at once (`None` for no limit); see `APIServer.admit()`."""
+
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, method, path, handler, locked=True, limit=None):
+        self.method = method
+        self.path = path
+        self.handler = handler
+        self.locked = locked
+        self.limit = limit
+
+        # Number of requests being handled (or waiting for the server
+        # lock) right now.
+        self.active = 0
+
+        # Regular expression matching the paths of a route with
+        # parameters; `None` if it has none.
+        self.pattern = None
+
+        parts = re.split(r'\{(\w+)\}', path)
+
+        if len(parts) > 1:
+            self.pattern = re.compile(''.join(
+                '(?P<' + part + '>[^/]+)' if index % 2 else re.escape(part)
+                for index, part in enumerate(parts)))
+
+    def match(self, path):
+        """Returns the parameters in `path` if it's one of ours, or `None`."""
+
+        match = self.pattern.fullmatch(path)
+
+        if not match:
+            return None
+
+        return {key: urllib.parse.unquote(value) for key, value in match.groupdict().items()}
+
+class RequestContext:
+
+    """What a request is for, worked out once when it comes in and
+shared by everything that handles it: the `route` that handles it, its
+`path` (without the API version or query), the `path_params` of the
+route and the URL query `params`."""
+
+    def __init__(self, route, path, path_params, query):
+        self.route = route
+        self.path = path
+        self.path_params = path_params
+
+        params = urllib.parse.parse_qs(query, keep_blank_values=True)
+
+        self.params = {key: params[key][0] for key in params}
+
+        # The parsed `POST` data, once read (see
+        # `APIServer.get_post_data()`).
+        self.post_data = None
+
 class APIServer:
 
     """Primary class for API management."""
@@ -17,37 +82,101 @@ class APIServer:
 
         self.server = server
 
+        # Maps methods to `{path: Route}`, as routes are added.
         self.routes = {}
 
-    def route(self, method, path, handler):
+        # Compiled by `init()`: `Route`s without parameters by `(method,
+        # path)`, those with parameters by method, and the route for
+        # paths that match neither.
+        self.static_routes = {}
+        self.pattern_routes = {}
+        self.error_route = None
+
+        # Guards the `active` counts of the routes.
+        self.admission_lock = threading.Lock()
+
+    def route(self, method, path, handler, locked=True, limit=None):
         """Adds a route to our list; binds `handler` to it. `handler` is a
-function that accepts parameters `request, response` and does something."""
+function that accepts parameters `request, response` and does something.
+If `locked` is `False`, `handler` runs without holding the server lock;
+it must only touch state that's safe to share between threads. `path`
+may contain parameters (see `Route`). If `limit` is set, requests
+beyond the first `limit` in flight are turned away (see `admit()`)."""
+
+        # pylint: disable=too-many-arguments
 
         if method not in self.routes:
             self.routes[method] = {}
 
-        self.routes[method][path] = handler
+        self.routes[method][path] = Route(method, path, handler, locked, limit)
 
-    def get_route(self, method, path=None):
-        """Tries to find the appropriate route for `path`. Returns a generic
-error handler if no route exists."""
+    def admit(self, route):
+        """Counts a request for `route` as in flight, and returns `True`;
+or returns `False` if the route is already handling as many requests
+as it may, in which case the request should be turned away right away
+instead of queueing behind the others. Requests that were admitted
+must be `release()`d."""
 
-        if not path:
-            path = method
-            method = 'GET'
+        if route.limit is None:
+            return True
 
-        path = '/' + urllib.parse.urlparse(path).path
-        
-        if method in self.routes:
-            if path in self.routes[method]:
-                print(method + ': ' + path)
-                return self.routes[method][path]
+        with self.admission_lock:
+            if route.active >= route.limit:
+                return False
+
+            route.active += 1
+
+        return True
+
+    def release(self, route):
+        """Counts a request admitted by `admit()` as done."""
+
+        if route.limit is None:
+            return
+
+        with self.admission_lock:
+            route.active -= 1
+
+    def compile_routes(self):
+        """Builds the lookup tables `get_context()` uses."""
+
+        self.static_routes = {}
+        self.pattern_routes = {}
 
-        if 'error_404' in self.routes['__']:
-            print('__: error_404 (requested: ' + method + ': ' + path + ')')
-            return self.routes['__']['error_404']
+        for method, routes in self.routes.items():
+            for path, route in routes.items():
+                if route.pattern:
+                    self.pattern_routes.setdefault(method, []).append(route)
+                else:
+                    self.static_routes[(method, path)] = route
 
-        return None
+        self.error_route = self.routes['__']['error_404']
+
+    def get_context(self, method, url):
+        """Returns the `RequestContext` of a `method` request for `url`
+(such as `task/next.json?node_id=...`, without the API version). Its
+`route` is the generic error route if no route matches."""
+
+        split = urllib.parse.urlsplit(url)
+
+        path = '/' + split.path
+
+        route = self.static_routes.get((method, path))
+        path_params = {}
+
+        if not route:
+            for pattern_route in self.pattern_routes.get(method, ()):
+                path_params = pattern_route.match(path)
+
+                if path_params is not None:
+                    route = pattern_route
+                    break
+            else:
+                print('__: error_404 (requested: ' + method + ': ' + path + ')')
+                route = self.error_route
+                path_params = {}
+
+        return RequestContext(route, path, path_params, split.query)
 
     def init(self):
         """Called after `__init__()`. Returns `self` to allow for one-line
@@ -60,6 +189,8 @@ creation and initialization."""
             print('error: subclasses of "API" should define an "error_404" route with the "__" method')
             sys.exit(1)
 
+        self.compile_routes()
+
         return self
 
     def init_routes(self):
@@ -68,19 +199,30 @@ creation and initialization."""
 
     @staticmethod
     def get_url_params(request, response):
-        """Returns the URL parameters; `{}` if none present."""
+        """Returns the URL parameters; `{}` if none present. The dictionary
+is the caller's to change."""
 
         _ = response
-        
-        data = urllib.parse.parse_qs(urllib.parse.urlparse(request.path).query)
 
-        return {x: data[x][0] for x in data}
+        return dict(request.context.params)
+
+    @staticmethod
+    def get_path_params(request, response):
+        """Returns the parameters in the path of the request's route (see
+`Route`); `{}` if it has none."""
+
+        _ = response
+
+        return request.context.path_params
 
     @staticmethod
     def get_post_data(request, response):
         """Returns the `POST` data; `{}` if none present."""
 
         _ = response
+
+        if request.context.post_data is not None:
+            return dict(request.context.post_data)
         
         content_length = request.headers.get('content-length')
 
@@ -89,9 +231,52 @@ creation and initialization."""
         
         length = int(content_length)
         data = str(request.rfile.read(length), 'utf8')
-        data = urllib.parse.parse_qs(urllib.parse.urlparse('?' + data).query)
+        data = urllib.parse.parse_qs(data)
+
+        request.context.post_data = {x: data[x][0] for x in data}
+
+        return dict(request.context.post_data)
+
+
+class SubRequest:
+
+    """Stands in for the request handler while a route handles a single
+operation of a batch request: the route reads the operation's URL
+`path`, `context` (a `RequestContext`) and `body`, and its JSON
+response is captured in `json_data` (along with its HTTP `status`)
+instead of being sent. `parent` is the handler of the batch request,
+and `batch_user` the username it was authenticated as."""
+
+    def __init__(self, parent, batch_user, path, context, body=b''):
+        self.path = path
+        self.context = context
+
+        self.headers = email.message.Message()
+        self.headers['Content-Length'] = str(len(body))
+
+        self.rfile = io.BytesIO(body)
+
+        self.client_address = parent.client_address
+
+        self.batch_user = batch_user
+
+        self.status = None
+        self.json_data = None
+
+    def respond_json(self, json_data, status=200):
+        """Captures the response."""
+
+        self.json_data = json_data
+        self.status = status
+
+    def respond_error(self, status):
+        """Captures an HTTP error response."""
 
-        return {x: data[x][0] for x in data}
+        self.respond_json({
+            'status': 'error',
+            'code': str(status),
+            'message': str(status)
+        }, status)
 
     
 class APIClient:
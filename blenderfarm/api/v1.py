@@ -2,21 +2,59 @@
 """API v1."""
 
 import json
+import math
+import os
+import random
+import re
+import threading
 import time
+import traceback
+import urllib.parse
 
 import requests
+import urllib3
 
 from .. import version as bf_version
 from . import api as bf_api
 from .. import error as bf_error
+from .. import bandwidth as bf_bandwidth
+from .. import blob as bf_blob
 from .. import digest as bf_digest
+from .. import events as bf_events
+from .. import serializable as bf_serializable
+from .. import wire as bf_wire
 from .. import task as bf_task
 from .. import job as bf_job
+from .. import node as bf_node
 
 class Server(bf_api.APIServer):
 
     """Same name as `api.API`, but this is the v1 API implementation."""
 
+    # Most operations a single `batch.json` request may hold.
+    MAX_BATCH_SIZE = 64
+
+    # Routes that stream their response or take a binary body, which
+    # can't be part of a batch.
+    UNBATCHABLE_PATHS = ('/batch.json', '/node/events', '/task/result.json', '/blob/chunk.json',
+                         '/blob/file.blend')
+
+    # URL parameters that must be numbers, and their types.
+    NUMERIC_PARAMETERS = {
+        'cores': int,
+        'memory': int,
+        'disk_free': int,
+        'memory_free': int,
+        'calibration': float,
+        'count': int,
+        'slots': int,
+        'wait': float,
+        'elapsed': float,
+        'peak_memory': int,
+        'event_id': int,
+        'port': int
+    }
+
     def __init__(self, server):
         super().__init__(server)
 
@@ -25,14 +63,46 @@ class Server(bf_api.APIServer):
     def init_routes(self):
         """Initialize routes."""
 
+        # Routes a farm of nodes floods when it starts up all at once are
+        # limited (see `APIServer.admit()`); those that carry finished
+        # work or keep leases alive never are.
         self.route('__', 'error_404', self.route_error_404)
-        self.route('GET', '/info.json', self.route_info)
+        self.route('GET', '/info.json', self.route_info, limit=32)
         
-        self.route('GET', '/auth/test.json', self.route_auth_test)
+        self.route('GET', '/auth/test.json', self.route_auth_test, limit=32)
         
-        self.route('GET', '/task/next.json', self.route_task_next)
+        self.route('POST', '/node/register.json', self.route_node_register, limit=32)
+
+        # Long polls wait here for work, without the server lock.
+        self.route('GET', '/task/next.json', self.route_task_next, limit=512)
         
-        self.route('POST', '/task/result.json', self.route_task_result)
+        self.route('POST', '/task/heartbeat.json', self.route_task_heartbeat)
+
+        # Uploads are read and stored without the server lock.
+        self.route('POST', '/task/result.json', self.route_task_result, locked=False)
+
+        self.route('GET', '/job/{job_id}/tasks.json', self.route_job_tasks, limit=16)
+
+        # Event streams stay open for as long as the node runs.
+        self.route('GET', '/node/events', self.route_node_events, locked=False)
+        self.route('POST', '/node/ack.json', self.route_node_ack)
+
+        # The blob store and the tracker are safe to share between
+        # threads, and blob transfers can take a while.
+        self.route('POST', '/blob/missing.json', self.route_blob_missing, locked=False, limit=32)
+        self.route('POST', '/blob/chunk.json', self.route_blob_chunk, locked=False, limit=32)
+        self.route('POST', '/blob/commit.json', self.route_blob_commit, locked=False, limit=32)
+
+        self.route('GET', '/blob/manifest.json', self.route_blob_manifest, locked=False, limit=64)
+
+        self.route('GET', '/blob/file.blend', self.route_blob_file, locked=False)
+        self.route('HEAD', '/blob/file.blend', self.route_blob_file, locked=False)
+
+        self.route('POST', '/peer/announce.json', self.route_peer_announce, locked=False)
+
+        # Operations take the server lock one at a time, as they would on
+        # their own, and are limited like their own routes.
+        self.route('POST', '/batch.json', self.route_batch, locked=False)
 
     @staticmethod
     def route_error_404(request, response):
@@ -59,8 +129,44 @@ class Server(bf_api.APIServer):
             'context': context
         }, status=400)
 
+    def verify_parameters(self, request, response):
+        """Verifies that the numeric URL parameters (see
+`NUMERIC_PARAMETERS`) of the request are numbers; if one isn't,
+responds with an `invalid-parameter` error and returns `False`."""
+
+        data = self.get_url_params(request, response)
+
+        for key, parse in Server.NUMERIC_PARAMETERS.items():
+            if key not in data:
+                continue
+
+            try:
+                valid = math.isfinite(parse(data[key]))
+            except ValueError:
+                valid = False
+
+            if not valid:
+                response.respond_json({
+                    'status': 'error',
+                    'code': 'invalid-parameter',
+                    'message': 'Invalid value for parameter',
+                    'context': key
+                })
+
+                return False
+
+        return True
+
     def verify_auth(self, request, response):
-        """Verifies that the user is authenticated."""
+        """Verifies that the user is authenticated, and that the request's
+parameters are valid (see `verify_parameters()`). Operations of a batch
+(see `route_batch()`) share its authentication."""
+
+        if not self.verify_parameters(request, response):
+            return False
+
+        if getattr(request, 'batch_user', None):
+            return True
         
         data = self.get_url_params(request, response)
 
@@ -115,12 +221,12 @@ class Server(bf_api.APIServer):
 
         _ = request
 
-        response.respond_json({
+        response.respond_json(dict({
             'status': 'ok',
             'version': bf_version.__version__,
             'uptime': self.server.get_uptime(),
             'time': time.time()
-        })
+        }, **self.server.get_bandwidth_limits()))
 
         
     def route_auth_test(self, request, response):
@@ -134,40 +240,94 @@ class Server(bf_api.APIServer):
         })
 
         
+    def route_node_register(self, request, response):
+        """Node registration route."""
+
+        if not self.verify_auth(request, response):
+            return
+
+        data = self.get_url_params(request, response)
+
+        render_node = self.server.nodes.register(data['user'], data)
+
+        response.respond_json({
+            'status': 'ok',
+            'node': render_node.serialize()
+        })
+
     def route_task_next(self, request, response):
         """Next task route."""
 
         if not self.verify_auth(request, response):
             return
 
-        job = self.server.jobs.get_next_job()
+        data = self.get_url_params(request, response)
 
-        if not job:
-            response.respond_json({
-                'status': 'ok',
-                'task': None
-            })
-            return
+        if data.get('node_id'):
+            render_node = self.server.nodes.get_node(data['node_id'])
 
-        task = job.get_next_task()
+            if not render_node or render_node.username != data['user']:
+                response.respond_json({
+                    'status': 'error',
+                    'code': 'invalid-node',
+                    'message': 'No such node',
+                    'context': data['node_id']
+                })
+                return
 
-        if not task:
+        tasks = self.server.get_next_tasks(data)
+
+        if not tasks and data.get('wait'):
+            try:
+                wait = float(data['wait'])
+            except ValueError:
+                wait = 0
+
+            if wait > 0:
+                tasks = self.server.wait_for_tasks(data, wait)
+
+        if not tasks:
             response.respond_json({
                 'status': 'ok',
                 'task': None
             })
             return
-        
-        task.in_progress = True
 
         response.respond_json({
             'status': 'ok',
-            'job': task.job.serialize(),
-            'task': task.serialize()
+            'lease_time': self.server.LEASE_TIME,
+            'job': bf_serializable.Deferred(tasks[0].job, True),
+            'task': tasks[0].serialize(),
+            'tasks': [{
+                'job': bf_serializable.Deferred(task.job, True),
+                'task': task.serialize()
+            } for task in tasks]
         })
 
+    def route_task_heartbeat(self, request, response):
+        """Lease renewal route."""
+
+        if not self.verify_auth(request, response):
+            return
+
+        data = self.get_url_params(request, response)
+
+        if not all(k in data for k in ('node_id', 'task_ids')):
+            self.route_error_400(request, response, context='missing parameters')
+            return
+
+        task_ids = [task_id for task_id in data['task_ids'].split(',') if task_id]
+
+        response.respond_json(dict({
+            'status': 'ok',
+            'lease_time': self.server.LEASE_TIME,
+            'lost': self.server.renew_leases(data['node_id'], task_ids)
+        }, **self.server.get_bandwidth_limits()))
+
     def route_task_result(self, request, response):
-        """Task render result route."""
+        """Task render result route. Runs without the server lock, which is
+only taken to look up the task and to mark it complete, so a slow
+upload doesn't hold up other requests."""
 
         if not self.verify_auth(request, response):
             return
@@ -184,7 +344,9 @@ class Server(bf_api.APIServer):
             
             return False
 
-        job = self.server.jobs.get_job(data['job_id'])
+        with self.server.lock:
+            job = self.server.jobs.get_job(data['job_id'])
+            task = job.get_task(data['task_id']) if job else None
 
         if not job:
             response.respond_json({
@@ -195,8 +357,6 @@ class Server(bf_api.APIServer):
             })
             return
 
-        task = job.get_task(data['task_id'])
-        
         if not task:
             response.respond_json({
                 'status': 'error',
@@ -206,227 +366,1409 @@ class Server(bf_api.APIServer):
             })
             return
 
-        task.in_progress = False
-        task.complete = True
+        peak_memory = int(data.get('peak_memory') or 0)
+        elapsed = float(data['elapsed'])
 
         length = request.headers['content-length']
         data = request.rfile.read(int(length))
 
         print('saving result!')
 
-        task.write_result(data)
+        # The result is stored before the task is marked complete, so a
+        # failed upload or write leaves it to be rendered again.
+        self.server.write_task_result(task, data, elapsed, peak_memory)
+
+        with self.server.lock:
+            task.set_complete()
+
+            if peak_memory:
+                job.record_peak_memory(task, peak_memory)
+
+            self.server.record_task_elapsed(task, elapsed)
+
+            # The node has room for another task now.
+            self.server.dispatch_waiters()
 
-        self.server.jobs.save()
+        self.server.save()
 
         response.respond_json({
             'status': 'ok'
         })
 
 
-class Client(bf_api.APIClient):
+    def route_job_tasks(self, request, response):
+        """Job progress route; lists the tasks of the job in the path."""
 
-    """v1 API client (must talk with the v1 server, above)"""
+        if not self.verify_auth(request, response):
+            return
 
-    def __init__(self):
-        super().__init__()
+        job_id = self.get_path_params(request, response)['job_id']
 
-        self.server_info = {}
+        job = self.server.jobs.get_job(job_id)
 
-        self.clear_local_state()
+        if not job:
+            response.respond_json({
+                'status': 'error',
+                'code': 'invalid-job',
+                'message': 'No such job',
+                'context': job_id
+            })
+            return
 
-        self.api_version = '1'
+        response.respond_json({
+            'status': 'ok',
+            'job_id': job.job_id,
+            'job_status': job.status,
+            'remaining': job.get_remaining_count(),
+            'tasks': [task.serialize() for task in job.tasks]
+        })
 
-        self.user = None
-        self.key = None
+    # ## Event streams
 
-        self.jobs = {}
-        self.task = []
+    def get_owned_node(self, request, response, data):
+        """Returns the node `data['node_id']` if it belongs to the
+authenticated user; otherwise, responds with an `invalid-node` error
+and returns `None`."""
 
-        self.connection_start_time = 0
+        render_node = self.server.nodes.get_node(data.get('node_id'))
 
-    def clear_server_info(self):
-        """Resets server info. Called when disconnecting (so we don't show
-stale server info.)"""
-        
-        self.server_info = {
-            'version': None,
-            'uptime': None
-        }
+        if not render_node or render_node.username != data['user']:
+            response.respond_json({
+                'status': 'error',
+                'code': 'invalid-node',
+                'message': 'No such node',
+                'context': data.get('node_id')
+            })
+            return None
 
-    def clear_local_state(self):
-        """Clears local state. Used in case of aborted connections or when
-disconnecting."""
-        self.clear_server_info()
+        return render_node
 
-        self.user = None
-        self.key = None
+    def route_node_events(self, request, response):
+        """Event stream route; see `events.py`. Runs without the server
+lock, for as long as the node stays connected."""
 
-    # ## Parse response JSON
+        if not self.verify_auth(request, response):
+            return
 
-    @staticmethod
-    def parse_json(json_string):
-        """Parses a `json_string` and returns the Python object; raises
-`error.Error('invalid-json')` if the string could not be decoded."""
-        
-        try:
-            json_data = json.loads(json_string)
-        except json.decoder.JSONDecodeError as _:
-            print('Could not decode JSON:')
-            print(json_string)
+        data = self.get_url_params(request, response)
 
-            raise bf_error.Error('invalid-json', 'Invalid or malformed JSON could not be decoded')
+        with self.server.lock:
+            render_node = self.get_owned_node(request, response, data)
 
-        return json_data
+            if not render_node:
+                return
 
-    def get_server_info(self, key):
-        """Returns "key" of server info; for example, "version" or "uptime"."""
+            try:
+                slots = max(1, int(data.get('slots', 1)))
+            except ValueError:
+                slots = 1
 
-        if key == 'version':
-            return self.server_info['version']
-        
-        # Values that increment with time.
-        elif key == 'uptime' or key == 'time':
-            if self.server_info[key]:
-                return self.server_info[key] + time.monotonic() - self.connection_start_time
-            return None
+            render_node.update_capabilities(data)
 
+            held_task_ids = [task_id for task_id in data.get('held', '').split(',') if task_id]
 
-    def handle_response(self, path, response, raise_errors=False):
-        """Handles a response from the server. If `raise_errors` is True,
-then any errors will be raised directly instead of being returned as a
-Python object."""
-        
-        # Handle the response.
+            stream = self.server.open_stream(render_node.node_id, slots, data, held_task_ids)
 
-        json_data = self.parse_json(response.text)
+        # The stream has no length; it ends when the connection does, so
+        # it mustn't take up a keep-alive slot.
+        response.close_connection = True
 
-        if not isinstance(json_data, dict) or response.status_code != 200:
-            raise bf_error.Error('http-error', 'Server returned an error status', context=str(response.status_code))
-        
-        if json_data['status'] == 'ok' or not raise_errors:
-            return json_data
+        response.send_response(200)
+        response.send_header('Content-Type', 'text/event-stream')
+        response.send_header('Cache-Control', 'no-cache')
+        response.send_header('Connection', 'close')
+        response.end_headers()
 
-        if not all(k in json_data for k in ('code', 'message')):
-            raise bf_error.Error('invalid-json', 'Invalid or malformed JSON could not be decoded')
+        try:
+            stream.serve(response.wfile)
+        except OSError:
+            pass
+        finally:
+            self.server.close_stream(stream)
 
-        context = path
+    def route_node_ack(self, request, response):
+        """Event acknowledgement route. `held` (for `renew` events) is the
+comma-separated list of tasks the node still holds; `slots` and any
+capabilities update what the node is offered from now on."""
 
-        if 'context' in json_data:
-            context = json_data['context']
-            
-        raise bf_error.Error(json_data['code'], json_data['message'], context)
+        if not self.verify_auth(request, response):
+            return
 
-    # ## Low-level communications
+        data = self.get_url_params(request, response)
 
-    def request_get(self, path, params=None, raise_errors=False, auth=False):
-        """Submits a `GET` request to the server. The path must *not* start with a leading '/'."""
+        if 'event_id' not in data:
+            self.route_error_400(request, response, context='missing parameters')
+            return
 
-        if not params:
-            params = {}
+        render_node = self.get_owned_node(request, response, data)
 
-        if auth:
-            params = self.add_auth(params)
+        if not render_node:
+            return
 
-        try:
-            response = self.session.get(self.build_url(path), params=params)
-        except requests.exceptions.ConnectionError as _:
-            raise bf_error.Error('network-error', 'Could not connect to the server', self.get_host_port())
+        stream = self.server.streams.get(render_node.node_id)
 
-        return self.handle_response(path, response, raise_errors)
+        if not stream:
+            response.respond_json({
+                'status': 'error',
+                'code': 'no-stream',
+                'message': 'Node has no event stream open',
+                'context': render_node.node_id
+            })
+            return
 
-    def request_post(self, path, params=None, data=None, raise_errors=False, auth=False):
-        """Submits a `POST` request to the server. The path must *not* start with a leading '/'."""
+        render_node.update_capabilities(data)
 
-        if not params:
-            params = {}
+        stream.parameters.update(data)
 
-        if auth:
-            params = self.add_auth(params)
+        if data.get('slots'):
+            stream.slots = max(1, int(data['slots']))
 
-        try:
-            response = self.session.post(self.build_url(path), params=params, data=data)
-        except requests.exceptions.ConnectionError as _:
-            raise bf_error.Error('network-error', 'Could not connect to the server', self.get_host_port())
+        held_task_ids = None
 
-        return self.handle_response(path, response, raise_errors)
+        if 'held' in data:
+            held_task_ids = [task_id for task_id in data['held'].split(',') if task_id]
 
-    def add_auth(self, data):
-        """Injects the HMAC digest into URL parameter data."""
-        
-        data['user'] = self.user
-        data['time'] = str(0)
+        self.server.acknowledge(stream, int(data['event_id']), held_task_ids)
 
-        data['digest'] = bf_digest.get_key_value_digest(data, self.key)
+        response.respond_json({
+            'status': 'ok'
+        })
 
-        return data
+    # ## Batches
 
-    # ## Actual server communications
-    
-    def request_server_info(self):
-        """Requests server info from server and populates our `server_info` fields."""
-        
-        response = self.request_get('/info.json')
+    def route_batch(self, request, response):
+        """Batch route. The body is a JSON list of operations, each with a
+`method`, a `path` (such as `/task/heartbeat.json`), URL `params` and
+optionally a text `body`; they're run in order, authenticated as the
+batch's user, and their JSON responses are returned in `results`."""
 
-        self.server_info['version'] = response['version']
-        self.server_info['uptime'] = response['uptime']
-        self.server_info['time'] = response['time']
+        if not self.verify_auth(request, response):
+            return
 
-    def request_auth_test(self):
-        """Makes sure the user/key pair is valid."""
-        
-        response = self.request_get('/auth/test.json', auth=True, raise_errors=True)
+        data = self.get_url_params(request, response)
 
-        # If any errors happened above, they would have raised an exception, so we're good here.
+        operations = self.get_json_body(request)
 
-    def request_next_task(self):
-        """Requests the next task task from the server."""
-        
-        response = self.request_get('/task/next.json', auth=True, raise_errors=True)
+        if not isinstance(operations, list) or not all(isinstance(operation, dict) for operation in operations):
+            self.route_error_400(request, response, context='invalid operations')
+            return
 
-        if not response['task'] or not response['job']:
-            return None
+        if len(operations) > Server.MAX_BATCH_SIZE:
+            self.route_error_400(request, response, context='too many operations')
+            return
 
-        job = bf_job.Job(None).unserialize(response['job'])
+        response.respond_json({
+            'status': 'ok',
+            'results': [self.run_batch_operation(request, data['user'], operation) for operation in operations]
+        })
 
-        next_task = bf_task.Task(job).unserialize(response['task'])
+    def run_batch_operation(self, request, user, operation):
+        """Runs a single `operation` of a batch sent by `user` over
+`request`, and returns its JSON response."""
 
-        return next_task
-        
-    def download_job_file(self, job, filename):
-        """Submits a `GET` request to the server. The path must *not* start with a leading '/'."""
+        method = str(operation.get('method', 'GET'))
+        path = '/' + str(operation.get('path', '')).lstrip('/')
+
+        params = {key: str(value) for key, value in (operation.get('params') or {}).items()}
+
+        # Batches must not hold up the operations that follow.
+        params.pop('wait', None)
+        params['user'] = user
+
+        url = path + '?' + urllib.parse.urlencode(params)
+
+        context = self.get_context(method, url[1:])
+
+        if context.route.path in Server.UNBATCHABLE_PATHS:
+            return {
+                'status': 'error',
+                'code': 'unbatchable',
+                'message': 'Operation cannot be part of a batch',
+                'context': path
+            }
+
+        if not self.admit(context.route):
+            return {
+                'status': 'error',
+                'code': 'overloaded',
+                'message': 'Server is busy, retry later',
+                'context': str(request.get_retry_after())
+            }
 
-        url = job.job_info.file_url
+        sub_request = bf_api.SubRequest(request, user, url, context, bytes(str(operation.get('body', '')), 'utf8'))
 
         try:
-            with open(filename, 'wb') as handle:
-                
-                response = self.session.get(url, stream=True)
+            if context.route.locked:
+                with self.server.lock:
+                    context.route.handler(sub_request, sub_request)
+            else:
+                context.route.handler(sub_request, sub_request)
+        except Exception as _: # pylint: disable=broad-except
+            print('Exception during batch operation "' + method + ': ' + path + '":')
+            traceback.print_exc()
+        finally:
+            self.release(context.route)
+
+        if sub_request.json_data is None:
+            return {
+                'status': 'error',
+                'code': '500',
+                'message': '500 Internal Server Error',
+                'context': path
+            }
 
-                if not response.ok:
-                    raise bf_error.Error('network-error', 'Could not download file for job', url)
+        return sub_request.json_data
 
-                for block in response.iter_content(1024):
-                    handle.write(block)
-        except requests.exceptions.ConnectionError as _:
-            raise bf_error.Error('network-error', 'Could not download file for job', url)
+    # ## Blob store
 
-        return filename
-        
-    def upload_render_result(self, task, filename, elapsed=0):
-        """Submits a `POST` request to the server including the rendered file `filename`."""
+    @staticmethod
+    def get_json_body(request):
+        """Returns the request body decoded as JSON, or `None` if it's
+missing or invalid."""
 
-        params = {
-            'task_id': task.task_id,
-            'job_id': task.job.job_id,
-            'elapsed': str(elapsed)
-        }
+        length = request.headers.get('content-length')
+
+        if not length:
+            return None
 
         try:
-            with open(filename, 'rb') as handle:
-                response = self.request_post('/task/result.json', params=params, data=handle, auth=True)
+            return json.loads(str(request.rfile.read(int(length)), 'utf8'))
+        except ValueError:
+            return None
+
+    def route_blob_missing(self, request, response):
+        """Missing chunks route. The body is a JSON list of chunk hashes."""
+
+        if not self.verify_auth(request, response):
+            return
 
-        except requests.exceptions.ConnectionError as _:
-            raise bf_error.Error('network-error', 'Could not upload file for job', url)
+        chunk_hashes = self.get_json_body(request)
+
+        if not isinstance(chunk_hashes, list):
+            self.route_error_400(request, response, context='expected a list of chunk hashes')
+            return
+
+        response.respond_json({
+            'status': 'ok',
+            'missing': self.server.blobs.get_missing_chunks(chunk_hashes)
+        })
+
+    def route_blob_chunk(self, request, response):
+        """Chunk upload route. The body is the chunk itself."""
+
+        if not self.verify_auth(request, response):
+            return
+
+        data = self.get_url_params(request, response)
+
+        length = request.headers.get('content-length')
+
+        if 'hash' not in data or not length:
+            self.route_error_400(request, response, context='missing parameters')
+            return
+
+        try:
+            self.server.blobs.put_chunk(data['hash'], request.rfile.read(int(length)))
+        except bf_error.Error as exception:
+            response.respond_json({
+                'status': 'error',
+                'code': exception.code,
+                'message': exception.message,
+                'context': exception.context
+            })
+            return
+
+        response.respond_json({
+            'status': 'ok'
+        })
+
+    def route_blob_commit(self, request, response):
+        """File commit route. The body is the JSON list of the file's chunk
+hashes, in order."""
+
+        if not self.verify_auth(request, response):
+            return
+
+        chunk_hashes = self.get_json_body(request)
+
+        if not isinstance(chunk_hashes, list):
+            self.route_error_400(request, response, context='expected a list of chunk hashes')
+            return
+
+        try:
+            manifest = self.server.blobs.commit(chunk_hashes)
+        except bf_error.Error as exception:
+            response.respond_json({
+                'status': 'error',
+                'code': exception.code,
+                'message': exception.message,
+                'context': exception.context
+            })
+            return
+
+        response.respond_json({
+            'status': 'ok',
+            'hash': manifest['hash'],
+            'size': manifest['size']
+        })
+
+    def route_blob_manifest(self, request, response):
+        """File manifest route."""
+
+        if not self.verify_auth(request, response):
+            return
+
+        data = self.get_url_params(request, response)
+
+        manifest = self.server.blobs.get_manifest(data.get('hash'))
+
+        if not manifest:
+            response.respond_json({
+                'status': 'error',
+                'code': 'invalid-file',
+                'message': 'No such file',
+                'context': data.get('hash')
+            })
+            return
+
+        response.respond_json({
+            'status': 'ok',
+            'manifest': manifest
+        })
+
+    @staticmethod
+    def get_byte_range(header, size):
+        """Parses the HTTP `Range` header `header` for a `size`-byte file.
+Returns `(start, end)` (`end` exclusive), or `None` if the range can't
+be satisfied. Only single ranges are supported."""
+
+        match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+
+        if not match or not (match.group(1) or match.group(2)):
+            return None
+
+        if not match.group(1):
+            # A suffix range: the last `n` bytes.
+            start = max(0, size - int(match.group(2)))
+            end = size
+        else:
+            start = int(match.group(1))
+            end = size
+
+            if match.group(2):
+                end = min(size, int(match.group(2)) + 1)
+
+        if start >= end:
+            return None
+
+        return start, end
+
+    def route_blob_file(self, request, response):
+        """File download route. Supports `HEAD` requests and HTTP ranges,
+so interrupted downloads can be resumed."""
+
+        if not self.verify_auth(request, response):
+            return
+
+        data = self.get_url_params(request, response)
+
+        manifest = self.server.blobs.get_manifest(data.get('hash'))
+
+        if not manifest:
+            response.respond_json({
+                'status': 'error',
+                'code': 'invalid-file',
+                'message': 'No such file',
+                'context': data.get('hash')
+            }, status=404)
+            return
+
+        size = manifest['size']
+
+        start, end = 0, size
+
+        if request.headers.get('Range'):
+            byte_range = self.get_byte_range(request.headers['Range'], size)
+
+            if not byte_range:
+                response.send_response(416)
+                response.send_header('Content-Range', 'bytes */' + str(size))
+                response.send_header('Content-Length', '0')
+                response.end_headers()
+                return
+
+            start, end = byte_range
+
+            response.send_response(206)
+            response.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(end - 1) + '/' + str(size))
+        else:
+            response.send_response(200)
+
+        response.send_header('Content-Type', 'application/octet-stream')
+        response.send_header('Content-Length', str(end - start))
+        response.send_header('Accept-Ranges', 'bytes')
+        response.end_headers()
+
+        if request.command == 'HEAD':
+            return
+
+        for block in self.server.blobs.read_file(manifest, start, end):
+            response.wfile.write(block)
+
+
+    def route_peer_announce(self, request, response):
+        """Peer announcement route; see `tracker.Tracker.announce()`."""
+
+        if not self.verify_auth(request, response):
+            return
+
+        data = self.get_url_params(request, response)
+
+        if not all(k in data for k in ('node_id', 'hash', 'status')):
+            self.route_error_400(request, response, context='missing parameters')
+            return
+
+        render_node = self.server.nodes.get_node(data['node_id'])
+
+        if not render_node or render_node.username != data['user']:
+            response.respond_json({
+                'status': 'error',
+                'code': 'invalid-node',
+                'message': 'No such node',
+                'context': data['node_id']
+            })
+            return
+
+        if data['status'] == 'gone':
+            self.server.tracker.remove(data['hash'], data['node_id'])
+
+            response.respond_json({
+                'status': 'ok',
+                'parent': None
+            })
+            return
+
+        try:
+            port = int(data.get('port', 0))
+        except ValueError:
+            port = 0
+
+        if not port:
+            self.route_error_400(request, response, context='missing or invalid port')
+            return
+
+        parent = self.server.tracker.announce(data['hash'], data['node_id'], request.client_address[0], port,
+                                              data['status'] == 'complete', data.get('failed'))
+
+        response.respond_json({
+            'status': 'ok',
+            'parent': parent
+        })
+
+
+class Client(bf_api.APIClient):
+
+    """v1 API client (must talk with the v1 server, above)"""
+
+    # Job files are downloaded in blocks of this many bytes.
+    DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+    # Times a request the server turns away under load (with `429` or
+    # `503`) is retried, after the `Retry-After` delay it asks for.
+    OVERLOAD_RETRIES = 5
+
+    # Job files are only split into parallel segments if every segment
+    # is at least this many bytes.
+    MIN_SEGMENT_SIZE = 64 * 1024 * 1024
+
+    # Seconds to wait for a file server to respond (or to send the next
+    # block) before giving up; the download is resumed later.
+    DOWNLOAD_TIMEOUT = 60
+
+    def __init__(self):
+        super().__init__()
+
+        self.server_info = {}
+
+        self.clear_local_state()
+
+        self.api_version = '1'
+
+        self.user = None
+        self.key = None
+
+        self.jobs = {}
+        self.task = []
+
+        # Seconds the server leases tasks to us for, as of the last
+        # task request or heartbeat.
+        self.lease_time = 15 * 60
+
+        # If `True`, we ask the server for responses in the binary wire
+        # encoding (see `wire.py`); servers that don't support it
+        # answer in JSON anyway.
+        self.binary = True
+
+        # Calls to `request_coalesced()` waiting to be sent, whether one
+        # is being sent right now, and whether the server supports
+        # `batch.json` (until it tells us otherwise).
+        self.batch_queue = []
+        self.batch_sending = False
+        self.batch_condition = threading.Condition()
+        self.batch_supported = True
+
+        # Job file downloads (and chunks from peers), and result uploads
+        # (and chunks served to peers), pass through these; see
+        # `bandwidth.py`.
+        self.download_bucket = bf_bandwidth.TokenBucket()
+        self.upload_bucket = bf_bandwidth.TokenBucket()
+
+        self.connection_start_time = 0
+
+    def clear_server_info(self):
+        """Resets server info. Called when disconnecting (so we don't show
+stale server info.)"""
+        
+        self.server_info = {
+            'version': None,
+            'uptime': None
+        }
+
+    def clear_local_state(self):
+        """Clears local state. Used in case of aborted connections or when
+disconnecting."""
+        self.clear_server_info()
+
+        self.user = None
+        self.key = None
+
+    # ## Parse response JSON
+
+    @staticmethod
+    def parse_json(json_string):
+        """Parses a `json_string` and returns the Python object; raises
+`error.Error('invalid-json')` if the string could not be decoded."""
+        
+        try:
+            json_data = json.loads(json_string)
+        except json.decoder.JSONDecodeError as _:
+            print('Could not decode JSON:')
+            print(json_string)
+
+            raise bf_error.Error('invalid-json', 'Invalid or malformed JSON could not be decoded')
+
+        return json_data
+
+    def parse_response(self, response):
+        """Parses the body of the API `response`, JSON or binary (see
+`wire.py`) depending on its `Content-Type`; raises
+`error.Error('invalid-json')` if it can't be decoded."""
+
+        if not response.headers.get('Content-Type', '').startswith(bf_wire.CONTENT_TYPE):
+            return self.parse_json(response.text)
+
+        try:
+            return bf_wire.loads(response.content)
+        except ValueError:
+            raise bf_error.Error('invalid-json', 'Invalid or malformed response could not be decoded')
+
+    def get_headers(self):
+        """Returns the headers of our API requests. `requests` decodes
+compressed responses on its own."""
+
+        headers = {
+            'Accept-Encoding': 'gzip, deflate'
+        }
+
+        if self.binary:
+            headers['Accept'] = bf_wire.CONTENT_TYPE + ', application/json'
+
+        return headers
+
+    def get_server_info(self, key):
+        """Returns "key" of server info; for example, "version" or "uptime"."""
+
+        if key == 'version':
+            return self.server_info['version']
+        
+        # Values that increment with time.
+        elif key == 'uptime' or key == 'time':
+            if self.server_info[key]:
+                return self.server_info[key] + time.monotonic() - self.connection_start_time
+            return None
+
+
+    def handle_response(self, path, response, raise_errors=False):
+        """Handles a response from the server. If `raise_errors` is True,
+then any errors will be raised directly instead of being returned as a
+Python object."""
+        
+        # Handle the response.
+
+        json_data = self.parse_response(response)
+
+        if not isinstance(json_data, dict) or response.status_code != 200:
+            raise bf_error.Error('http-error', 'Server returned an error status', context=str(response.status_code))
+
+        return self.handle_json(path, json_data, raise_errors)
+
+    @staticmethod
+    def handle_json(path, json_data, raise_errors=False):
+        """Handles the JSON response `json_data` to a request for `path`;
+see `handle_response()`."""
+
+        if json_data['status'] == 'ok' or not raise_errors:
+            return json_data
+
+        if not all(k in json_data for k in ('code', 'message')):
+            raise bf_error.Error('invalid-json', 'Invalid or malformed JSON could not be decoded')
+
+        context = path
+
+        if 'context' in json_data:
+            context = json_data['context']
+            
+        raise bf_error.Error(json_data['code'], json_data['message'], context)
+
+    # ## Low-level communications
+
+    @staticmethod
+    def get_retry_after(response):
+        """Returns the seconds to wait before retrying if the server turned
+`response`'s request away under load, or `None` if it didn't."""
+
+        if response.status_code not in (429, 503):
+            return None
+
+        try:
+            return max(0, float(response.headers.get('Retry-After', 1)))
+        except ValueError:
+            return 1
+
+    def send_request(self, method, path, params, data=None):
+        """Sends a request and returns its response. Requests the server
+turns away under load are retried up to `OVERLOAD_RETRIES` times, as
+soon as it asks for, unless `data` is a file (which can't be sent
+again); after that, raises `error.Error('overloaded')` with the delay
+as its context."""
+
+        for attempt in range(Client.OVERLOAD_RETRIES + 1):
+            try:
+                response = self.session.request(method, self.build_url(path), params=params, data=data,
+                                                headers=self.get_headers())
+            except requests.exceptions.RequestException as _:
+                raise bf_error.Error('network-error', 'Could not connect to the server', self.get_host_port())
+
+            retry_after = self.get_retry_after(response)
+
+            if retry_after is None:
+                return response
+
+            if attempt == Client.OVERLOAD_RETRIES or hasattr(data, 'read'):
+                break
+
+            # The server adds jitter in whole seconds; spread retries
+            # within the second, too.
+            time.sleep(retry_after + random.uniform(0, 1))
+
+        raise bf_error.Error('overloaded', 'Server is busy, retry later', str(retry_after))
+
+    def request_get(self, path, params=None, raise_errors=False, auth=False):
+        """Submits a `GET` request to the server. The path must *not* start with a leading '/'."""
+
+        if not params:
+            params = {}
+
+        if auth:
+            params = self.add_auth(params)
+
+        response = self.send_request('GET', path, params)
+
+        return self.handle_response(path, response, raise_errors)
+
+    def request_post(self, path, params=None, data=None, raise_errors=False, auth=False):
+        """Submits a `POST` request to the server. The path must *not* start with a leading '/'."""
+
+        if not params:
+            params = {}
+
+        if auth:
+            params = self.add_auth(params)
+
+        response = self.send_request('POST', path, params, data)
+
+        return self.handle_response(path, response, raise_errors)
+
+    def request_coalesced(self, method, path, params=None, data=None, raise_errors=False):
+        """Submits an authenticated `method` request, like `request_get()`
+and `request_post()` with `auth`. Requests made by other threads while
+one is in flight are queued, and once it returns they're sent together
+in a single `batch.json` request (see `send_batch()`), so a busy node
+doesn't pay a round trip for each. `data`, if present, must be text."""
+
+        # pylint: disable=too-many-arguments
+
+        call = {
+            'operation': {
+                'method': method,
+                'path': path,
+                'params': params or {}
+            },
+            'done': False,
+            'response': None,
+            'error': None
+        }
+
+        if data is not None:
+            call['operation']['body'] = data
+
+        with self.batch_condition:
+            self.batch_queue.append(call)
+
+            while self.batch_sending and not call['done']:
+                self.batch_condition.wait()
+
+            if not call['done']:
+                calls = self.batch_queue
+                self.batch_queue = []
+                self.batch_sending = True
+
+        if not call['done']:
+            try:
+                self.send_batch(calls)
+            finally:
+                with self.batch_condition:
+                    self.batch_sending = False
+                    self.batch_condition.notify_all()
+
+        if call['error']:
+            raise call['error']
+
+        return self.handle_json(path, call['response'], raise_errors)
+
+    def send_batch(self, calls):
+        """Sends the queued `calls` of `request_coalesced()`: a single one
+on its own, and more in a `batch.json` request, unless the server
+doesn't support it. Stores every call's response or error."""
+
+        if len(calls) > 1 and self.batch_supported:
+            try:
+                response = self.request_post('/batch.json', data=json.dumps([call['operation'] for call in calls]),
+                                             auth=True, raise_errors=True)
+
+                for call, result in zip(calls, response['results']):
+                    call['response'] = result
+                    call['done'] = True
+
+                return
+            except bf_error.Error as exception:
+                if exception.code != 'http-error':
+                    for call in calls:
+                        call['error'] = exception
+                        call['done'] = True
+
+                    return
+
+                # An older server; send them one by one from now on.
+                self.batch_supported = False
+
+        for call in calls:
+            operation = call['operation']
+
+            try:
+                if operation['method'] == 'GET':
+                    call['response'] = self.request_get(operation['path'], dict(operation['params']), auth=True)
+                else:
+                    call['response'] = self.request_post(operation['path'], dict(operation['params']),
+                                                         operation.get('body'), auth=True)
+            except bf_error.Error as exception:
+                call['error'] = exception
+
+            call['done'] = True
+
+    def add_auth(self, data):
+        """Injects the HMAC digest into URL parameter data."""
+        
+        data['user'] = self.user
+        data['time'] = str(0)
+
+        data['digest'] = bf_digest.get_key_value_digest(data, self.key)
+
+        return data
+
+    # ## Actual server communications
+    
+    def request_server_info(self):
+        """Requests server info from server and populates our `server_info` fields."""
+        
+        response = self.request_get('/info.json')
+
+        self.server_info['version'] = response['version']
+        self.server_info['uptime'] = response['uptime']
+        self.server_info['time'] = response['time']
+
+        self.update_bandwidth_limits(response)
+
+    def set_bandwidth_limits(self, download_limit='', upload_limit=''):
+        """Sets our own download and upload limits (see `bandwidth.py`).
+Raises `ValueError` if either is malformed."""
+
+        download_limit, upload_limit = bf_bandwidth.Limit(download_limit), bf_bandwidth.Limit(upload_limit)
+
+        self.download_bucket.set_limit(download_limit)
+        self.upload_bucket.set_limit(upload_limit)
+
+    def update_bandwidth_limits(self, data):
+        """Applies the `download_limit` and `upload_limit` the server sets
+for its nodes in `data` (an `info.json` or heartbeat response, or an
+`info` or `renew` event) over our own; limits it doesn't set are
+lifted."""
+
+        for key, bucket in (('download_limit', self.download_bucket), ('upload_limit', self.upload_bucket)):
+            try:
+                bucket.set_override(bf_bandwidth.Limit(data[key]) if data.get(key) else None)
+            except ValueError:
+                print('ignoring invalid ' + key + ' "' + str(data[key]) + '" from the server')
+
+    def request_auth_test(self):
+        """Makes sure the user/key pair is valid."""
+        
+        response = self.request_get('/auth/test.json', auth=True, raise_errors=True)
+
+        # If any errors happened above, they would have raised an exception, so we're good here.
+
+    def request_node_register(self, capabilities, node_id=None):
+        """Registers this machine as a render node with `capabilities`
+(see `node.Node.update_capabilities()`). If `node_id` is present, the
+existing node is updated instead. Returns the registered `node.Node`."""
+
+        params = {key: str(value) for key, value in capabilities.items()}
+
+        if node_id:
+            params['node_id'] = node_id
+
+        response = self.request_post('/node/register.json', params=params, auth=True, raise_errors=True)
+
+        return bf_node.Node().unserialize(response['node'])
+
+    def request_next_task(self, node_id=None, capabilities=None):
+        """Requests the next task task from the server. If `node_id` is
+present, only tasks this node is capable of performing are returned;
+`capabilities` may contain updated capabilities (such as `disk_free`
+or `memory_free`)."""
+
+        tasks = self.request_next_tasks(node_id, capabilities)
+
+        if not tasks:
+            return None
+
+        return tasks[0]
+
+    def request_next_tasks(self, node_id=None, capabilities=None, count=1, wait=0):
+        """Requests up to `count` tasks from the server at once; returns a
+(possibly empty) list of tasks. See `request_next_task()`. If `wait` is
+present, the server holds the request for up to that many seconds
+until there's work. The number of seconds the tasks are leased for is
+stored in `lease_time`."""
+
+        params = {}
+
+        if capabilities:
+            params = {key: str(value) for key, value in capabilities.items()}
+
+        if node_id:
+            params['node_id'] = node_id
+
+        if count != 1:
+            params['count'] = str(count)
+
+        if wait:
+            params['wait'] = str(wait)
+
+            response = self.request_get('/task/next.json', params=params, auth=True, raise_errors=True)
+        else:
+            response = self.request_coalesced('GET', '/task/next.json', params, raise_errors=True)
+
+        if not response['task'] or not response['job']:
+            return []
+
+        self.lease_time = response.get('lease_time', self.lease_time)
+
+        return self.parse_tasks(response.get('tasks') or [{'job': response['job'], 'task': response['task']}])
+
+    @staticmethod
+    def parse_tasks(entries):
+        """Returns the tasks described by `entries`, a list of `{"job":
+..., "task": ...}` dictionaries; tasks of the same job share a single
+`job.Job`."""
+
+        jobs = {}
+        tasks = []
+
+        for entry in entries:
+            job_id = entry['job']['job_id']
+
+            if job_id not in jobs:
+                jobs[job_id] = bf_job.Job(None).unserialize(entry['job'])
+
+            tasks.append(bf_task.Task(jobs[job_id]).unserialize(entry['task']))
+
+        return tasks
+
+    def request_heartbeat(self, node_id, task_ids):
+        """Renews our leases on the tasks `task_ids`. Returns the list of
+task IDs we no longer hold; those should be abandoned."""
+
+        params = {
+            'node_id': node_id,
+            'task_ids': ','.join(task_ids)
+        }
+
+        response = self.request_coalesced('POST', '/task/heartbeat.json', params, raise_errors=True)
+
+        self.lease_time = response.get('lease_time', self.lease_time)
+
+        self.update_bandwidth_limits(response)
+
+        return response['lost']
+
+    def request_events(self, node_id, slots, capabilities=None, held_task_ids=()):
+        """Opens our event stream (see `events.py`), announcing that we
+want to hold up to `slots` tasks and already hold `held_task_ids`, and
+yields every event as `(event_id, event_type, data)` until the server
+closes it. `info`, `renew` and `offer` events update `lease_time`, and
+`info` and `renew` events the server's bandwidth limits.
+Raises `error.Error('network-error')` when the connection drops, and
+`error.Error('http-error')` if the server doesn't support event
+streams."""
+
+        params = {}
+
+        if capabilities:
+            params = {key: str(value) for key, value in capabilities.items()}
+
+        params['node_id'] = node_id
+        params['slots'] = str(slots)
+        params['held'] = ','.join(held_task_ids)
+
+        params = self.add_auth(params)
+
+        try:
+            response = self.session.get(self.build_url('/node/events'), params=params, stream=True,
+                                        timeout=Client.DOWNLOAD_TIMEOUT)
+        except requests.exceptions.RequestException:
+            raise bf_error.Error('network-error', 'Could not connect to the server', self.get_host_port())
+
+        with response:
+            retry_after = self.get_retry_after(response)
+
+            if retry_after is not None:
+                raise bf_error.Error('overloaded', 'Server is busy, retry later', str(retry_after))
+
+            if not response.headers.get('Content-Type', '').startswith('text/event-stream'):
+                self.handle_response('/node/events', response, raise_errors=True)
+
+                raise bf_error.Error('http-error', 'Server did not open an event stream',
+                                     str(response.status_code))
+
+            try:
+                # Events are small, and must be handled as soon as they
+                # arrive, rather than once a bigger block fills up.
+                lines = response.iter_lines(chunk_size=1, decode_unicode=True)
+
+                for event_id, event_type, data in bf_events.parse_events(lines):
+                    if 'lease_time' in data:
+                        self.lease_time = data['lease_time']
+
+                    if event_type in ('info', 'renew'):
+                        self.update_bandwidth_limits(data)
+
+                    yield event_id, event_type, data
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError):
+                raise bf_error.Error('network-error', 'Lost the event stream', self.get_host_port())
+
+    def request_ack(self, node_id, event_id, held_task_ids=None, slots=None, capabilities=None):
+        """Acknowledges the event `event_id`. `held_task_ids` (for `renew`
+events) lists every task we still hold; `slots` and `capabilities`
+update what the server offers us from now on."""
+
+        # pylint: disable=too-many-arguments
+
+        params = {}
+
+        if capabilities:
+            params = {key: str(value) for key, value in capabilities.items()}
+
+        params['node_id'] = node_id
+        params['event_id'] = str(event_id)
+
+        if held_task_ids is not None:
+            params['held'] = ','.join(held_task_ids)
+
+        if slots:
+            params['slots'] = str(slots)
+
+        self.request_coalesced('POST', '/node/ack.json', params, raise_errors=True)
+
+    def download_job_file(self, job, filename, hasher=None, segments=1):
+        """Downloads the work file of `job` into `filename`, resuming from
+whatever `filename` already holds (see `download_range()`). If
+`hasher` (a `hashlib` object) is present, it's updated with the whole
+file contents. Large files are downloaded in up to `segments` parallel
+ranges if the server supports it (see `download_segments()`)."""
+
+        url = self.get_job_file_url(job)
+
+        if segments > 1 and not os.path.isfile(filename):
+            size = self.get_download_size(url)
+
+            segments = min(segments, size // Client.MIN_SEGMENT_SIZE)
+
+            if segments > 1:
+                self.download_segments(url, filename, size, segments, hasher)
+                return filename
+
+        self.download_range(url, filename, hasher=hasher)
+
+        return filename
+
+    def get_job_file_url(self, job):
+        """Returns the URL to download the work file of `job` from: its
+`file_url`, or our server's blob store if the file is hosted there."""
+
+        if job.job_info.file_url:
+            return job.job_info.file_url
+
+        params = self.add_auth({
+            'hash': job.job_info.file_hash
+        })
+
+        return self.build_url('/blob/file.blend') + '?' + urllib.parse.urlencode(params)
+
+    def request_file_manifest(self, file_hash):
+        """Returns the manifest of the file `file_hash` in the server's
+blob store (see `blob.get_file_manifest()`)."""
+
+        response = self.request_get('/blob/manifest.json', params={'hash': file_hash}, auth=True,
+                                    raise_errors=True)
+
+        return response['manifest']
+
+    def request_peer_announce(self, node_id, file_hash, port, status, failed_id=None):
+        """Tells the tracker that our peer server on `port` is downloading
+(`status` is `"downloading"`), holds (`"complete"`) or dropped
+(`"gone"`) the file `file_hash`. `failed_id` is a peer we couldn't
+download from. Returns the peer to download from as a dictionary with
+its `node_id`, `address` and `port`, or `None` for the server."""
+
+        # pylint: disable=too-many-arguments
+
+        params = {
+            'node_id': node_id,
+            'hash': file_hash,
+            'port': str(port),
+            'status': status
+        }
+
+        if failed_id:
+            params['failed'] = failed_id
+
+        response = self.request_coalesced('POST', '/peer/announce.json', params, raise_errors=True)
+
+        return response['parent']
+
+    def request_peer_chunk(self, peer, chunk_hash, wait=0):
+        """Requests the chunk `chunk_hash` from `peer` (as returned by
+`request_peer_announce()`), waiting up to `wait` seconds for the peer
+to receive it. Returns the chunk, or `None` if the peer doesn't have
+it or can't be reached. The chunk is verified against its hash."""
+
+        url = 'http://' + peer['address'] + ':' + str(peer['port']) + '/chunk'
+
+        try:
+            response = self.session.get(url, params={'hash': chunk_hash, 'wait': str(wait)},
+                                        timeout=wait + Client.DOWNLOAD_TIMEOUT)
+        except requests.exceptions.RequestException:
+            return None
+
+        if response.status_code != 200 or bf_blob.get_hash(response.content) != chunk_hash:
+            return None
+
+        self.download_bucket.consume(len(response.content))
+
+        return response.content
+
+    def get_download_size(self, url):
+        """Returns the size of the file at `url` in bytes if its server
+supports range requests, or `0` otherwise."""
+
+        try:
+            response = self.session.head(url, allow_redirects=True, timeout=Client.DOWNLOAD_TIMEOUT)
+        except requests.exceptions.RequestException:
+            return 0
+
+        if not response.ok or response.headers.get('Accept-Ranges') != 'bytes':
+            return 0
+
+        try:
+            return int(response.headers.get('Content-Length', 0))
+        except ValueError:
+            return 0
+
+    def download_range(self, url, filename, start=0, end=None, hasher=None, session=None):
+        """Downloads bytes `start` to `end`-1 (or to the end) of the file at
+`url` into `filename`. If `filename` already holds the first part of
+the range, only the rest is requested with an HTTP `Range` header, so
+interrupted downloads pick up where they left off; an interrupted
+download raises `error.Error('network-error')` and leaves `filename`
+in place. `hasher` is updated with the contents of `filename`.
+`session` is the `requests.Session` to use (by default, ours)."""
+
+        # pylint: disable=too-many-arguments,too-many-branches
+
+        session = session or self.session
+
+        offset = 0
+
+        if os.path.isfile(filename):
+            offset = os.path.getsize(filename)
+
+        if end is not None and start + offset >= end:
+            return
+
+        headers = {
+            # We want the bytes as they're stored, so we can resume
+            # at an offset and read them straight into our buffer.
+            'Accept-Encoding': 'identity'
+        }
+
+        if start + offset or end is not None:
+            headers['Range'] = 'bytes=' + str(start + offset) + '-' + ('' if end is None else str(end - 1))
+
+        try:
+            response = session.get(url, headers=headers, stream=True, timeout=Client.DOWNLOAD_TIMEOUT)
+        except requests.exceptions.RequestException:
+            raise bf_error.Error('network-error', 'Could not download file for job', url)
+
+        with response:
+            if response.status_code == 416 and offset and not start and end is None:
+                if response.headers.get('Content-Range') == 'bytes */' + str(offset):
+                    # We already have the whole file.
+                    if hasher:
+                        Client.hash_file(filename, hasher)
+
+                    return None
+
+                # Our partial file is no prefix of the file on the
+                # server; start over.
+                os.remove(filename)
+                return self.download_range(url, filename, start, end, hasher, session)
+
+            if response.status_code == 206:
+                mode = 'ab'
+            elif response.status_code == 200 and not start and end is None:
+                # The server doesn't support ranges; start over.
+                mode = 'wb'
+                offset = 0
+            else:
+                raise bf_error.Error('network-error', 'Could not download file for job', url)
+
+            if hasher and offset:
+                Client.hash_file(filename, hasher)
+
+            with open(filename, mode) as handle:
+                Client.read_response(url, response, handle, hasher, self.download_bucket)
+
+        return None
+
+    @staticmethod
+    def read_response(url, response, output, hasher=None, bucket=None):
+        """Reads the body of the streamed download `response` from `url`
+in blocks, writing it to the file object `output` and updating
+`hasher`, at the rate `bucket` (a `bandwidth.TokenBucket`) allows.
+Raises `error.Error('network-error')` if the body ends short
+of its `Content-Length`. Returns the number of bytes read."""
+
+        length = response.headers.get('Content-Length')
+
+        received = 0
+
+        buffer = bytearray(Client.DOWNLOAD_BLOCK_SIZE)
+        view = memoryview(buffer)
+
+        try:
+            while True:
+                size = response.raw.readinto(buffer)
+
+                if not size:
+                    break
+
+                output.write(view[:size])
+
+                if hasher:
+                    hasher.update(view[:size])
+
+                received += size
+
+                if bucket:
+                    bucket.consume(size)
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError):
+            raise bf_error.Error('network-error', 'Download of file for job was interrupted', url)
+
+        if length and length.isdigit() and received < int(length):
+            raise bf_error.Error('network-error', 'Download of file for job was interrupted', url)
+
+        return received
+
+    def copy_range(self, url, start, end, output, hasher=None):
+        """Downloads bytes `start` to `end`-1 of the file at `url` straight
+into the file object `output`, updating `hasher`. Unlike
+`download_range()`, this can't be resumed."""
+
+        # pylint: disable=too-many-arguments
+
+        headers = {
+            'Accept-Encoding': 'identity',
+            'Range': 'bytes=' + str(start) + '-' + str(end - 1)
+        }
+
+        try:
+            response = self.session.get(url, headers=headers, stream=True, timeout=Client.DOWNLOAD_TIMEOUT)
+        except requests.exceptions.RequestException:
+            raise bf_error.Error('network-error', 'Could not download file for job', url)
+
+        with response:
+            if response.status_code != 206:
+                raise bf_error.Error('network-error', 'Could not download file for job', url)
+
+            if Client.read_response(url, response, output, hasher, self.download_bucket) != end - start:
+                raise bf_error.Error('network-error', 'Download of file for job was interrupted', url)
+
+    def download_segments(self, url, filename, size, segments, hasher=None):
+        """Downloads the `size`-byte file at `url` into `filename` in
+`segments` parallel ranges, each into its own resumable
+`<filename>.<index>` file; once all of them are complete, they're
+joined into `filename` (updating `hasher` on the way) and removed."""
+
+        # pylint: disable=too-many-arguments
+
+        bounds = [size * index // segments for index in range(segments + 1)]
+
+        segment_filenames = [filename + '.' + str(index) for index in range(segments)]
+
+        errors = []
+
+        def download_segment(index):
+            with requests.Session() as session:
+                try:
+                    self.download_range(url, segment_filenames[index], bounds[index], bounds[index + 1],
+                                        session=session)
+                except bf_error.Error as exception:
+                    errors.append(exception)
+
+        threads = [threading.Thread(target=download_segment, args=(index,), daemon=True)
+                   for index in range(segments)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        with open(filename, 'wb') as handle:
+            for segment_filename in segment_filenames:
+                Client.hash_file(segment_filename, hasher, handle)
+
+        for segment_filename in segment_filenames:
+            os.remove(segment_filename)
+
+    @staticmethod
+    def hash_file(filename, hasher=None, output=None):
+        """Reads `filename` in blocks, updating `hasher` and writing to the
+file object `output` if they're present."""
+
+        buffer = bytearray(Client.DOWNLOAD_BLOCK_SIZE)
+        view = memoryview(buffer)
+
+        with open(filename, 'rb') as handle:
+            while True:
+                size = handle.readinto(buffer)
+
+                if not size:
+                    break
+
+                if hasher:
+                    hasher.update(view[:size])
+
+                if output:
+                    output.write(view[:size])
+
+    def upload_job_file(self, filename):
+        """Uploads the local file `filename` into the server's blob store
+and returns its manifest (see `blob.get_file_manifest()`). Only chunks
+the server lacks are sent, so re-uploading a revised file (or resuming
+an interrupted upload) is cheap."""
+
+        manifest = bf_blob.get_file_manifest(filename)
+
+        chunk_hashes = [chunk_hash for chunk_hash, _ in manifest['chunks']]
+
+        response = self.request_post('/blob/missing.json', data=json.dumps(chunk_hashes), auth=True,
+                                     raise_errors=True)
+
+        missing = set(response['missing'])
+
+        with open(filename, 'rb') as handle:
+            for chunk_hash, chunk_size in manifest['chunks']:
+                if chunk_hash not in missing:
+                    handle.seek(chunk_size, os.SEEK_CUR)
+                    continue
+
+                missing.discard(chunk_hash)
+
+                self.upload_bucket.consume(chunk_size)
+
+                self.request_post('/blob/chunk.json', params={'hash': chunk_hash}, data=handle.read(chunk_size),
+                                  auth=True, raise_errors=True)
+
+        response = self.request_post('/blob/commit.json', data=json.dumps(chunk_hashes), auth=True,
+                                     raise_errors=True)
+
+        if response['hash'] != manifest['hash']:
+            raise bf_error.Error('invalid-file', 'Uploaded file does not match its hash', filename)
+
+        return manifest
+
+    def upload_render_result(self, task, filename, elapsed=0, peak_memory=0):
+        """Submits a `POST` request to the server including the rendered
+file `filename`. `peak_memory` is the peak memory usage of the render,
+in bytes (`0` if unknown). Raises an `error.Error` if the upload fails."""
+
+        return self.upload_result(task.job.job_id, task.task_id, filename, elapsed, peak_memory)
+
+    def upload_result(self, job_id, task_id, filename, elapsed=0, peak_memory=0):
+        """Same as `upload_render_result()`, but only needs the IDs of the
+job and task; used to upload results saved before a restart."""
+
+        # pylint: disable=too-many-arguments
+
+        params = {
+            'task_id': task_id,
+            'job_id': job_id,
+            'elapsed': str(elapsed),
+            'peak_memory': str(int(peak_memory))
+        }
+
+        try:
+            with open(filename, 'rb') as handle:
+                self.request_post('/task/result.json', params=params,
+                                  data=bf_bandwidth.ShapedReader(handle, self.upload_bucket), auth=True,
+                                  raise_errors=True)
+        except OSError as _:
+            raise bf_error.Error('missing-file', 'Could not read result file for task', filename)
 
         return filename
         
@@ -0,0 +1,208 @@
+"""Bandwidth shaping for render node transfers. Job file downloads and
+result uploads (plus chunks served to peers) each pass through a
+`TokenBucket`, so a farm of nodes doesn't saturate the network.
+
+Limits are given as comma-separated entries, each either a rate or a
+local time-of-day window with its own rate:
+
+    09:00-18:00=2M,0
+
+limits transfers to 2 MiB/s during working hours and lifts the limit
+(`0`) the rest of the day. Rates are in bytes per second, with an
+optional `K`, `M` or `G` suffix (powers of 1024); windows may wrap
+around midnight, and the first matching window wins. Transfers are
+slowed down, never cut off, when a window starts."""
+
+import os
+import threading
+import time
+
+def parse_rate(text):
+    """Returns the rate `text` (such as `"512K"`) in bytes per second.
+Raises `ValueError` if it's malformed."""
+
+    text = text.strip().upper()
+
+    multiplier = 1
+
+    for suffix, suffix_multiplier in (('K', 1024), ('M', 1024 ** 2), ('G', 1024 ** 3)):
+        if text.endswith(suffix):
+            text = text[:-1]
+            multiplier = suffix_multiplier
+
+    rate = float(text) * multiplier
+
+    if rate < 0:
+        raise ValueError('negative rate "' + text + '"')
+
+    return int(rate)
+
+def parse_time(text):
+    """Returns the local time `text` (`"HH:MM"`) in minutes since midnight.
+Raises `ValueError` if it's malformed."""
+
+    hours, _, minutes = text.strip().partition(':')
+
+    minute = int(hours) * 60 + int(minutes or 0)
+
+    if not 0 <= minute <= 24 * 60:
+        raise ValueError('invalid time "' + text + '"')
+
+    return minute
+
+class Limit:
+
+    """A bandwidth limit parsed from `spec` (see above); an empty spec
+means no limit. Raises `ValueError` if `spec` is malformed."""
+
+    def __init__(self, spec=''):
+        self.spec = spec or ''
+
+        # Rate outside of every window, in bytes per second; `0` for no
+        # limit.
+        self.rate = 0
+
+        # `(start, end, rate)` of every window, in minutes since
+        # midnight.
+        self.windows = []
+
+        for entry in self.spec.split(','):
+            if not entry.strip():
+                continue
+
+            if '=' not in entry:
+                self.rate = parse_rate(entry)
+                continue
+
+            window, _, rate = entry.partition('=')
+            start, separator, end = window.partition('-')
+
+            if not separator:
+                raise ValueError('invalid window "' + window + '"')
+
+            self.windows.append((parse_time(start), parse_time(end), parse_rate(rate)))
+
+    def get_rate(self, now=None):
+        """Returns the rate in effect at `now` (a `time.time()` time; by
+default, the current time), in bytes per second; `0` for no limit."""
+
+        local_time = time.localtime(now)
+
+        minute = local_time.tm_hour * 60 + local_time.tm_min
+
+        for start, end, rate in self.windows:
+            if start <= end:
+                inside = start <= minute < end
+            else:
+                inside = minute >= start or minute < end
+
+            if inside:
+                return rate
+
+        return self.rate
+
+class TokenBucket:
+
+    """Limits the bytes passed through it to the rate of `limit` (a
+`Limit`), or to that of the override the server sets, allowing bursts
+of up to one second's worth. Safe to share between threads, which
+share its bandwidth."""
+
+    # Seconds between checks of the time-of-day schedule.
+    SCHEDULE_TIME = 10
+
+    def __init__(self, limit=None):
+        self.limit = limit or Limit()
+
+        # A `Limit` that takes precedence over `limit`, or `None`.
+        self.override = None
+
+        # Current rate in bytes per second (`0` for no limit), and the
+        # `time.monotonic()` time it was last looked up.
+        self.rate = 0
+        self.rate_time = None
+
+        # Bytes that may pass right away; negative while transfers wait
+        # for the bytes they've already taken.
+        self.tokens = 0
+        self.update_time = time.monotonic()
+
+        self.lock = threading.Lock()
+
+    def set_limit(self, limit):
+        """Sets our own `Limit`."""
+
+        with self.lock:
+            self.limit = limit
+            self.rate_time = None
+
+    def set_override(self, limit):
+        """Sets the `Limit` the server imposes over ours; `None` lifts it."""
+
+        with self.lock:
+            self.override = limit
+            self.rate_time = None
+
+    def get_rate(self):
+        """Returns the rate currently in effect, in bytes per second; `0`
+for no limit."""
+
+        with self.lock:
+            return (self.override or self.limit).get_rate()
+
+    def consume(self, size):
+        """Takes `size` bytes from the bucket, sleeping for as long as it
+takes the bucket to earn them back."""
+
+        with self.lock:
+            now = time.monotonic()
+
+            if self.rate_time is None or now - self.rate_time >= TokenBucket.SCHEDULE_TIME:
+                self.rate = (self.override or self.limit).get_rate()
+                self.rate_time = now
+
+            if not self.rate:
+                self.tokens = 0
+                self.update_time = now
+                return
+
+            self.tokens = min(self.rate, self.tokens + (now - self.update_time) * self.rate)
+            self.update_time = now
+
+            self.tokens -= size
+
+            delay = max(0, -self.tokens / self.rate)
+
+        if delay:
+            time.sleep(delay)
+
+class ShapedReader:
+
+    """Wraps the file object `handle`, so reading from it takes its bytes
+from `bucket` (a `TokenBucket`). Passed as a request body, `requests`
+streams it in blocks, with a `Content-Length` header."""
+
+    def __init__(self, handle, bucket):
+        self.handle = handle
+        self.bucket = bucket
+
+    def __len__(self):
+        return os.fstat(self.handle.fileno()).st_size - self.handle.tell()
+
+    def __iter__(self):
+        while True:
+            data = self.read(64 * 1024)
+
+            if not data:
+                return
+
+            yield data
+
+    def read(self, size=-1):
+        """Reads up to `size` bytes."""
+
+        data = self.handle.read(size)
+
+        self.bucket.consume(len(data))
+
+        return data
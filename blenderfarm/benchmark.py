@@ -0,0 +1,108 @@
+"""Node calibration benchmarks. A benchmark performs a standardized
+micro-render; its score tells the server how fast this node is compared
+to a reference machine."""
+
+import os
+import subprocess
+import tempfile
+import time
+
+from . import error
+
+class Benchmark:
+
+    """A standardized micro-render. Subclasses override `run()`."""
+
+    # Seconds a single run takes on the reference machine; a node that
+    # needs exactly this long scores `1.0`.
+    reference_time = 1.0
+
+    def run(self):
+        """Performs the micro-render once."""
+
+        pass
+
+    def measure(self):
+        """Performs the micro-render once and returns the number of
+fractional seconds it took."""
+
+        start_time = time.monotonic()
+
+        self.run()
+
+        return time.monotonic() - start_time
+
+    def calibrate(self, runs=3):
+        """Runs the benchmark `runs` times and returns the score; higher is
+faster. The median run is used, so a single hiccup doesn't skew it."""
+
+        times = sorted(self.measure() for _ in range(max(1, runs)))
+
+        return self.reference_time / max(times[len(times) // 2], 1e-6)
+
+
+class StubBenchmark(Benchmark):
+
+    """A pure-Python stand-in for a render, for machines (and tests)
+without Blender. Renders a small Mandelbrot set."""
+
+    reference_time = 1.0
+
+    def __init__(self, size=128, iterations=256):
+        self.size = size
+        self.iterations = iterations
+
+    def run(self):
+        pixels = 0
+
+        for pixel_y in range(self.size):
+            for pixel_x in range(self.size):
+                point = complex(pixel_x / self.size * 3 - 2, pixel_y / self.size * 3 - 1.5)
+                value = 0j
+
+                for _ in range(self.iterations):
+                    value = value * value + point
+
+                    if abs(value) > 2:
+                        break
+                else:
+                    pixels += 1
+
+        return pixels
+
+
+class BlenderBenchmark(Benchmark):
+
+    """Renders a single frame of `filename` at a reduced resolution with
+the Blender executable `blender_path`."""
+
+    reference_time = 30.0
+
+    def __init__(self, blender_path='blender', filename=None, frame=1, resolution_percentage=25):
+        self.blender_path = blender_path
+
+        if not filename:
+            filename = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                    'test', 'animation.blend')
+
+        self.filename = filename
+        self.frame = frame
+        self.resolution_percentage = resolution_percentage
+
+    def run(self):
+        if not os.path.isfile(self.filename):
+            raise error.Error('missing-file', 'Benchmark file does not exist', self.filename)
+
+        with tempfile.TemporaryDirectory() as directory:
+            command = [
+                self.blender_path, '-b', self.filename,
+                '--python-expr',
+                'import bpy; bpy.context.scene.render.resolution_percentage = ' + str(self.resolution_percentage),
+                '-o', os.path.join(directory, 'frame_####'),
+                '-f', str(self.frame)
+            ]
+
+            try:
+                subprocess.check_call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except (OSError, subprocess.CalledProcessError):
+                raise error.Error('render-error', 'Could not run the Blender benchmark', self.blender_path)
@@ -0,0 +1,295 @@
+"""Job file blob store. The server keeps job files as content-defined
+chunks, stored once by hash no matter how many files (or revisions of
+a file) contain them, plus a manifest per file listing its chunks.
+Uploading a revised `.blend` only sends the chunks the server lacks.
+
+Chunk boundaries depend only on the bytes around them, so an edit only
+changes the chunks it touches: every byte is mapped to a single bit
+through `CHUNK_TABLE`, and a chunk ends wherever the bits of the last
+`len(CHUNK_PATTERN)` bytes spell out `CHUNK_PATTERN` (but never before
+`MIN_CHUNK_SIZE` or after `MAX_CHUNK_SIZE` bytes). Both the mapping and
+the search run at C speed (`bytes.translate()` and `bytes.find()`)."""
+
+import hashlib
+import json
+import os
+import re
+import threading
+
+from . import error
+
+# Maps every byte value to `0` or `1`.
+CHUNK_TABLE = bytes(hashlib.sha256(bytes([value])).digest()[0] & 1 for value in range(256))
+
+# One in `2 ** len(CHUNK_PATTERN)` positions in random data ends a
+# chunk, so chunks average about `MIN_CHUNK_SIZE + 256 KiB`.
+CHUNK_PATTERN = bytes(int(bit) for bit in '100110101101000111')
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+# Files are read and chunked this many bytes at a time.
+READ_SIZE = 16 * 1024 * 1024
+
+HASH_PATTERN = re.compile('^[0-9a-f]{64}$')
+
+def get_hash(data):
+    """Returns the SHA-256 hex digest of `data`."""
+
+    return hashlib.sha256(data).hexdigest()
+
+def is_valid_hash(value):
+    """Returns `True` if `value` looks like a SHA-256 hex digest."""
+
+    return bool(value and HASH_PATTERN.match(value))
+
+def get_temporary_filename(filename):
+    """Returns a name to write `filename` under before moving it into
+place; unique to the calling thread, so concurrent writers of the same
+file don't trip over each other."""
+
+    return filename + '.' + str(os.getpid()) + '-' + str(threading.get_ident()) + '.tmp'
+
+def split_chunks(handle):
+    """Reads the file object `handle` to the end and yields its contents
+as content-defined chunks (see above)."""
+
+    buffer = b''
+    position = 0
+
+    eof = False
+
+    while True:
+        if not eof and len(buffer) - position < MAX_CHUNK_SIZE:
+            data = handle.read(READ_SIZE)
+
+            if data:
+                buffer = buffer[position:] + data
+                position = 0
+                continue
+
+            eof = True
+
+        if position >= len(buffer):
+            return
+
+        window = buffer[position:position + MAX_CHUNK_SIZE]
+
+        index = window.translate(CHUNK_TABLE).find(CHUNK_PATTERN, MIN_CHUNK_SIZE - len(CHUNK_PATTERN))
+
+        if index < 0:
+            end = len(window)
+        else:
+            end = index + len(CHUNK_PATTERN)
+
+        yield window[:end]
+
+        position += end
+
+def get_file_manifest(filename, chunk_function=None):
+    """Chunks the local file `filename` and returns its manifest: a
+dictionary with the file's `hash`, its `size` and the list of its
+`chunks` as `[hash, size]` pairs. If `chunk_function` is present, it's
+called with the hash and contents of every chunk."""
+
+    file_hasher = hashlib.sha256()
+
+    chunks = []
+    size = 0
+
+    with open(filename, 'rb') as handle:
+        for chunk in split_chunks(handle):
+            chunk_hash = get_hash(chunk)
+
+            if chunk_function:
+                chunk_function(chunk_hash, chunk)
+
+            file_hasher.update(chunk)
+
+            chunks.append([chunk_hash, len(chunk)])
+            size += len(chunk)
+
+    return {
+        'hash': file_hasher.hexdigest(),
+        'size': size,
+        'chunks': chunks
+    }
+
+# # `BlobStore`
+
+class BlobStore:
+
+    """Stores chunks in `<directory>/chunks/` and file manifests in
+`<directory>/files/`, all named by their hashes. Chunks are written to
+a temporary file first, so a crash never leaves a partial chunk
+behind; uploads interrupted between chunks simply resume by asking for
+the missing ones again."""
+
+    def __init__(self, directory='blobs'):
+        self.directory = directory
+
+    def get_chunk_filename(self, chunk_hash):
+        """Returns the path the chunk `chunk_hash` is stored at."""
+
+        return os.path.join(self.directory, 'chunks', chunk_hash[:2], chunk_hash)
+
+    def get_manifest_filename(self, file_hash):
+        """Returns the path the manifest of file `file_hash` is stored at."""
+
+        return os.path.join(self.directory, 'files', file_hash + '.json')
+
+    # ## Chunks
+
+    def has_chunk(self, chunk_hash):
+        """Returns `True` if we hold the chunk `chunk_hash`."""
+
+        return is_valid_hash(chunk_hash) and os.path.isfile(self.get_chunk_filename(chunk_hash))
+
+    def get_missing_chunks(self, chunk_hashes):
+        """Returns the hashes in `chunk_hashes` we don't hold, in order and
+without duplicates."""
+
+        missing = []
+        seen = set()
+
+        for chunk_hash in chunk_hashes:
+            if chunk_hash in seen:
+                continue
+
+            seen.add(chunk_hash)
+
+            if not self.has_chunk(chunk_hash):
+                missing.append(chunk_hash)
+
+        return missing
+
+    def put_chunk(self, chunk_hash, data):
+        """Stores the chunk `data`, which must hash to `chunk_hash`. Raises
+`error.Error('invalid-chunk')` if it doesn't."""
+
+        if not is_valid_hash(chunk_hash) or get_hash(data) != chunk_hash:
+            raise error.Error('invalid-chunk', 'Chunk does not match its hash', chunk_hash)
+
+        self.write_chunk(chunk_hash, data)
+
+    def write_chunk(self, chunk_hash, data):
+        """Stores the chunk `data` as `chunk_hash` without checking it,
+unless we already hold it."""
+
+        if self.has_chunk(chunk_hash):
+            return
+
+        filename = self.get_chunk_filename(chunk_hash)
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        temporary_filename = get_temporary_filename(filename)
+
+        with open(temporary_filename, 'wb') as handle:
+            handle.write(data)
+
+        os.replace(temporary_filename, filename)
+
+    def read_chunk(self, chunk_hash):
+        """Returns the contents of the chunk `chunk_hash`."""
+
+        with open(self.get_chunk_filename(chunk_hash), 'rb') as handle:
+            return handle.read()
+
+    # ## Files
+
+    def commit(self, chunk_hashes):
+        """Records the file made of the chunks `chunk_hashes`, in order
+(every one of which we must hold), and returns its manifest (see
+`get_file_manifest()`). Raises `error.Error('missing-chunks')` if we
+lack any of the chunks."""
+
+        missing = self.get_missing_chunks(chunk_hashes)
+
+        if missing:
+            raise error.Error('missing-chunks', 'Missing ' + str(len(missing)) + ' chunk(s)', ','.join(missing))
+
+        file_hasher = hashlib.sha256()
+
+        chunks = []
+        size = 0
+
+        for chunk_hash in chunk_hashes:
+            data = self.read_chunk(chunk_hash)
+
+            file_hasher.update(data)
+
+            chunks.append([chunk_hash, len(data)])
+            size += len(data)
+
+        manifest = {
+            'hash': file_hasher.hexdigest(),
+            'size': size,
+            'chunks': chunks
+        }
+
+        self.save_manifest(manifest)
+
+        return manifest
+
+    def save_manifest(self, manifest):
+        """Writes the file `manifest` to disk."""
+
+        filename = self.get_manifest_filename(manifest['hash'])
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        temporary_filename = get_temporary_filename(filename)
+
+        with open(temporary_filename, 'w') as handle:
+            json.dump(manifest, handle)
+
+        os.replace(temporary_filename, filename)
+
+    def get_manifest(self, file_hash):
+        """Returns the manifest of the file `file_hash`, or `None` if we
+don't hold it."""
+
+        if not is_valid_hash(file_hash):
+            return None
+
+        try:
+            with open(self.get_manifest_filename(file_hash), 'r') as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+    def has_file(self, file_hash):
+        """Returns `True` if we hold the file `file_hash`."""
+
+        return is_valid_hash(file_hash) and os.path.isfile(self.get_manifest_filename(file_hash))
+
+    def read_file(self, manifest, start=0, end=None):
+        """Yields bytes `start` to `end`-1 (or to the end) of the file
+described by `manifest`, a chunk at a time."""
+
+        if end is None:
+            end = manifest['size']
+
+        offset = 0
+
+        for chunk_hash, chunk_size in manifest['chunks']:
+            if offset + chunk_size > start and offset < end:
+                data = self.read_chunk(chunk_hash)
+
+                yield data[max(0, start - offset):end - offset]
+
+            offset += chunk_size
+
+            if offset >= end:
+                break
+
+    def ingest(self, filename):
+        """Stores the local file `filename`, skipping chunks we already
+hold, and returns its manifest."""
+
+        manifest = get_file_manifest(filename, self.write_chunk)
+
+        self.save_manifest(manifest)
+
+        return manifest
@@ -0,0 +1,97 @@
+"""Bloom filters, used by render nodes to tell the server which job
+files they already hold without sending the whole list."""
+
+import base64
+import hashlib
+import math
+
+class BloomFilter:
+
+    """A fixed-size Bloom filter of strings. Membership tests may return
+false positives (at roughly `error_rate`), but never false negatives."""
+
+    # Limits on filters restored by `decode()`, which come from nodes:
+    # the number of hash functions (a 1% error rate needs 7), and the
+    # size in bytes (enough for about 50,000 items at 1%).
+    MAX_HASHES = 32
+    MAX_SIZE = 64 * 1024
+
+    def __init__(self, capacity=64, error_rate=0.01):
+        # Number of bits, rounded up to a whole number of bytes.
+        bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.size = max(64, int(math.ceil(bits / 8)) * 8)
+
+        # Number of hash functions.
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+
+        self.bits = bytearray(self.size // 8)
+
+    def get_positions(self, item):
+        """Returns the bit positions for `item`. Positions are derived from
+a single SHA-1 digest by double hashing."""
+
+        digest = hashlib.sha1(bytes(item, 'utf8')).digest()
+
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:16], 'little') | 1
+
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        """Adds the string `item` to the filter."""
+
+        for position in self.get_positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        for position in self.get_positions(item):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+
+        return True
+
+    def encode(self):
+        """Returns a compact string representation of this filter, safe to
+use as a URL parameter value. Inverse of `decode()`."""
+
+        return str(self.hashes) + ':' + str(base64.urlsafe_b64encode(bytes(self.bits)), 'ascii')
+
+    def decode(self, string):
+        """Restores the filter from the string returned by `encode()`.
+Returns `self`; raises `ValueError` if `string` is malformed, or uses
+more than `MAX_HASHES` hash functions or `MAX_SIZE` bytes."""
+
+        hashes, data = string.split(':', 1)
+
+        # Base64 takes four characters per three bytes.
+        if len(data) > (BloomFilter.MAX_SIZE + 2) // 3 * 4:
+            raise ValueError('Bloom filter is too large')
+
+        hashes = int(hashes)
+
+        if not 1 <= hashes <= BloomFilter.MAX_HASHES:
+            raise ValueError('invalid Bloom filter hash count ' + str(hashes))
+
+        bits = bytearray(base64.urlsafe_b64decode(bytes(data, 'ascii')))
+
+        if not bits:
+            raise ValueError('empty Bloom filter')
+
+        self.hashes = hashes
+        self.bits = bits
+        self.size = len(bits) * 8
+
+        return self
+
+    @staticmethod
+    def from_items(items, error_rate=0.01):
+        """Returns a new filter sized for, and containing, every string in `items`."""
+
+        items = list(items)
+
+        bloom_filter = BloomFilter(max(len(items), 16), error_rate)
+
+        for item in items:
+            bloom_filter.add(item)
+
+        return bloom_filter
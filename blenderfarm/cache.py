@@ -0,0 +1,227 @@
+"""Render node job file cache. Job files are stored by key (see
+`job.Job.get_file_key()`), which is the file's content hash whenever
+the server knows it; jobs sharing a file share a single cached copy,
+and a cached file is never stale. The cache is limited in size, and
+the least recently used files are evicted to make room."""
+
+import collections
+import json
+import os
+import threading
+
+class FileCache:
+
+    """A cache of job files in `directory`, holding at most `max_size`
+bytes (`0` for no limit). Files are stored as `<key>.blend`; files in
+use can be pinned so they're never evicted. Recency is kept in the
+files' modification times, so it survives restarts."""
+
+    EXTENSION = '.blend'
+
+    # Chunk manifests of cached files from the server's blob store (see
+    # `blob.py`) are kept next to them, with this extension.
+    MANIFEST_EXTENSION = '.chunks.json'
+
+    def __init__(self, directory='cache', max_size=0):
+        self.directory = directory
+        self.max_size = max_size
+
+        # Maps keys to file sizes, least recently used first.
+        self.files = collections.OrderedDict()
+
+        # Maps keys of pinned files to their pin count.
+        self.pins = collections.Counter()
+
+        self.lock = threading.Lock()
+
+        self.scan()
+
+    def scan(self):
+        """Rebuilds the index from the files in our directory."""
+
+        files = []
+
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if not name.endswith(FileCache.EXTENSION):
+                    continue
+
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+
+                files.append((stat.st_mtime, name[:-len(FileCache.EXTENSION)], stat.st_size))
+
+        with self.lock:
+            self.files = collections.OrderedDict((key, size) for _, key, size in sorted(files))
+
+    def get_filename(self, key):
+        """Returns the path the file with `key` is (or would be) cached at."""
+
+        return os.path.join(self.directory, key + FileCache.EXTENSION)
+
+    def get_manifest_filename(self, key):
+        """Returns the path the chunk manifest of the file with `key` is
+(or would be) stored at."""
+
+        return os.path.join(self.directory, key + FileCache.MANIFEST_EXTENSION)
+
+    def save_manifest(self, key, manifest):
+        """Stores the chunk `manifest` of the cached file with `key`."""
+
+        filename = self.get_manifest_filename(key)
+
+        with open(filename + '.tmp', 'w') as handle:
+            json.dump(manifest, handle)
+
+        os.replace(filename + '.tmp', filename)
+
+    def get_manifest(self, key):
+        """Returns the chunk manifest of the cached file with `key`, or
+`None` if it has none."""
+
+        try:
+            with open(self.get_manifest_filename(key), 'r') as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+    def get_chunk_index(self):
+        """Returns a dictionary mapping the hash of every chunk of every
+cached file with a manifest to `(key, offset, size)`: where to find it
+in our cache."""
+
+        index = {}
+
+        for key in self.get_keys():
+            manifest = self.get_manifest(key)
+
+            if not manifest:
+                continue
+
+            offset = 0
+
+            for chunk_hash, chunk_size in manifest['chunks']:
+                index.setdefault(chunk_hash, (key, offset, chunk_size))
+
+                offset += chunk_size
+
+        return index
+
+    def get_keys(self):
+        """Returns the keys of every cached file."""
+
+        with self.lock:
+            return list(self.files)
+
+    def get_size(self):
+        """Returns the total size of every cached file, in bytes."""
+
+        with self.lock:
+            return sum(self.files.values())
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.files
+
+    def get(self, key, pin=False):
+        """Returns the filename of the cached file with `key`, marking it as
+recently used (and pinning it if `pin` is `True`), or `None` if it's
+not cached."""
+
+        with self.lock:
+            if key not in self.files:
+                return None
+
+            filename = self.get_filename(key)
+
+            if not os.path.isfile(filename):
+                del self.files[key]
+                return None
+
+            self.files.move_to_end(key)
+
+            if pin:
+                self.pins[key] += 1
+
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+
+        return filename
+
+    def add(self, key, filename, pin=False):
+        """Moves the complete, verified file `filename` into the cache as
+`key` (pinning it if `pin` is `True`), evicting other files if we're
+over our size limit. Returns the new filename."""
+
+        cached_filename = self.get_filename(key)
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        os.replace(filename, cached_filename)
+
+        with self.lock:
+            self.files[key] = os.path.getsize(cached_filename)
+            self.files.move_to_end(key)
+
+            if pin:
+                self.pins[key] += 1
+
+        self.evict(keep=key)
+
+        return cached_filename
+
+    def pin(self, key):
+        """Prevents the file with `key` from being evicted until `unpin()`
+is called as many times as `pin()`."""
+
+        with self.lock:
+            self.pins[key] += 1
+
+    def unpin(self, key):
+        """Undoes one `pin()` of the file with `key`."""
+
+        with self.lock:
+            self.pins[key] -= 1
+
+            if self.pins[key] <= 0:
+                del self.pins[key]
+
+    def evict(self, needed=0, keep=None):
+        """Removes the least recently used unpinned files (other than the
+file with `keep`) until the cache, plus `needed` more bytes, fits in
+`max_size`. Returns the number of bytes freed."""
+
+        if not self.max_size:
+            return 0
+
+        removed = []
+
+        with self.lock:
+            size = sum(self.files.values()) + needed
+
+            for key in list(self.files):
+                if size <= self.max_size:
+                    break
+
+                if self.pins[key] > 0 or key == keep:
+                    continue
+
+                size -= self.files[key]
+                removed.append((key, self.files.pop(key)))
+
+        freed = 0
+
+        for key, file_size in removed:
+            for filename in (self.get_filename(key), self.get_manifest_filename(key)):
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+
+            freed += file_size
+
+        return freed
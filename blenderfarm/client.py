@@ -1,9 +1,46 @@
 
 """Blenderfarm client."""
 
+import hashlib
 import os
+import re
+import shutil
+import socket
+import subprocess
 
 from . import api
+from . import bloom
+from . import cache
+from . import db
+from . import error
+from . import peer
+from . import render
+
+# # `NodeConfig`
+
+class NodeConfig(db.DB):
+    """Render node state that survives restarts: the `node_id` the server
+assigned to us and our calibration score (see `benchmark.py`)."""
+
+    def __init__(self):
+        super().__init__('node.json')
+
+        self.node_id = None
+        self.calibration = 0
+
+        # If we don't have any saved data, save the DB.
+        if not self.restore():
+            self.save()
+
+    def _save(self):
+        return {
+            'node_id': self.node_id,
+            'calibration': self.calibration
+        }
+
+    def _restore(self, data):
+        self.node_id = data.get('node_id')
+        self.calibration = data.get('calibration', 0)
 
 # # `Client`
 
@@ -14,6 +51,14 @@ rendering the actual frames, and reporting progress back to the
 server. It may optionally implement `Node`."""
 
     ## pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    # When sharing job files with peers: how long to wait for a chunk our
+    # parent is still downloading, in seconds; how many parents to try
+    # before falling back to the server; and the most we download from
+    # the server in one range, so our own children aren't kept waiting.
+    PEER_WAIT = 30
+    PEER_ATTEMPTS = 3
+    PEER_RUN_SIZE = 8 * 1024 * 1024
     
     def __init__(self, host='localhost', port=44363, username='anon', key='1234', insecure=False, is_node=False):
 
@@ -26,6 +71,9 @@ server. It may optionally implement `Node`."""
         # If `True`, use `http` instead of `https`.
         self.insecure = insecure
 
+        self.api.set_host_port(host, port)
+        self.api.set_insecure(insecure)
+
         # Credentials.
         self.username = username
         self.key = key
@@ -36,6 +84,53 @@ server. It may optionally implement `Node`."""
         # The task we are currently performing. Only applicable if `is_node` is True.
         self.task = None
 
+        # Our `node_id`, assigned by the server when we register. Only
+        # applicable if `is_node` is True.
+        self.node_id = None
+
+        # Persistent node state; `None` unless `is_node` is True.
+        self.config = None
+
+        if is_node:
+            self.config = NodeConfig()
+            self.node_id = self.config.node_id
+
+        # The Blender executable used to render.
+        self.blender_path = 'blender'
+
+        # Job files are downloaded into this directory, which holds
+        # at most `cache_size` bytes (`0` for no limit); see `cache.py`.
+        self.cache_directory = 'cache'
+        self.cache_size = 0
+
+        # The `cache.FileCache` of job files; created on first use by
+        # `get_cache()`.
+        self.cache = None
+
+        # Large job files are downloaded in up to this many parallel
+        # segments.
+        self.download_segments = 4
+
+        # If not `0`, job files are shared with other nodes on this port
+        # (see `peer.py`) by `peer_server`, once it's started.
+        self.peer_port = 0
+        self.peer_server = None
+
+        # Rendered frames are written into this directory, then moved
+        # into the outbox directory until they're uploaded.
+        self.result_directory = 'render'
+        self.outbox_directory = 'outbox'
+
+        # The `render.RenderExecutor` driving Blender; created on first
+        # use by `get_executor()`.
+        self.executor = None
+
+        # Memory (in bytes) the tasks we hold but haven't started
+        # rendering yet will need; it's subtracted from the free memory
+        # we report, so the server doesn't hand it out twice. Kept up to
+        # date by `runner.NodeRunner`.
+        self.reserved_memory = 0
+
     # State utility functions.
 
     def is_connected(self):
@@ -82,9 +177,113 @@ if `host` and `port` have been set, `False` otherwise."""
         return self.api.get_server_info(key)
 
     def connect(self, user, key):
-        """Attempts to connect to the server. Does not catch any exceptions."""
+        """Attempts to connect to the server, and registers this machine as
+a render node if `is_node` is True. Does not catch any exceptions."""
+
+        self.api.connect(user, key)
+
+        if self.is_node:
+            self.register_node()
+
+    def register_node(self):
+        """Reports our capabilities to the server and remembers the
+`node_id` it assigns to us."""
+
+        render_node = self.api.request_node_register(self.get_capabilities(), self.node_id)
+
+        self.node_id = render_node.node_id
+
+        if self.config:
+            self.config.node_id = self.node_id
+            self.config.save()
+
+        return render_node
+
+    # ## Capabilities
+
+    def set_bandwidth_limits(self, download_limit='', upload_limit=''):
+        """Limits our downloads and uploads (see `bandwidth.py`), unless the
+server imposes limits of its own. Raises `ValueError` if either limit
+is malformed."""
+
+        self.api.set_bandwidth_limits(download_limit, upload_limit)
+
+    def get_blender_version(self):
+        """Returns the version of the Blender executable at `blender_path`
+(such as `"2.79"`), or an empty string if it can't be run."""
+
+        try:
+            output = subprocess.check_output([self.blender_path, '--version'], stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            return ''
+
+        match = re.search(r'Blender\s+([0-9][0-9.]*)', str(output, 'utf8', 'replace'))
+
+        if not match:
+            return ''
+
+        return match.group(1)
+
+    def get_disk_free(self):
+        """Returns the disk space available for job files, in bytes: the
+free space in our cache directory plus what evicting cached files
+would free, limited by `cache_size`."""
+
+        path = self.cache_directory
+
+        if not os.path.isdir(path):
+            path = '.'
+
+        disk_free = shutil.disk_usage(path).free + self.get_cache().get_size()
+
+        if self.cache_size:
+            disk_free = min(disk_free, self.cache_size)
+
+        return disk_free
 
-        return self.api.connect(user, key)
+    @staticmethod
+    def get_memory():
+        """Returns the total memory of this machine, in bytes (or `0` if it
+can't be determined on this platform)."""
+
+        try:
+            return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        except (AttributeError, ValueError, OSError):
+            return 0
+
+    @staticmethod
+    def get_memory_free():
+        """Returns the memory available for new tasks on this machine, in
+bytes (or `0` if it can't be determined on this platform)."""
+
+        try:
+            with open('/proc/meminfo', 'r') as handle:
+                for line in handle:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+
+        try:
+            return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+        except (AttributeError, ValueError, OSError):
+            return 0
+
+    def get_capabilities(self):
+        """Returns a dictionary of the capabilities we report to the server."""
+
+        capabilities = {
+            'hostname': socket.gethostname(),
+            'cores': os.cpu_count() or 1,
+            'memory': self.get_memory(),
+            'disk_free': self.get_disk_free(),
+            'blender_version': self.get_blender_version()
+        }
+
+        if self.config and self.config.calibration:
+            capabilities['calibration'] = self.config.calibration
+
+        return capabilities
 
     def disconnect(self):
         """Disconnects from the server."""
@@ -98,18 +297,381 @@ if `host` and `port` have been set, `False` otherwise."""
 
         pass
 
+    def get_task_capabilities(self):
+        """Returns the capabilities that change from task to task, sent
+along with every task request. `memory_free` doesn't include the
+memory reserved for tasks we're about to render (see
+`reserved_memory`)."""
+
+        if not self.node_id:
+            return None
+
+        capabilities = {
+            'disk_free': self.get_disk_free()
+        }
+
+        memory_free = self.get_memory_free()
+
+        if memory_free:
+            capabilities['memory_free'] = max(0, memory_free - self.reserved_memory)
+
+        cached_keys = self.get_cached_job_keys()
+
+        if cached_keys:
+            capabilities['cache'] = bloom.BloomFilter.from_items(cached_keys).encode()
+
+        return capabilities
+
     def request_next_task(self):
         """Requests the next task from the server, and if it exists, performs it."""
 
-        return self.api.request_next_task()
+        return self.api.request_next_task(self.node_id, self.get_task_capabilities())
+
+    def request_next_tasks(self, count, wait=0):
+        """Requests up to `count` tasks to run at once. The server only
+hands out as many as it expects to fit in our free memory. If there's
+nothing to do, the server waits up to `wait` seconds for work."""
+
+        return self.api.request_next_tasks(self.node_id, self.get_task_capabilities(), count, wait)
     
-    def download_job_file(self, job, filename):
-        """Downloads the job work file from whatever server it's hosted at."""
+    def request_events(self, slots, held_task_ids=()):
+        """Opens our event stream; see `api.v1.Client.request_events()`."""
+
+        return self.api.request_events(self.node_id, slots, self.get_task_capabilities(), held_task_ids)
+
+    def request_ack(self, event_id, held_task_ids=None, slots=None):
+        """Acknowledges the event `event_id`, updating our capabilities;
+see `api.v1.Client.request_ack()`."""
+
+        return self.api.request_ack(self.node_id, event_id, held_task_ids, slots, self.get_task_capabilities())
+
+    def request_heartbeat(self, task_ids):
+        """Renews our leases on the tasks `task_ids`; returns the IDs of
+tasks we no longer hold."""
+
+        return self.api.request_heartbeat(self.node_id, task_ids)
+
+    def get_lease_time(self):
+        """Returns the number of seconds the server leases tasks to us for."""
+
+        return self.api.lease_time
+
+    # ## Job file cache
+
+    def get_cache(self):
+        """Returns our `cache.FileCache`, creating it if necessary."""
+
+        if not self.cache:
+            self.cache = cache.FileCache(self.cache_directory, self.cache_size)
+
+        return self.cache
+
+    def get_job_filename(self, job):
+        """Returns the path `job`'s work file is cached at."""
+
+        return self.get_cache().get_filename(job.get_file_key())
+
+    def get_cached_job_keys(self):
+        """Returns a list of the file keys (see `job.Job.get_file_key()`) of
+every job file in our cache."""
+
+        return self.get_cache().get_keys()
+
+    def download_job_file(self, job, filename=None, pin=False):
+        """Downloads the job work file from whatever server it's hosted at,
+unless it's cached already. If the job's file hash is known, the
+download is verified against it. If `filename` is omitted, the file is
+stored in our cache (and pinned there if `pin` is `True`; see
+`cache.FileCache.pin()`). Returns the filename."""
+
+        file_cache = self.get_cache()
+        key = job.get_file_key()
+
+        if not filename:
+            cached_filename = file_cache.get(key, pin)
+
+            if cached_filename:
+                return cached_filename
+
+            partial_filename = os.path.join(file_cache.directory, key + '.part')
+        else:
+            if os.path.isfile(filename):
+                return filename
+
+            partial_filename = filename + '.part'
+
+        if os.path.dirname(partial_filename):
+            os.makedirs(os.path.dirname(partial_filename), exist_ok=True)
+
+        if not filename:
+            file_cache.evict(job.job_info.file_size)
+
+        file_hash = job.job_info.get_file_hash()
+        hasher = hashlib.sha256()
+
+        manifest = None
+
+        # Files in the server's blob store are assembled from chunks we
+        # or our peers already hold where possible.
+        if not filename and file_hash and not job.job_info.file_url:
+            manifest = self.api.request_file_manifest(file_hash)
+
+        try:
+            # Download next to the final file, so an interrupted download
+            # is never mistaken for a cached one, and can be resumed later.
+            if not manifest or not self.sync_job_file(job, manifest, partial_filename, hasher):
+                self.api.download_job_file(job, partial_filename, hasher, self.download_segments)
+
+            if file_hash and hasher.hexdigest() != file_hash.lower():
+                os.remove(partial_filename)
+                raise error.Error('corrupt-file', 'Downloaded job file does not match its hash',
+                                  job.job_info.file_url)
+        except error.Error:
+            if manifest and self.peer_server:
+                self.peer_server.finish_download(manifest)
+                self.announce_peer(file_hash, 'gone')
+
+            raise
+
+        if not filename:
+            if manifest:
+                file_cache.save_manifest(key, manifest)
+
+            filename = file_cache.add(key, partial_filename, pin)
+
+            if manifest and self.peer_server:
+                self.peer_server.finish_download(manifest)
+                self.announce_peer(file_hash, 'complete')
 
-        if os.path.isfile(filename):
             return filename
 
-        return self.api.download_job_file(job, filename)
-    
-    def upload_render_result(self, task, filename, elapsed=0):
-        return self.api.upload_render_result(task, filename, elapsed)
+        os.replace(partial_filename, filename)
+
+        return filename
+
+    def sync_job_file(self, job, manifest, filename, hasher):
+        """Assembles the work file of `job` into `filename` from its chunk
+`manifest`, copying every chunk some cached file already holds (such
+as the previous revision of the same `.blend`). If we run a peer
+server, the rest comes from the peer the tracker assigns us, and every
+chunk is served to our own peers as soon as it's written; whatever's
+left is downloaded from the server, in as few ranges as possible.
+`hasher` is updated with the whole file. Returns `False`, without
+doing anything, if none of the chunks are cached and we don't run a
+peer server."""
+
+        # pylint: disable=too-many-locals,too-many-statements
+
+        file_cache = self.get_cache()
+
+        index = file_cache.get_chunk_index()
+
+        source_keys = {index[chunk_hash][0] for chunk_hash, _ in manifest['chunks'] if chunk_hash in index}
+
+        if not source_keys and not self.peer_server:
+            return False
+
+        url = self.api.get_job_file_url(job)
+
+        parent = None
+
+        if self.peer_server:
+            self.peer_server.start_download(manifest)
+
+            parent = self.announce_peer(manifest['hash'], 'downloading')
+
+        sources = {}
+
+        # Make sure the files we copy from aren't evicted halfway.
+        for source_key in source_keys:
+            file_cache.pin(source_key)
+
+        # Chunks we lack, waiting to be downloaded from the server in a
+        # single range, as `(hash, offset, size)`.
+        missing = []
+
+        downloaded = 0
+
+        def written(chunk_hash, offset, size):
+            if self.peer_server:
+                handle.flush()
+                self.peer_server.add_chunk(chunk_hash, filename, offset, size)
+
+        def download_missing():
+            nonlocal downloaded
+
+            if not missing:
+                return
+
+            start = missing[0][1]
+            end = missing[-1][1] + missing[-1][2]
+
+            self.api.copy_range(url, start, end, handle, hasher)
+
+            for chunk_hash, offset, size in missing:
+                written(chunk_hash, offset, size)
+
+            downloaded += end - start
+            missing.clear()
+
+        try:
+            for source_key in source_keys:
+                sources[source_key] = open(file_cache.get_filename(source_key), 'rb')
+
+            with open(filename, 'wb') as handle:
+                offset = 0
+
+                for chunk_hash, chunk_size in manifest['chunks']:
+                    data = None
+
+                    if chunk_hash in index:
+                        source_key, source_offset, _ = index[chunk_hash]
+
+                        sources[source_key].seek(source_offset)
+
+                        data = sources[source_key].read(chunk_size)
+                    else:
+                        # Ask our parent, and another one if it lets us down.
+                        for _ in range(Client.PEER_ATTEMPTS):
+                            if not parent:
+                                break
+
+                            data = self.api.request_peer_chunk(parent, chunk_hash, Client.PEER_WAIT)
+
+                            if data is not None:
+                                break
+
+                            parent = self.announce_peer(manifest['hash'], 'downloading', parent['node_id'])
+
+                    if data is None:
+                        missing.append((chunk_hash, offset, chunk_size))
+
+                        # Keep our own peers fed while the server sends us
+                        # a long run.
+                        if self.peer_server and offset + chunk_size - missing[0][1] >= Client.PEER_RUN_SIZE:
+                            download_missing()
+                    else:
+                        download_missing()
+
+                        handle.write(data)
+                        hasher.update(data)
+
+                        written(chunk_hash, offset, chunk_size)
+
+                    offset += chunk_size
+
+                download_missing()
+        except OSError:
+            raise error.Error('corrupt-file', 'Could not assemble job file from cached chunks', filename)
+        finally:
+            for source in sources.values():
+                source.close()
+
+            for source_key in source_keys:
+                file_cache.unpin(source_key)
+
+        print('synced job file ' + manifest['hash'] + ': downloaded ' + str(downloaded) + ' of ' +
+              str(manifest['size']) + ' bytes from the server')
+
+        return True
+
+    # ## Peers
+
+    def start_peer_server(self):
+        """Starts serving our cached job files to other nodes on
+`peer_port`, and tells the tracker which files we hold."""
+
+        self.peer_server = peer.PeerServer(self.get_cache(), self.peer_port)
+        self.peer_server.bucket = self.api.upload_bucket
+        self.peer_server.start()
+
+        for key in self.get_cached_job_keys():
+            if self.get_cache().get_manifest(key):
+                self.announce_peer(key, 'complete')
+
+    def stop_peer_server(self):
+        """Stops serving job files to other nodes."""
+
+        if self.peer_server:
+            self.peer_server.stop()
+            self.peer_server = None
+
+    def announce_peer(self, file_hash, status, failed_id=None):
+        """Tells the tracker about the file `file_hash` (see
+`api.v1.Client.request_peer_announce()`); returns the peer to download
+it from, or `None` for the server (or if the tracker can't be
+reached)."""
+
+        try:
+            return self.api.request_peer_announce(self.node_id, file_hash, self.peer_server.port, status,
+                                                  failed_id)
+        except error.Error as exception:
+            print('could not reach the tracker: ' + str(exception))
+            return None
+
+    def release_job_file(self, job):
+        """Unpins `job`'s work file in our cache after a `pin`ned
+`download_job_file()`."""
+
+        self.get_cache().unpin(job.get_file_key())
+
+    def upload_job_file(self, filename):
+        """Uploads the local file `filename` into the server's blob store;
+see `api.v1.Client.upload_job_file()`. Returns the file's manifest."""
+
+        return self.api.upload_job_file(filename)
+
+    # ## Rendering
+
+    def get_executor(self):
+        """Returns our `render.RenderExecutor`, creating it if necessary."""
+
+        if not self.executor:
+            self.executor = render.RenderExecutor(self.blender_path)
+
+        return self.executor
+
+    def get_result_filename(self, task):
+        """Returns the path the rendered result of `task` is written to."""
+
+        return os.path.join(self.result_directory, task.job.job_id, task.task_id + '.png')
+
+    def render_task(self, task, filename=None):
+        """Renders `task` using the job file `filename` (by default, the
+cached job file) and returns a `render.RenderResult`."""
+
+        if not filename:
+            filename = self.get_job_filename(task.job)
+
+        return self.get_executor().render_task(task, filename, self.get_result_filename(task))
+
+    def perform_task(self, task):
+        """Downloads the job file for `task` (if necessary), renders it, and
+uploads the result."""
+
+        self.task = task
+
+        try:
+            filename = self.download_job_file(task.job)
+
+            result = self.render_task(task, filename)
+
+            self.upload_render_result(task, result.output, result.elapsed, result.peak_memory)
+
+            os.remove(result.output)
+        finally:
+            self.task = None
+
+    def upload_render_result(self, task, filename, elapsed=0, peak_memory=0):
+        """Uploads the rendered file `filename` for `task`, along with the
+time it took and its peak memory usage in bytes."""
+
+        return self.api.upload_render_result(task, filename, elapsed, peak_memory)
+
+    def upload_result(self, job_id, task_id, filename, elapsed=0, peak_memory=0):
+        """Same as `upload_render_result()`, but only needs the IDs of the
+job and task."""
+
+        # pylint: disable=too-many-arguments
+
+        return self.api.upload_result(job_id, task_id, filename, elapsed, peak_memory)
@@ -0,0 +1,60 @@
+"""Compression of API responses. Clients list the encodings they
+accept in the `Accept-Encoding` header; responses of at least
+`MIN_SIZE` bytes are then sent `gzip`- or `deflate`-compressed."""
+
+import collections
+import zlib
+
+# Supported encodings, in order of preference, and the `wbits` of each
+# (`gzip` and `zlib` framing; HTTP's `deflate` is the latter).
+ENCODINGS = collections.OrderedDict((
+    ('gzip', 16 + zlib.MAX_WBITS),
+    ('deflate', zlib.MAX_WBITS)
+))
+
+# Smaller responses are sent as is; compressing them saves next to
+# nothing.
+MIN_SIZE = 1024
+
+# zlib compression level.
+LEVEL = 6
+
+def choose_encoding(accept_encoding):
+    """Returns the encoding to use for a request with the
+`Accept-Encoding` header `accept_encoding`, or `None` to send the
+response as is."""
+
+    if not accept_encoding:
+        return None
+
+    accepted = set()
+
+    for entry in accept_encoding.split(','):
+        name, _, parameters = entry.partition(';')
+
+        name = name.strip().lower()
+
+        parameter, _, value = parameters.partition('=')
+
+        if parameter.strip().lower() == 'q':
+            try:
+                if float(value) <= 0:
+                    continue
+            except ValueError:
+                continue
+
+        accepted.add(name)
+
+    for encoding in ENCODINGS:
+        if encoding in accepted or '*' in accepted:
+            return encoding
+
+    return None
+
+def compress(body, encoding):
+    """Returns `body` (bytes) compressed with `encoding` (one of
+`ENCODINGS`)."""
+
+    compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, ENCODINGS[encoding])
+
+    return compressor.compress(body) + compressor.flush()
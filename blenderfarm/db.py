@@ -2,6 +2,7 @@
 """Blenderfarm database management"""
 
 import json
+import os
 import random
 import string
 
@@ -30,8 +31,23 @@ class DB:
     def save(self):
         """Saves the db to disk."""
 
-        with open(self.filename, 'w') as dbfile:
-            json.dump(self._save(), dbfile)
+        self.write(self.snapshot())
+
+    def snapshot(self):
+        """Returns the db encoded as JSON, ready for `write()`. Taking the
+snapshot is quick; callers that hold a lock while the db may change
+can write it out after releasing the lock."""
+
+        return json.dumps(self._save())
+
+    def write(self, snapshot):
+        """Writes `snapshot` (see `snapshot()`) to disk. The file is
+replaced at once, so other processes never read it half-written."""
+
+        with open(self.filename + '.tmp', 'w') as dbfile:
+            dbfile.write(snapshot)
+
+        os.replace(self.filename + '.tmp', self.filename)
 
     def restore(self):
         """Restores the db from disk. Returns `True` if restoration happened,
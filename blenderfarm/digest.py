@@ -6,7 +6,7 @@ import hmac
 def get_digest(string, user_key):
     """Returns the HMAC digest for `string`, given the key `user_key`."""
     
-    return hmac.new(key=bytes(user_key, 'utf8'), msg=bytes(string, 'utf8')).hexdigest()
+    return hmac.new(key=bytes(user_key, 'utf8'), msg=bytes(string, 'utf8'), digestmod='md5').hexdigest()
 
 def get_key_value_digest(data, user_key):
     """Returns the HMAC digest for the URL and POST params `data`, given
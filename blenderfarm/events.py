@@ -0,0 +1,133 @@
+"""Server-to-node event streams. A render node that opens
+`node/events` keeps the connection open, and the server pushes events
+down it as server-sent events (`text/event-stream`), instead of the
+node polling for them:
+
+* `info`: server info, sent when the stream opens.
+* `offer`: tasks leased to the node, as soon as there's work and the
+  node has room for it.
+* `renew`: the tasks the server thinks the node holds; the node
+  answers with the ones it still holds, renewing their leases.
+* `cancel`: tasks the node should stop working on.
+* `keepalive`: sent on idle streams, so dead connections are noticed
+  on both ends.
+
+Nodes acknowledge `offer` and `renew` events by posting to
+`node/ack.json`; offers that aren't acknowledged in time are taken
+back. See `server.Server` for the dispatch side."""
+
+import itertools
+import json
+import queue
+import time
+
+class EventStream:
+
+    """The open event stream of the node `node_id`, which wants to hold
+up to `slots` tasks at once. `parameters` are passed on to
+`server.Server.get_next_tasks()` when offering it tasks."""
+
+    # pylint: disable=too-many-instance-attributes
+
+    # Seconds between `keepalive` events on an idle stream.
+    KEEPALIVE_TIME = 15
+
+    # Seconds a node has to acknowledge an offer.
+    ACK_TIME = 30
+
+    def __init__(self, node_id, slots, parameters):
+        self.node_id = node_id
+        self.slots = slots
+        self.parameters = parameters
+
+        # Events waiting to be written, as `(event_id, event_type,
+        # data)`; `None` closes the stream.
+        self.queue = queue.Queue()
+        self.event_ids = itertools.count(1)
+
+        # IDs of the tasks offered to the node that it (as far as we
+        # know) still holds.
+        self.task_ids = set()
+
+        # Maps the event IDs of offers that haven't been acknowledged yet
+        # to `(deadline, task_ids)`, where `deadline` is a
+        # `time.monotonic()` time.
+        self.offers = {}
+
+        # `time.monotonic()` time of the last `renew` event.
+        self.renew_time = time.monotonic()
+
+        self.open = True
+
+    def send(self, event_type, data):
+        """Queues an event and returns its ID."""
+
+        event_id = next(self.event_ids)
+
+        self.queue.put((event_id, event_type, data))
+
+        return event_id
+
+    def close(self):
+        """Ends the stream once the events queued so far are written."""
+
+        self.open = False
+        self.queue.put(None)
+
+    @staticmethod
+    def encode(event_id, event_type, data):
+        """Returns a single event in the `text/event-stream` format."""
+
+        if event_id is None:
+            return bytes('event: ' + event_type + '\ndata: ' + json.dumps(data) + '\n\n', 'utf8')
+
+        return bytes('id: ' + str(event_id) + '\nevent: ' + event_type + '\ndata: ' + json.dumps(data) + '\n\n',
+                     'utf8')
+
+    def serve(self, output):
+        """Writes events to the file object `output` until the stream is
+closed. Raises `OSError` once the node disconnects."""
+
+        while self.open:
+            try:
+                event = self.queue.get(timeout=EventStream.KEEPALIVE_TIME)
+            except queue.Empty:
+                event = (None, 'keepalive', {})
+
+            if event is None:
+                return
+
+            output.write(EventStream.encode(*event))
+            output.flush()
+
+def parse_events(lines):
+    """Parses the `text/event-stream` `lines` (strings, without line
+endings) and yields every event as `(event_id, event_type, data)`."""
+
+    event_id = None
+    event_type = 'message'
+    data = []
+
+    for line in lines:
+        if not line:
+            if data:
+                yield event_id, event_type, json.loads('\n'.join(data))
+
+            event_id = None
+            event_type = 'message'
+            data = []
+            continue
+
+        if line.startswith(':'):
+            continue
+
+        field, _, value = line.partition(':')
+
+        value = value[1:] if value.startswith(' ') else value
+
+        if field == 'id':
+            event_id = int(value)
+        elif field == 'event':
+            event_type = value
+        elif field == 'data':
+            data.append(value)
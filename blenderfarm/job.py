@@ -1,7 +1,20 @@
 
 """Job class."""
 
+import contextlib
+import heapq
+import json
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows; writes to the jobs database aren't coordinated
+    # between processes there.
+    fcntl = None
+
 from . import db
+from . import node as bf_node
 from . import serializable
 from . import task
 
@@ -15,6 +28,35 @@ class JobInfo(serializable.Serializable):
     def get_info_type(self):
         return 'none'
 
+    def is_compatible(self, node): # pylint: disable=no-self-use
+        """Returns `True` if `node` is capable of performing tasks for
+this job, `False` otherwise."""
+
+        _ = node
+
+        return True
+
+    def get_requirements(self): # pylint: disable=no-self-use
+        """Returns a tuple of the node requirements of this job that other
+jobs may share; `JobList` indexes jobs by it. `meets_requirements()`
+must give the same answer for every job with the same requirements."""
+
+        return ()
+
+    def meets_requirements(self, node): # pylint: disable=no-self-use
+        """Returns `True` if `node` meets the requirements returned by
+`get_requirements()`."""
+
+        _ = node
+
+        return True
+
+    def get_file_hash(self): # pylint: disable=no-self-use
+        """Returns the content hash of this job's work file, or an empty
+string if it's unknown."""
+
+        return ''
+
     def unserialize(self, data):
         return self
 
@@ -29,34 +71,123 @@ class JobInfoRender(JobInfo):
     def __init__(self, job):
         super().__init__(job)
 
+        # Where nodes download the `.blend` file from; if empty, the
+        # file is hosted in the server's blob store (see `blob.py`)
+        # under `file_hash`.
         self.file_url = ''
 
-        self.resolution = [1920, 1080]
+        # SHA-256 hex digest of the `.blend` file, or empty if unknown.
+        # Nodes cache files by hash and verify downloads against it.
+        self.file_hash = ''
+
+        # `[width, height]`; `None` uses whatever the `.blend` file
+        # says.
+        self.resolution = None
 
         # Renders frames from `[0]` to `[1]-1`.
         self.frame_range = [0, 1]
 
+        # Render samples; `None` uses whatever the `.blend` file says.
+        self.samples = None
+
+        # If `True`, every frame is first rendered as a scaled-down,
+        # low-sample preview before the full-quality pass starts.
+        self.preview = False
+
+        # Preview resolution, as a fraction of the full resolution.
+        self.preview_scale = 0.25
+
+        self.preview_samples = 16
+
+        # ## Node requirements
+
+        # Nodes with fewer cores or less memory (in bytes) than this
+        # are never handed tasks for this job.
+        self.min_cores = 0
+        self.min_memory = 0
+
+        # Minimum Blender version, such as `"2.79"`; empty if any
+        # version will do.
+        self.blender_version = ''
+
+        # Size of the `.blend` file, in bytes. Nodes without enough
+        # free disk space to hold it are skipped.
+        self.file_size = 0
+
     def get_info_type(self):
         return 'render'
 
+    def get_file_hash(self):
+        return self.file_hash
+
     def unserialize(self, data):
         super().unserialize(data)
 
         self.file_url = data['file_url']
+        self.file_hash = data.get('file_hash', '')
         self.frame_range = data['frame_range']
-        self.resolution = data['resolution']
+        self.resolution = data.get('resolution')
+        self.samples = data.get('samples')
+
+        self.preview = data.get('preview', False)
+        self.preview_scale = data.get('preview_scale', self.preview_scale)
+        self.preview_samples = data.get('preview_samples', self.preview_samples)
+
+        self.min_cores = data.get('min_cores', 0)
+        self.min_memory = data.get('min_memory', 0)
+        self.blender_version = data.get('blender_version', '')
+        self.file_size = data.get('file_size', 0)
 
         return self
 
+    def is_compatible(self, node):
+        if node.disk_free < self.file_size:
+            return False
+
+        return self.meets_requirements(node)
+
+    def get_requirements(self):
+        return self.min_cores, self.min_memory, self.blender_version
+
+    def meets_requirements(self, node):
+        if node.cores < self.min_cores:
+            return False
+
+        if node.memory < self.min_memory:
+            return False
+
+        if bf_node.parse_version(node.blender_version) < bf_node.parse_version(self.blender_version):
+            return False
+
+        return True
+
     def get_tasks(self):
+        """Returns a new list of tasks; one per frame, preceded by one
+preview task per frame if `preview` is set."""
 
         tasks = []
 
+        if self.preview:
+            for frame in range(self.frame_range[0], self.frame_range[1]):
+                frame_task = task.Task(self.job)
+
+                task_info = task.TaskInfoPreview(frame_task)
+                task_info.frame = frame
+                task_info.resolution = list(self.resolution) if self.resolution else None
+                task_info.scale = self.preview_scale
+                task_info.samples = self.preview_samples
+
+                frame_task.task_info = task_info
+
+                tasks.append(frame_task)
+
         for frame in range(self.frame_range[0], self.frame_range[1]):
             frame_task = task.Task(self.job)
             
             task_info = task.TaskInfoRender(frame_task)
             task_info.frame = frame
+            task_info.resolution = list(self.resolution) if self.resolution else None
+            task_info.samples = self.samples
 
             frame_task.task_info = task_info
             
@@ -68,8 +199,19 @@ class JobInfoRender(JobInfo):
         out = super().serialize()
 
         out['file_url'] = self.file_url
+        out['file_hash'] = self.file_hash
         out['frame_range'] = self.frame_range
         out['resolution'] = self.resolution
+        out['samples'] = self.samples
+
+        out['preview'] = self.preview
+        out['preview_scale'] = self.preview_scale
+        out['preview_samples'] = self.preview_samples
+
+        out['min_cores'] = self.min_cores
+        out['min_memory'] = self.min_memory
+        out['blender_version'] = self.blender_version
+        out['file_size'] = self.file_size
 
         return out
 
@@ -94,10 +236,17 @@ class Job(serializable.Serializable):
     # One or more tasks on this job have failed.
     STATUS_FAILED = 'failed'
 
-    # Currently in-progress tasks are saved, but further tasks are not
-    # created.
+    # No tasks are handed out, and nodes working on the job's tasks are
+    # told to stop; they're handed out again once the job is resumed.
     STATUS_PAUSED = 'paused'
 
+    # Like `STATUS_PAUSED`, but for good.
+    STATUS_CANCELLED = 'cancelled'
+
+    # Nodes must have this fraction of memory free on top of the
+    # estimated peak memory usage of a task before they're handed it.
+    MEMORY_MARGIN = 0.25
+
     def __init__(self, job_info):
         self.status = Job.STATUS_PENDING
 
@@ -111,11 +260,104 @@ class Job(serializable.Serializable):
         # Contains a list of `task_id`s.
         self.working_tasks = []
 
+        # Index of the tasks that can be handed out (see `update_task()`):
+        # maps their `task_id` to the `Task`, and keeps them in a heap of
+        # `(-priority, position, task_id)`, where `position` is the
+        # task's index in `tasks`. Heap entries of tasks that have been
+        # handed out since are skipped (and dropped) by `get_next_task()`.
+        self.pending = {}
+        self.pending_heap = []
+
+        # Maps `task_id` to its index in `tasks`.
+        self.task_positions = {}
+
+        # IDs of tasks that are neither complete nor ignored.
+        self.open_tasks = set()
+
+        # The highest peak memory usage reported for a single task, in
+        # bytes, keyed by `task_info_type` (preview tasks need far less
+        # memory than full-quality ones).
+        self.memory_estimates = {}
+
+        # `[total elapsed seconds, task count]` of completed tasks, keyed
+        # by `task_info_type`.
+        self.elapsed_totals = {}
+
         if job_info:
             self.job_info.job = self
 
+    def is_active(self):
+        """Returns `True` if this job's tasks should be handed out."""
+
+        return self.status not in (Job.STATUS_PAUSED, Job.STATUS_CANCELLED, Job.STATUS_FAILED)
+
+    def resume(self):
+        """Makes a paused job active again."""
+
+        if any(task_object.complete for task_object in self.tasks):
+            self.status = Job.STATUS_WORKING
+        else:
+            self.status = Job.STATUS_PENDING
+
     def populate_tasks(self):
-        self.tasks = self.job_info.get_tasks()
+        self.set_tasks(self.job_info.get_tasks())
+
+    def set_tasks(self, tasks):
+        """Replaces our tasks with `tasks`, and rebuilds the pending-task
+index."""
+
+        self.tasks = tasks
+
+        self.pending = {}
+        self.pending_heap = []
+        self.task_positions = {}
+        self.open_tasks = set()
+
+        for position, task_object in enumerate(tasks):
+            self.task_positions[task_object.task_id] = position
+            self.update_task(task_object)
+
+    def add_task(self, task_object):
+        """Adds `task_object` to our tasks."""
+
+        task_object.job = self
+
+        self.task_positions[task_object.task_id] = len(self.tasks)
+        self.tasks.append(task_object)
+
+        self.update_task(task_object)
+
+    def update_task(self, task_object):
+        """Updates the pending-task index after `task_object` was leased,
+released, completed or ignored, or its lease expired. Tasks that stop
+being available are also dropped lazily by `get_next_task()`, but
+`get_remaining_count()` is only exact if this is called for every
+change."""
+
+        task_id = task_object.task_id
+
+        if task_object.complete or task_object.ignore:
+            self.open_tasks.discard(task_id)
+        else:
+            self.open_tasks.add(task_id)
+
+        if not task_object.should_execute():
+            self.pending.pop(task_id, None)
+            return
+
+        if task_id in self.pending:
+            return
+
+        self.pending[task_id] = task_object
+
+        heapq.heappush(self.pending_heap, (-task_object.get_priority(), self.task_positions.get(task_id, 0), task_id))
+
+        # Entries of tasks handed out since pile up; start over once
+        # they outnumber the live ones.
+        if len(self.pending_heap) > 2 * len(self.pending) + 64:
+            self.pending_heap = [(-pending_task.get_priority(), self.task_positions.get(pending_id, 0), pending_id)
+                                 for pending_id, pending_task in self.pending.items()]
+            heapq.heapify(self.pending_heap)
         
     def get_task(self, task_id):
         """Returns the task with `task_id`, or `None` if no such task exists."""
@@ -130,6 +372,7 @@ class Job(serializable.Serializable):
 
     def unserialize(self, data):
         self.job_id = data['job_id']
+        self.status = data.get('status', Job.STATUS_PENDING)
 
         job_info_type = data['job_info_type']
         
@@ -141,23 +384,37 @@ class Job(serializable.Serializable):
             
         self.job_info.unserialize(data['job_info'])
 
-        if 'tasks' in data:
-            self.tasks = []
+        self.memory_estimates = data.get('memory_estimates', {})
+        self.elapsed_totals = data.get('elapsed_totals', {})
 
-            for task_serialized in data['tasks']:
-                self.tasks.append(task.Task(self).unserialize(task_serialized))
+        if 'tasks' in data:
+            self.set_tasks([task.Task(self).unserialize(task_serialized) for task_serialized in data['tasks']])
 
         return self
 
+    def get_revision(self, net=False):
+        """Returns the parts of `serialize(net)` that can change, or `None`."""
+
+        # Everything else `serialize(net=True)` includes never changes.
+        if not net:
+            return None
+
+        return self.status, tuple(self.memory_estimates.items())
+
     def serialize(self, net=False):
         out = {}
 
         out['job_id'] = self.job_id
+        out['status'] = self.status
 
         out['job_info_type'] = self.job_info.get_info_type()
         out['job_info'] = self.job_info.serialize()
 
+        out['memory_estimates'] = self.memory_estimates
+
         if not net:
+            out['elapsed_totals'] = self.elapsed_totals
+
             out['tasks'] = []
 
             for task_object in self.tasks:
@@ -165,22 +422,113 @@ class Job(serializable.Serializable):
 
         return out
 
+    def get_file_key(self):
+        """Returns the key render nodes cache this job's file under, and
+use to advertise that they hold it: the file's hash if it's known (so
+jobs sharing a file share the cached copy), or the `job_id`."""
+
+        return self.job_info.get_file_hash() or self.job_id
+
     def get_job_line(self):
         """Returns a human-readable job info string."""
-        return self.job_id.ljust(24)
+        return self.job_id.ljust(24) + ' ' + self.status
 
     def get_next_task(self):
-        """Returns the highest-priority task."""
+        """Returns the highest-priority task, or `None` if no task
+should be executed right now. Among tasks with the same priority, the
+first one wins. Looked up in the pending-task index (see
+`update_task()`) rather than by scanning every task."""
 
-        if not self.tasks:
+        if not self.is_active():
             return None
 
-        for task in self.tasks:
-            if task.should_execute():
-                return task
+        while self.pending_heap:
+            task_id = self.pending_heap[0][2]
+
+            task_object = self.pending.get(task_id)
+
+            if task_object is not None:
+                if task_object.should_execute():
+                    return task_object
+
+                del self.pending[task_id]
+
+            heapq.heappop(self.pending_heap)
 
         return None
 
+    def get_remaining_count(self):
+        """Returns the number of tasks that have yet to be handed out."""
+
+        return len(self.pending)
+
+    def is_finished(self):
+        """Returns `True` if none of this job's tasks is left to complete,
+or the job isn't active."""
+
+        if not self.is_active():
+            return True
+
+        return not self.open_tasks
+
+    # ## Elapsed time
+
+    def record_elapsed(self, task_object, elapsed):
+        """Adds the `elapsed` seconds a node took to perform `task_object`
+to the job's statistics."""
+
+        totals = self.elapsed_totals.setdefault(task_object.task_info.get_info_type(), [0, 0])
+
+        totals[0] += elapsed
+        totals[1] += 1
+
+    def get_average_elapsed(self, task_object):
+        """Returns the average number of seconds tasks like `task_object`
+took, or `None` if none have been completed yet."""
+
+        totals = self.elapsed_totals.get(task_object.task_info.get_info_type())
+
+        if not totals or not totals[1]:
+            return None
+
+        return totals[0] / totals[1]
+
+    # ## Memory profile
+
+    def record_peak_memory(self, task_object, peak_memory):
+        """Updates the memory estimate for tasks like `task_object` with the
+`peak_memory` (in bytes) a node reported after performing it."""
+
+        info_type = task_object.task_info.get_info_type()
+
+        if peak_memory > self.memory_estimates.get(info_type, 0):
+            self.memory_estimates[info_type] = peak_memory
+
+    def get_memory_estimate(self, task_object):
+        """Returns the estimated peak memory usage of `task_object` in
+bytes, or `None` if no node has reported it yet."""
+
+        return self.memory_estimates.get(task_object.task_info.get_info_type())
+
+    def get_required_memory(self, task_object):
+        """Returns the free memory (in bytes) a node needs to safely perform
+`task_object`: its estimated peak memory usage plus `MEMORY_MARGIN`.
+Until a node reports the memory usage of this kind of task, the job's
+`min_memory` requirement is used instead."""
+
+        estimate = self.get_memory_estimate(task_object)
+
+        if estimate is None:
+            estimate = getattr(self.job_info, 'min_memory', 0)
+
+        return int(estimate * (1 + Job.MEMORY_MARGIN))
+
+    def fits_memory(self, task_object, memory_free):
+        """Returns `True` if a node with `memory_free` bytes of free memory
+can safely perform `task_object` (see `get_required_memory()`)."""
+
+        return memory_free >= self.get_required_memory(task_object)
+
     
 # # JobsList
     
@@ -192,10 +540,196 @@ class JobList(db.DB):
 
         self.jobs = []
 
+        # Maps `job_id` to `Job`.
+        self.job_index = {}
+
+        # Maps `task_id` to `Task`, across every job.
+        self.task_index = {}
+
+        # Jobs that may have tasks to hand out, indexed by their node
+        # requirements (see `JobInfo.get_requirements()`): maps the
+        # requirements to `{job_id: Job}`. Jobs are dropped once
+        # `get_next_job()` finds them finished, and added back by
+        # `index_job()`.
+        self.runnable = {}
+
+        # Maps `job_id` to the order jobs were added in; older jobs win
+        # ties in `get_next_job()`.
+        self.job_order = {}
+
+        # Called with every job added by `add()` or `merge()`, if set.
+        self.on_add = None
+
+        # Called with every job whose status `merge()` picked up, if set.
+        self.on_status = None
+
+        # `(mtime, size)` of our file when we last read or wrote it.
+        self.signature = None
+
         # If we don't have any saved data, save the DB.
         if not self.restore():
             self.save()
 
+    def get_signature(self):
+        """Returns the `(mtime, size)` of our file on disk, or `None` if it
+doesn't exist."""
+
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def save(self):
+        # Another process changed the file between our snapshot and
+        # writing it; the next snapshot merges its changes.
+        while not self.write(self.snapshot()):
+            pass
+
+    def snapshot(self):
+        """Picks up jobs other processes added to the db on disk (see
+`merge()`), so they're not overwritten, and returns the encoded db."""
+
+        self.merge()
+
+        return super().snapshot()
+
+    def write(self, snapshot):
+        """Writes `snapshot`, unless another process changed the file since
+we last read or wrote it; returns `False` if so, in which case a new
+snapshot (which merges those changes) should be written instead."""
+
+        with self.lock_file():
+            if self.get_signature() != self.signature:
+                return False
+
+            super().write(snapshot)
+
+            self.signature = self.get_signature()
+
+        return True
+
+    @contextlib.contextmanager
+    def lock_file(self):
+        """Holds an exclusive lock on the db file, shared with every other
+process that writes it (see `write()` and `update_saved()`)."""
+
+        with open(self.filename + '.lock', 'a') as handle:
+            if fcntl:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def update_saved(self, update):
+        """Changes the db on disk in place, for processes other than the
+server (such as `bf.py`), whose copy of the jobs may be out of date:
+`update` is called with the saved list of serialized jobs and changes
+it, so nothing else the server saved meanwhile is undone. The server
+picks the change up through `merge()`."""
+
+        with self.lock_file():
+            try:
+                with open(self.filename, 'r') as dbfile:
+                    data = json.load(dbfile)
+            except FileNotFoundError:
+                data = []
+
+            update(data)
+
+            db.DB.write(self, json.dumps(data))
+
+        self.restore()
+
+    def set_status(self, job_id, update):
+        """Changes the status of the job `job_id` on disk (see
+`update_saved()`): `update` is called with the job as saved, and
+changes its status, which is all that's written back. Returns the
+updated job, or `None` if there's no such job."""
+
+        updated = []
+
+        def update_status(data):
+            for job_data in data:
+                if job_data['job_id'] == job_id:
+                    job = Job(None).unserialize(job_data)
+
+                    update(job)
+
+                    job_data['status'] = job.status
+
+                    updated.append(job)
+
+        self.update_saved(update_status)
+
+        return updated[0] if updated else None
+
+    def restore(self):
+        restored = super().restore()
+
+        self.signature = self.get_signature()
+
+        return restored
+
+    def merge(self):
+        """Adds the jobs another process (such as `bf.py job add`) saved to
+disk since we last read or wrote it, and picks up the status of jobs
+it paused, resumed or cancelled, leaving the rest of the (partly
+unsaved) state of the jobs we already hold alone. Returns the new
+jobs."""
+
+        signature = self.get_signature()
+
+        if signature is None or signature == self.signature:
+            return []
+
+        self.signature = signature
+
+        try:
+            with open(self.filename, 'r') as dbfile:
+                data = json.load(dbfile)
+        except (OSError, ValueError):
+            # Files are replaced at once (see `write()`), so it's broken;
+            # our next save overwrites it.
+            return []
+
+        jobs = []
+        changed_jobs = []
+
+        for job_data in data:
+            if job_data['job_id'] in self.job_index:
+                job = self.job_index[job_data['job_id']]
+
+                if job_data.get('status', job.status) != job.status:
+                    job.status = job_data['status']
+                    changed_jobs.append(job)
+
+                    # Resumed jobs are runnable again.
+                    self.index_job(job)
+
+                continue
+
+            job = Job(None)
+            job.unserialize(job_data)
+
+            self.jobs.append(job)
+            self.index_job(job)
+
+            jobs.append(job)
+
+        for job in jobs:
+            self.job_added(job)
+
+        for job in changed_jobs:
+            if self.on_status:
+                self.on_status(job)
+
+        return jobs
+
     # # Save/restore
 
     def _save(self):
@@ -207,42 +741,118 @@ class JobList(db.DB):
         return out_jobs
 
     def _restore(self, data):
-        self.jobs = []
+        jobs = []
 
         for job_data in data:
             job = Job(None)
             job.unserialize(job_data)
 
-            self.jobs.append(job)
+            jobs.append(job)
 
-    def add(self, job):
-        """Adds a job."""
+        self.set_jobs(jobs)
+
+    def set_jobs(self, jobs):
+        """Replaces our jobs with `jobs`, and rebuilds our indexes."""
 
-        self.refresh()
+        self.jobs = jobs
+        self.job_index = {}
+        self.task_index = {}
+        self.runnable = {}
+        self.job_order = {}
 
-        self.jobs.append(job)
+        for job in jobs:
+            self.index_job(job)
 
-        self.save()
+    def index_job(self, job):
+        """Adds `job` and its tasks to our indexes. Must be called again
+whenever tasks are added to `job`, or it may have become runnable
+again."""
+
+        self.job_index[job.job_id] = job
+
+        self.job_order.setdefault(job.job_id, len(self.job_order))
+
+        for task_object in job.tasks:
+            self.task_index[task_object.task_id] = task_object
+
+        if not job.is_finished():
+            self.runnable.setdefault(job.job_info.get_requirements(), {})[job.job_id] = job
+
+    def add(self, job):
+        """Adds a job to the db on disk (see `update_saved()`)."""
+
+        self.update_saved(lambda data: data.append(job.serialize()))
+
+        self.job_added(job)
 
         return True
 
+    def job_added(self, job):
+        """Calls `on_add`, if set, with the newly added `job`."""
+
+        if self.on_add:
+            self.on_add(job)
+
     def get_jobs(self):
         return self.jobs
 
     def get_job(self, job_id):
         """Returns the job with `job_id`, or `None` if no such job exists."""
         
-        for job in self.jobs:
-            if job.job_id == job_id:
-                return job
-
-        return None
+        return self.job_index.get(job_id)
 
-    def get_next_job(self):
-        """Returns the highest-priority job."""
+    def get_task(self, task_id):
+        """Returns the task with `task_id` in any job, or `None` if no such task exists."""
+
+        return self.task_index.get(task_id)
+
+    def get_next_job(self, node=None, memory_free=None, tail_size=0):
+        """Returns the job holding the highest-priority task, or `None` if
+no job has any task left to hand out. Preview tasks of a newer job
+are handed out before full-quality tasks of an older one; otherwise,
+older jobs win. If `node` is present, jobs it is not capable of
+performing are skipped; if `memory_free` (in bytes) is present, so are
+jobs whose next task would not fit in that much memory. Jobs with
+`tail_size` or fewer tasks left are skipped too, so their last tasks
+are left for faster nodes. Among jobs with the same priority, jobs
+whose file `node` already holds are preferred, to avoid needless
+downloads and job switches."""
         
-        if not self.jobs:
-            return None
+        next_job = None
+        next_rank = None
+
+        for requirements, jobs in list(self.runnable.items()):
+            # Every job in the group has the same requirements.
+            if node and not next(iter(jobs.values())).job_info.meets_requirements(node):
+                continue
+
+            for job in list(jobs.values()):
+                next_task = job.get_next_task()
+
+                if not next_task:
+                    if job.is_finished():
+                        del jobs[job.job_id]
+                    continue
+
+                rank = (next_task.get_priority(), bool(node and node.has_job_file(job)), -self.job_order[job.job_id])
+
+                # Only the winner has to pass the (costlier) checks below.
+                if next_job is not None and rank <= next_rank:
+                    continue
+
+                if node and not job.job_info.is_compatible(node):
+                    continue
+
+                if memory_free is not None and not job.fits_memory(next_task, memory_free):
+                    continue
+
+                if tail_size and job.get_remaining_count() <= tail_size:
+                    continue
+
+                next_job = job
+                next_rank = rank
+
+            if not jobs:
+                del self.runnable[requirements]
 
-        # Obviously, this is a temporary placeholder.
-        return self.jobs[0] # TODO duh.
+        return next_job
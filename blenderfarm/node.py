@@ -1,7 +1,31 @@
 """Render nodes."""
 
+import time
+
+from . import bloom
+from . import db
 from . import serializable
 
+def parse_version(version):
+    """Converts a version string such as `"2.79.1"` into a tuple of
+integers, such as `(2, 79, 1)`, so versions can be compared. Returns
+`()` if `version` is empty."""
+
+    if not version:
+        return ()
+
+    parts = []
+
+    for part in str(version).split('.'):
+        digits = ''.join(character for character in part if character.isdigit())
+
+        if not digits:
+            break
+
+        parts.append(int(digits))
+
+    return tuple(parts)
+
 class Node(serializable.Serializable):
 
     """Describes a single render node. Nodes are unique for every machine/user/key combination."""
@@ -9,12 +33,141 @@ class Node(serializable.Serializable):
     def __init__(self):
         self.node_id = None
 
+        # The user this node authenticated as when it registered.
+        self.username = None
+
+        self.hostname = ''
+
+        # ## Capabilities (reported by the node itself)
+
+        self.cores = 0
+
+        # Total memory, in bytes.
+        self.memory = 0
+
+        # Free disk space in the node's cache directory, in bytes.
+        self.disk_free = 0
+
+        # Memory available for new tasks, in bytes, as of the last
+        # request.
+        self.memory_free = 0
+
+        self.blender_version = ''
+
+        # Epoch time of the last request from this node.
+        self.last_seen = 0
+
+        # ## Speed
+
+        # Score of the calibration benchmark (see `benchmark.py`); `0`
+        # if the node hasn't been calibrated.
+        self.calibration = 0
+
+        # Moving average of how much faster than the farm's average this
+        # node performs tasks (`2.0` means twice as fast), and the
+        # number of results it's based on.
+        self.elapsed_ratio = 1.0
+        self.elapsed_samples = 0
+
+        # ## Job file cache
+
+        # A `bloom.BloomFilter` of the job file keys (see
+        # `job.Job.get_file_key()`) this node has cached, or `None` if
+        # it hasn't told us.
+        self.cache_filter = None
+
+        # The job this node was last handed a task for; its file is
+        # almost certainly still loaded.
+        self.last_job_id = None
+
+    def update_capabilities(self, data):
+        """Updates capabilities from the (stringified) URL parameters
+`data`. Missing keys are left untouched."""
+
+        if 'hostname' in data:
+            self.hostname = data['hostname']
+
+        if 'cores' in data:
+            self.cores = int(data['cores'])
+
+        if 'memory' in data:
+            self.memory = int(data['memory'])
+
+        if 'disk_free' in data:
+            self.disk_free = int(data['disk_free'])
+
+        if 'memory_free' in data:
+            self.memory_free = int(data['memory_free'])
+
+        if 'blender_version' in data:
+            self.blender_version = data['blender_version']
+
+        if 'calibration' in data:
+            self.calibration = float(data['calibration'])
+
+        if 'cache' in data:
+            try:
+                self.cache_filter = bloom.BloomFilter().decode(data['cache'])
+            except ValueError:
+                self.cache_filter = None
+
+        self.last_seen = time.time()
+
+    def record_elapsed_ratio(self, ratio):
+        """Adds a single result to the moving average of `elapsed_ratio`;
+`ratio` is the farm's average time for the task divided by the time
+this node took."""
+
+        weight = max(0.1, 1 / (self.elapsed_samples + 1))
+
+        self.elapsed_ratio += (ratio - self.elapsed_ratio) * weight
+        self.elapsed_samples += 1
+
+    def has_job_file(self, job):
+        """Returns `True` if this node (probably) holds the file for `job`
+already. False positives are possible, but rare."""
+
+        if job.job_id == self.last_job_id:
+            return True
+
+        if not self.cache_filter:
+            return False
+
+        return job.get_file_key() in self.cache_filter
+
+    def get_node_line(self):
+        """Returns a human-readable node info string."""
+
+        return ' '.join([
+            self.node_id.ljust(32),
+            (self.username or '').ljust(16),
+            self.hostname.ljust(24),
+            str(self.cores).rjust(4) + ' cores',
+            str(self.memory // (1024 * 1024)).rjust(8) + ' MiB',
+            'blender ' + (self.blender_version or '?'),
+            'calibration ' + str(round(self.calibration, 2))
+        ])
 
     def unserialize(self, data):
         super().unserialize(data)
 
         self.node_id = data['node_id']
 
+        self.username = data.get('username')
+        self.hostname = data.get('hostname', '')
+
+        self.cores = data.get('cores', 0)
+        self.memory = data.get('memory', 0)
+        self.disk_free = data.get('disk_free', 0)
+        self.memory_free = data.get('memory_free', 0)
+        self.blender_version = data.get('blender_version', '')
+
+        self.last_seen = data.get('last_seen', 0)
+
+        self.calibration = data.get('calibration', 0)
+        self.elapsed_ratio = data.get('elapsed_ratio', 1.0)
+        self.elapsed_samples = data.get('elapsed_samples', 0)
+
         return self
 
     def serialize(self):
@@ -22,4 +175,90 @@ class Node(serializable.Serializable):
 
         out['node_id'] = self.node_id
 
+        out['username'] = self.username
+        out['hostname'] = self.hostname
+
+        out['cores'] = self.cores
+        out['memory'] = self.memory
+        out['disk_free'] = self.disk_free
+        out['memory_free'] = self.memory_free
+        out['blender_version'] = self.blender_version
+
+        out['last_seen'] = self.last_seen
+
+        out['calibration'] = self.calibration
+        out['elapsed_ratio'] = self.elapsed_ratio
+        out['elapsed_samples'] = self.elapsed_samples
+
         return out
+
+
+# # NodeList
+
+class NodeList(db.DB):
+    """Node registry database."""
+
+    def __init__(self):
+        super().__init__('nodes.json')
+
+        # Maps `node_id` to `Node`.
+        self.nodes = {}
+
+        # If we don't have any saved data, save the DB.
+        if not self.restore():
+            self.save()
+
+    # # Save/restore
+
+    def _save(self):
+        out_nodes = []
+
+        for node in self.nodes.values():
+            out_nodes.append(node.serialize())
+
+        return out_nodes
+
+    def _restore(self, data):
+        self.nodes = {}
+
+        for node_data in data:
+            node = Node().unserialize(node_data)
+
+            self.nodes[node.node_id] = node
+
+    def get_nodes(self):
+        """Returns a list of every registered node."""
+
+        return list(self.nodes.values())
+
+    def get_active_nodes(self, since):
+        """Returns a list of every node that made a request after the epoch
+time `since`."""
+
+        return [node for node in self.nodes.values() if node.last_seen >= since]
+
+    def get_node(self, node_id):
+        """Returns the node with `node_id`, or `None` if no such node is registered."""
+
+        return self.nodes.get(node_id)
+
+    def register(self, username, data):
+        """Registers (or re-registers) a node owned by `username`, with
+the capabilities in `data` (see `Node.update_capabilities()`). If
+`data` contains the `node_id` of a node owned by the same user, that
+node is updated; otherwise, a new node is created. Returns the `Node`."""
+
+        node = self.get_node(data.get('node_id'))
+
+        if not node or node.username != username:
+            node = Node()
+            node.node_id = db.generate_uuid()
+            node.username = username
+
+            self.nodes[node.node_id] = node
+
+        node.update_capabilities(data)
+
+        self.save()
+
+        return node
@@ -0,0 +1,279 @@
+"""Render result outbox. Finished frames are moved into an on-disk
+outbox the moment they're written, and uploaded from there by
+background threads; results survive network outages and node restarts
+and are never lost to a failed upload."""
+
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+from . import error
+
+class Outbox:
+
+    """A durable upload queue in `directory`, drained by
+`upload_threads` threads through `client` (a `client.Client`). Every
+result is stored as two files: the result itself, and a
+`<task_id>.json` entry describing it; the entry is written last, so a
+result only counts once both exist. Entries left over from a previous
+run are picked up again by `start()`.
+
+Failed uploads are retried with exponential backoff (with jitter, so a
+farm of nodes doesn't retry in lockstep), except when the server says
+the job or task no longer exists."""
+
+    # Seconds to wait before the first retry; doubled on every failed
+    # attempt, up to `MAX_RETRY_TIME`.
+    RETRY_TIME = 1
+    MAX_RETRY_TIME = 5 * 60
+
+    # Error codes that won't go away by retrying.
+    PERMANENT_ERRORS = ('invalid-job', 'invalid-task', 'missing-file')
+
+    def __init__(self, client, directory='outbox', upload_threads=4):
+        self.client = client
+        self.directory = directory
+        self.upload_threads = upload_threads
+
+        # Heap of `(next_attempt, sequence, entry)`, where `next_attempt`
+        # is a `time.monotonic()` time; `sequence` keeps equal times in
+        # insertion order.
+        self.pending = []
+        self.sequence = itertools.count()
+
+        # Maps the `task_id` of every entry that's queued or being
+        # uploaded to the entry.
+        self.entries = {}
+
+        self.condition = threading.Condition()
+
+        # Called with the `task_id` of every entry that's uploaded or
+        # discarded, if set.
+        self.on_remove = None
+
+        self.threads = []
+
+        self.running = False
+
+    def __len__(self):
+        """Returns the number of results waiting to be uploaded."""
+
+        with self.condition:
+            return len(self.entries)
+
+    def get_entry_filename(self, task_id):
+        """Returns the path of the entry for `task_id`."""
+
+        return os.path.join(self.directory, task_id + '.json')
+
+    def save_entry(self, entry):
+        """Atomically writes `entry` to disk."""
+
+        filename = self.get_entry_filename(entry['task_id'])
+
+        with open(filename + '.tmp', 'w') as handle:
+            json.dump(entry, handle)
+
+        os.replace(filename + '.tmp', filename)
+
+    def remove_entry(self, entry):
+        """Deletes `entry` and its result from disk."""
+
+        with self.condition:
+            self.entries.pop(entry['task_id'], None)
+
+        for filename in (entry['filename'], self.get_entry_filename(entry['task_id'])):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+        if self.on_remove:
+            self.on_remove(entry['task_id'])
+
+    def get_task_ids(self):
+        """Returns the IDs of the tasks whose results are queued or being
+uploaded."""
+
+        with self.condition:
+            return list(self.entries)
+
+    def schedule(self, entry, delay=0):
+        """Queues `entry` to be uploaded in `delay` seconds."""
+
+        with self.condition:
+            self.entries[entry['task_id']] = entry
+
+            heapq.heappush(self.pending, (time.monotonic() + delay, next(self.sequence), entry))
+            self.condition.notify()
+
+    def put(self, task, result):
+        """Moves the rendered `result` (a `render.RenderResult`) of `task`
+into the outbox and queues it for upload. Returns as soon as the
+result is safely on disk."""
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        extension = os.path.splitext(result.output)[1]
+
+        filename = os.path.join(self.directory, task.task_id + extension)
+
+        os.replace(result.output, filename)
+
+        self.add(task.job.job_id, task.task_id, filename, result.elapsed, result.peak_memory)
+
+    def add(self, job_id, task_id, filename, elapsed=0, peak_memory=0):
+        """Queues the result file `filename` of the task `task_id`, which
+must already be in our directory, for upload. `elapsed` and
+`peak_memory` are reported along with it."""
+
+        # pylint: disable=too-many-arguments
+
+        entry = {
+            'job_id': job_id,
+            'task_id': task_id,
+            'filename': filename,
+            'elapsed': elapsed,
+            'peak_memory': peak_memory,
+            'attempts': 0
+        }
+
+        self.save_entry(entry)
+        self.schedule(entry)
+
+    def restore(self):
+        """Queues every entry left in the outbox by a previous run (or by
+`put()` before `start()`) that isn't queued yet. Returns the number of
+entries found."""
+
+        if not os.path.isdir(self.directory):
+            return 0
+
+        count = 0
+
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json'):
+                continue
+
+            with self.condition:
+                if name[:-len('.json')] in self.entries:
+                    continue
+
+            try:
+                with open(os.path.join(self.directory, name), 'r') as handle:
+                    entry = json.load(handle)
+            except (OSError, ValueError):
+                continue
+
+            self.schedule(entry)
+
+            count += 1
+
+        return count
+
+    # ## Lifecycle
+
+    def start(self):
+        """Queues entries from a previous run, then starts uploading."""
+
+        self.running = True
+
+        count = self.restore()
+
+        if count:
+            print('resuming upload of ' + str(count) + ' result(s)')
+
+        for index in range(self.upload_threads):
+            thread = threading.Thread(target=self.run_uploader, daemon=True, name='uploader-' + str(index))
+            thread.start()
+
+            self.threads.append(thread)
+
+    def stop(self):
+        """Stops uploading, after finishing uploads in progress. Queued
+results stay in the outbox for the next run."""
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    def get_next_entry(self):
+        """Waits until an entry is due for upload and returns it; returns
+`None` once the outbox is stopped."""
+
+        with self.condition:
+            while self.running:
+                now = time.monotonic()
+
+                if self.pending and self.pending[0][0] <= now:
+                    return heapq.heappop(self.pending)[2]
+
+                timeout = None
+
+                if self.pending:
+                    timeout = self.pending[0][0] - now
+
+                self.condition.wait(timeout)
+
+        return None
+
+    def run_uploader(self):
+        """Uploads due entries until the outbox is stopped."""
+
+        while True:
+            entry = self.get_next_entry()
+
+            if not entry:
+                return
+
+            self.upload(entry)
+
+    def upload(self, entry):
+        """Attempts to upload `entry`; on failure, schedules a retry."""
+
+        try:
+            self.client.upload_result(entry['job_id'], entry['task_id'], entry['filename'],
+                                      entry['elapsed'], entry['peak_memory'])
+        except error.Error as exception:
+            if exception.code in Outbox.PERMANENT_ERRORS:
+                print('discarding result of task "' + entry['task_id'] + '": ' + str(exception))
+                self.remove_entry(entry)
+                return
+
+            self.retry(entry, exception)
+            return
+        except Exception as exception: # pylint: disable=broad-except
+            self.retry(entry, exception)
+            return
+
+        self.remove_entry(entry)
+
+    def retry(self, entry, exception):
+        """Schedules another attempt to upload `entry` after it failed with `exception`."""
+
+        entry['attempts'] += 1
+
+        delay = min(Outbox.MAX_RETRY_TIME, Outbox.RETRY_TIME * 2 ** (entry['attempts'] - 1))
+        delay *= random.uniform(0.5, 1)
+
+        # Don't come back sooner than an overloaded server asked us to.
+        if isinstance(exception, error.Error) and exception.code == 'overloaded':
+            try:
+                delay = max(delay, float(exception.context))
+            except (TypeError, ValueError):
+                pass
+
+        print('could not upload result of task "' + entry['task_id'] + '" (attempt ' +
+              str(entry['attempts']) + '), retrying in ' + str(round(delay, 1)) + 's: ' + str(exception))
+
+        self.save_entry(entry)
+        self.schedule(entry, delay)
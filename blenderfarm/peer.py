@@ -0,0 +1,191 @@
+"""Render node peer server. Serves chunks of job files from the node's
+cache (and of files it's still downloading) to other render nodes, so
+new job files spread through the farm instead of every node fetching
+them from the server; see `tracker.py`.
+
+Chunks are requested with `GET /chunk?hash=<chunk hash>&wait=<seconds>`.
+If the chunk belongs to a file we're still downloading, the request
+waits up to `wait` seconds for it to arrive. Chunks are addressed by
+their hash, and every node verifies the chunks it receives, so a peer
+can't hand out bad data."""
+
+import threading
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class PeerRequestHandler(BaseHTTPRequestHandler):
+
+    """Handles chunk requests for `peer_server`, a `PeerServer`."""
+
+    peer_server = None
+
+    # pylint: disable=invalid-name
+    def do_GET(self):
+        """Responds to `GET` requests."""
+
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+
+        if url.path != '/chunk' or 'hash' not in params:
+            self.send_error(404)
+            return
+
+        try:
+            wait = min(float(params.get('wait', ['0'])[0]), PeerServer.MAX_WAIT)
+        except ValueError:
+            wait = 0
+
+        data = self.peer_server.get_chunk(params['hash'][0], wait)
+
+        if data is None:
+            self.send_error(404)
+            return
+
+        if self.peer_server.bucket:
+            self.peer_server.bucket.consume(len(data))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+        self.wfile.write(data)
+
+    def log_message(self, _format, *args):
+        """Inhibit logging."""
+
+        _ = _format, args
+
+class PeerServer:
+
+    """Serves the chunks in `file_cache` (a `cache.FileCache`), plus the
+chunks of downloads in progress, on `port`."""
+
+    # Longest a request may wait for a chunk, in seconds.
+    MAX_WAIT = 60
+
+    def __init__(self, file_cache, port, host=''):
+        self.file_cache = file_cache
+
+        self.host = host
+        self.port = port
+
+        # Maps the hash of every chunk of every download in progress to
+        # `(filename, offset, size)` once it has been written, or to
+        # `None` until then.
+        self.downloads = {}
+
+        # The chunk index of `file_cache` (see
+        # `cache.FileCache.get_chunk_index()`), and the cache keys it was
+        # built from.
+        self.index = {}
+        self.index_keys = None
+
+        self.condition = threading.Condition()
+
+        # If set, the `bandwidth.TokenBucket` the chunks we serve pass
+        # through.
+        self.bucket = None
+
+        self.httpd = None
+
+    def start(self):
+        """Starts serving chunks in a background thread."""
+
+        handler = type('BoundPeerRequestHandler', (PeerRequestHandler,), {'peer_server': self})
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), handler)
+        self.httpd.daemon_threads = True
+
+        # Pick up the actual port if we were asked for any free one.
+        self.port = self.httpd.server_address[1]
+
+        threading.Thread(target=self.httpd.serve_forever, daemon=True, name='peer-server').start()
+
+    def stop(self):
+        """Stops serving chunks."""
+
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    # ## Downloads in progress
+
+    def start_download(self, manifest):
+        """Announces that the chunks of `manifest` are on their way, so
+requests for them wait instead of failing."""
+
+        with self.condition:
+            for chunk_hash, _ in manifest['chunks']:
+                self.downloads.setdefault(chunk_hash, None)
+
+    def add_chunk(self, chunk_hash, filename, offset, size):
+        """Records that the chunk `chunk_hash` has been written to
+`filename` (and flushed) at `offset`."""
+
+        # pylint: disable=too-many-arguments
+
+        with self.condition:
+            self.downloads[chunk_hash] = (filename, offset, size)
+            self.condition.notify_all()
+
+    def finish_download(self, manifest):
+        """Forgets about the download of `manifest`, once it's in the cache
+or it has failed; requests still waiting for its chunks give up."""
+
+        with self.condition:
+            for chunk_hash, _ in manifest['chunks']:
+                self.downloads.pop(chunk_hash, None)
+
+            self.condition.notify_all()
+
+    # ## Chunks
+
+    def get_cached_chunk(self, chunk_hash):
+        """Returns `(filename, offset, size)` of `chunk_hash` in our cache,
+or `None`."""
+
+        keys = set(self.file_cache.get_keys())
+
+        if keys != self.index_keys:
+            self.index = self.file_cache.get_chunk_index()
+            self.index_keys = keys
+
+        if chunk_hash not in self.index:
+            return None
+
+        key, offset, size = self.index[chunk_hash]
+
+        return self.file_cache.get_filename(key), offset, size
+
+    def get_chunk(self, chunk_hash, wait=0):
+        """Returns the contents of the chunk `chunk_hash`, waiting up to
+`wait` seconds if it's part of a download in progress. Returns `None`
+if we don't have it."""
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.downloads.get(chunk_hash) or chunk_hash not in self.downloads,
+                                    wait)
+
+            locations = [self.downloads.get(chunk_hash), self.get_cached_chunk(chunk_hash)]
+
+        # A finished download may have moved into the cache meanwhile.
+        for location in locations:
+            if not location:
+                continue
+
+            filename, offset, size = location
+
+            try:
+                with open(filename, 'rb') as handle:
+                    handle.seek(offset)
+                    data = handle.read(size)
+            except OSError:
+                continue
+
+            if len(data) == size:
+                return data
+
+        return None
@@ -0,0 +1,448 @@
+"""Site-local relay server. A relay sits between the main server and a
+pool of render nodes behind a slow link (say, in another building).
+It speaks the v1 API to its local nodes like a regular `Server`, while
+the main server only sees a single node: the relay.
+
+    main server <- WAN -> relay <- LAN -> render nodes
+
+Tasks are leased from the main server in batches and handed out
+locally; the leases of every task the relay holds are renewed in a
+single heartbeat; and results are queued in an outbox and forwarded
+upstream over the relay's own connection. Job files are mirrored into
+the relay's blob store the first time a job comes through, so every
+file crosses the WAN once; only the chunks the relay lacks are
+fetched, so revised files are cheap too. Local nodes download them
+from the relay with the usual `blob/` endpoints."""
+
+import hashlib
+import io
+import os
+import shutil
+import socket
+import threading
+import time
+
+from . import error
+from . import node
+from . import outbox
+from . import server
+
+class Relay(server.Server):
+
+    """A `server.Server` for local nodes that leases its tasks from the
+main server through `upstream`, a connected `client.Client` registered
+as a render node there. Up to `batch` tasks are kept ready for the
+local nodes at any time."""
+
+    # pylint: disable=too-many-instance-attributes
+
+    # Seconds to wait before asking upstream again when it had nothing
+    # for us, and that the main server may hold a task request until
+    # there's work.
+    IDLE_TIME = 5
+    WAIT_TIME = 30
+
+    # Missing chunks of a mirrored file are fetched in ranges of at
+    # most this many bytes.
+    MIRROR_RANGE_SIZE = 64 * 1024 * 1024
+
+    # Results are forwarded upstream by this many threads.
+    UPLOAD_THREADS = 2
+
+    def __init__(self, upstream, host='localhost', port=44363, batch=16):
+        super().__init__(host, port)
+
+        self.upstream = upstream
+        self.batch = batch
+
+        # Results waiting to be forwarded upstream.
+        self.outbox = outbox.Outbox(upstream, 'outbox', Relay.UPLOAD_THREADS)
+
+        # Maps the `task_id` of every task leased upstream but never
+        # handed to a local node to the `time.monotonic()` time it was
+        # leased. Tasks no local node takes within a lease time (because
+        # none of them is capable of it) are given back. Guarded by
+        # `lock`, like `jobs`.
+        self.pooled = {}
+
+        # Set whenever local nodes take tasks, so the pool is refilled.
+        self.tasks_taken = threading.Event()
+
+        self.threads = []
+
+        self.running = False
+
+    # ## Lifecycle
+
+    def start(self):
+        """Starts leasing, heartbeats and result forwarding in the
+background, then serves local nodes until interrupted."""
+
+        self.running = True
+
+        self.outbox.start()
+
+        for target, name in ((self.run_leaser, 'leaser'), (self.run_heartbeat, 'heartbeat')):
+            thread = threading.Thread(target=target, daemon=True, name=name)
+            thread.start()
+
+            self.threads.append(thread)
+
+        try:
+            super().start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stops the background threads. Results that haven't been
+forwarded yet stay in the outbox for the next run."""
+
+        self.running = False
+        self.tasks_taken.set()
+
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+        self.outbox.stop()
+
+        self.threads = []
+
+    # ## Local nodes
+
+    def get_next_tasks(self, parameters):
+        with self.lock:
+            tasks = super().get_next_tasks(parameters)
+
+            for task in tasks:
+                self.pooled.pop(task.task_id, None)
+
+        if tasks:
+            self.tasks_taken.set()
+
+        return tasks
+
+    def write_task_result(self, task, data, elapsed, peak_memory):
+        """Queues the result of `task` to be forwarded upstream."""
+
+        os.makedirs(self.outbox.directory, exist_ok=True)
+
+        extension = os.path.splitext(task.task_info.get_result_filename())[1]
+
+        filename = os.path.join(self.outbox.directory, task.task_id + extension)
+
+        with open(filename, 'wb') as handle:
+            handle.write(data)
+
+        self.outbox.add(task.job.job_id, task.task_id, filename, elapsed, peak_memory)
+
+    # ## Upstream
+
+    def get_upstream_capabilities(self):
+        """Returns the capabilities we report upstream on behalf of our
+active local nodes, or `None` if there are none. We're as capable as
+our most capable node; free memory is the sum over every node, so the
+main server hands us as many tasks as all of them can hold."""
+
+        active_nodes = self.nodes.get_active_nodes(time.time() - server.Server.ACTIVE_TIME)
+
+        if not active_nodes:
+            return None
+
+        capabilities = {
+            'hostname': socket.gethostname(),
+            'cores': max(render_node.cores for render_node in active_nodes),
+            'memory': max(render_node.memory for render_node in active_nodes),
+            'disk_free': shutil.disk_usage('.').free,
+            'blender_version': max((render_node.blender_version for render_node in active_nodes),
+                                   key=node.parse_version)
+        }
+
+        memory_free = sum(render_node.memory_free for render_node in active_nodes)
+
+        if memory_free:
+            capabilities['memory_free'] = memory_free
+
+        calibration = sum(render_node.calibration for render_node in active_nodes)
+
+        if calibration:
+            capabilities['calibration'] = calibration
+
+        return capabilities
+
+    def get_available_count(self):
+        """Returns the number of tasks waiting for a local node."""
+
+        with self.lock:
+            return sum(job.get_remaining_count() for job in self.jobs.get_jobs())
+
+    def lease(self, count, wait=0):
+        """Leases up to `count` tasks upstream (letting the main server
+wait up to `wait` seconds for work), mirrors their job files and makes
+them available to local nodes. Returns the number of tasks leased."""
+
+        capabilities = self.get_upstream_capabilities()
+
+        if not capabilities:
+            return 0
+
+        try:
+            tasks = self.upstream.api.request_next_tasks(self.upstream.node_id, capabilities, count, wait)
+        except error.Error as exception:
+            print('could not lease tasks upstream: ' + str(exception))
+            return 0
+
+        jobs = {task.job.job_id: task.job for task in tasks}
+
+        for job in jobs.values():
+            try:
+                self.mirror_job_file(job)
+            except error.Error as exception:
+                # Their leases run out upstream, and they're handed out
+                # again.
+                print('could not mirror file for job "' + job.job_id + '": ' + str(exception))
+
+                tasks = [task for task in tasks if task.job is not job]
+
+        self.add_tasks(tasks)
+
+        return len(tasks)
+
+    def add_tasks(self, tasks):
+        """Adds the `tasks` leased upstream to our jobs, for local nodes to
+take."""
+
+        with self.lock:
+            for task in tasks:
+                local_task = self.jobs.get_task(task.task_id)
+
+                # We gave it up, and got it back before it was pruned.
+                if local_task:
+                    local_task.set_ignore(False)
+                    self.pooled[task.task_id] = time.monotonic()
+                    continue
+
+                local_job = self.jobs.get_job(task.job_id)
+
+                if not local_job:
+                    local_job = task.job
+                    local_job.set_tasks([])
+
+                    self.jobs.jobs.append(local_job)
+                else:
+                    for info_type, estimate in task.job.memory_estimates.items():
+                        if estimate > local_job.memory_estimates.get(info_type, 0):
+                            local_job.memory_estimates[info_type] = estimate
+
+                local_job.add_task(task)
+
+                self.jobs.index_job(local_job)
+
+                self.pooled[task.task_id] = time.monotonic()
+
+            self.jobs.save()
+
+            self.dispatch_waiters()
+
+    def drop_task(self, task_id):
+        """Stops offering (and renewing) the task `task_id`; local nodes
+holding it are told to stop working on it right away if they have an
+event stream open, or at their next heartbeat."""
+
+        self.pooled.pop(task_id, None)
+
+        task = self.jobs.get_task(task_id)
+
+        if not task:
+            return
+
+        for node_id in task.nodes_working:
+            self.cancel_tasks(node_id, [task_id])
+
+        task.set_ignore(True)
+
+    def prune(self):
+        """Forgets finished and dropped tasks, and jobs left without any."""
+
+        with self.lock:
+            jobs = []
+
+            for job in self.jobs.get_jobs():
+                job.set_tasks([task for task in job.tasks if not task.complete and not task.ignore])
+
+                if job.tasks:
+                    jobs.append(job)
+
+            self.jobs.set_jobs(jobs)
+
+            self.jobs.save()
+
+    def run_leaser(self):
+        """Keeps `batch` tasks available to local nodes until the relay
+stops."""
+
+        while self.running:
+            self.tasks_taken.clear()
+
+            self.prune()
+
+            available = self.get_available_count()
+
+            wanted = self.batch - available
+
+            # Wait upstream for work only when our nodes have nothing
+            # left to take.
+            if wanted > 0 and self.lease(wanted, 0 if available else Relay.WAIT_TIME):
+                continue
+
+            self.tasks_taken.wait(Relay.IDLE_TIME)
+
+    def heartbeat(self):
+        """Renews the leases of every task we hold (including those whose
+results are still in the outbox) in a single request, and
+drops the tasks upstream says we lost, along with tasks no local node
+took in time."""
+
+        lease_time = self.upstream.get_lease_time()
+
+        with self.lock:
+            now = time.monotonic()
+
+            for task_id, leased in list(self.pooled.items()):
+                if now - leased > lease_time:
+                    self.drop_task(task_id)
+
+            task_ids = [task.task_id for job in self.jobs.get_jobs() for task in job.tasks
+                        if not task.complete and not task.ignore]
+
+        # Results still waiting to be forwarded keep their leases, so the
+        # tasks aren't handed to another node in the meantime.
+        held_task_ids = set(task_ids)
+
+        task_ids += [task_id for task_id in self.outbox.get_task_ids() if task_id not in held_task_ids]
+
+        if not task_ids:
+            return
+
+        try:
+            lost_task_ids = self.upstream.request_heartbeat(task_ids)
+        except error.Error as exception:
+            print('could not renew leases upstream: ' + str(exception))
+            return
+
+        with self.lock:
+            for task_id in lost_task_ids:
+                self.drop_task(task_id)
+
+    def run_heartbeat(self):
+        """Calls `heartbeat()` three times per lease time until the relay
+stops."""
+
+        last_heartbeat = time.monotonic()
+
+        while self.running:
+            time.sleep(1)
+
+            if time.monotonic() - last_heartbeat < self.upstream.get_lease_time() / 3:
+                continue
+
+            last_heartbeat = time.monotonic()
+
+            self.heartbeat()
+
+    # ## Job files
+
+    def mirror_job_file(self, job):
+        """Makes sure the work file of `job` is in our blob store, and
+points `job` at it. Jobs without a file hash are left alone; local
+nodes download their files from the job's `file_url` themselves."""
+
+        file_hash = job.job_info.get_file_hash().lower()
+
+        if not file_hash:
+            return
+
+        if not self.blobs.has_file(file_hash):
+            if job.job_info.file_url:
+                self.mirror_url(job, file_hash)
+            else:
+                self.mirror_blob(job, file_hash)
+
+        job.job_info.file_url = ''
+        job.job_info.file_hash = file_hash
+
+    def mirror_url(self, job, file_hash):
+        """Downloads the work file of `job` from its `file_url` (resuming
+an interrupted download) and stores it in our blob store."""
+
+        os.makedirs(self.blobs.directory, exist_ok=True)
+
+        partial_filename = os.path.join(self.blobs.directory, file_hash + '.part')
+
+        hasher = hashlib.sha256()
+
+        self.upstream.api.download_job_file(job, partial_filename, hasher)
+
+        if hasher.hexdigest() != file_hash:
+            os.remove(partial_filename)
+            raise error.Error('corrupt-file', 'Downloaded job file does not match its hash', job.job_info.file_url)
+
+        self.blobs.ingest(partial_filename)
+
+        os.remove(partial_filename)
+
+    def mirror_blob(self, job, file_hash):
+        """Copies the file `file_hash` from the main server's blob store
+into ours, fetching only the chunks we lack, in as few ranges as
+possible."""
+
+        manifest = self.upstream.api.request_file_manifest(file_hash)
+
+        missing = set(self.blobs.get_missing_chunks([chunk_hash for chunk_hash, _ in manifest['chunks']]))
+
+        url = self.upstream.api.get_job_file_url(job)
+
+        # Contiguous chunks to fetch in a single range, as
+        # `(hash, offset, size)`.
+        chunks = []
+
+        offset = 0
+
+        for chunk_hash, chunk_size in manifest['chunks']:
+            if chunk_hash in missing:
+                missing.discard(chunk_hash)
+
+                if chunks and (chunks[-1][1] + chunks[-1][2] != offset or
+                               offset + chunk_size - chunks[0][1] > Relay.MIRROR_RANGE_SIZE):
+                    self.fetch_chunks(url, chunks)
+                    chunks = []
+
+                chunks.append((chunk_hash, offset, chunk_size))
+
+            offset += chunk_size
+
+        self.fetch_chunks(url, chunks)
+
+        # Checks the whole file, and stores its manifest.
+        if self.blobs.commit([chunk_hash for chunk_hash, _ in manifest['chunks']])['hash'] != file_hash:
+            raise error.Error('corrupt-file', 'Mirrored job file does not match its hash', file_hash)
+
+    def fetch_chunks(self, url, chunks):
+        """Downloads the contiguous `chunks` (see `mirror_blob()`) of the
+file at `url` in one range, and stores them."""
+
+        if not chunks:
+            return
+
+        start = chunks[0][1]
+        end = chunks[-1][1] + chunks[-1][2]
+
+        output = io.BytesIO()
+
+        self.upstream.api.copy_range(url, start, end, output)
+
+        with output.getbuffer() as data:
+            for chunk_hash, offset, chunk_size in chunks:
+                self.blobs.put_chunk(chunk_hash, bytes(data[offset - start:offset - start + chunk_size]))
@@ -0,0 +1,393 @@
+"""Render execution. A `RenderExecutor` keeps long-lived render workers
+(see `render_worker.py`), one per loaded `.blend` file, and feeds them
+frames over a pipe; Blender's startup and file load cost is only paid
+again when a worker crashes or bloats."""
+
+import collections
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+from . import error
+from . import render_worker
+
+WORKER_SCRIPT = os.path.abspath(render_worker.__file__)
+
+if WORKER_SCRIPT.endswith('.pyc'):
+    WORKER_SCRIPT = WORKER_SCRIPT[:-1]
+
+def get_process_memory(pid):
+    """Returns the current resident memory of process `pid` in bytes, or
+`0` if it can't be determined on this platform."""
+
+    try:
+        with open('/proc/' + str(pid) + '/status', 'r') as handle:
+            for line in handle:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return 0
+
+# # `RenderResult`
+
+class RenderResult:
+
+    """The outcome of a single render."""
+
+    def __init__(self, output, elapsed=0, peak_memory=0):
+        # The rendered file.
+        self.output = output
+
+        # Fractional seconds the render took, not including any
+        # worker startup.
+        self.elapsed = elapsed
+
+        # Peak memory usage of the worker during this render, in
+        # bytes.
+        self.peak_memory = peak_memory
+
+# # `RenderWorker`
+
+class RenderWorker:
+
+    """A single worker process with `filename` loaded. `command` is the
+full command line used to start it."""
+
+    # Seconds to wait for a new worker to load its file.
+    START_TIMEOUT = 10 * 60
+
+    # Seconds between samples of the worker's memory while waiting for
+    # a reply.
+    SAMPLE_TIME = 0.1
+
+    def __init__(self, filename, command):
+        self.filename = filename
+        self.command = command
+
+        self.process = None
+
+        # Replies read from the worker's stdout, in order. `None` is
+        # queued when the worker exits.
+        self.replies = queue.Queue()
+
+        # Number of frames this worker has rendered.
+        self.render_count = 0
+
+        # `True` once `abort()` has been called.
+        self.aborted = False
+
+        # Highest resident memory of the worker sampled since the last
+        # request was sent, in bytes.
+        self.peak_memory = 0
+
+    def start(self):
+        """Starts the worker and waits until it has loaded its file.
+Raises `error.Error('render-error')` if it fails to start."""
+
+        try:
+            self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=subprocess.DEVNULL, universal_newlines=True, bufsize=1)
+        except OSError:
+            raise error.Error('render-error', 'Could not start render worker', ' '.join(self.command))
+
+        self.replies = queue.Queue()
+
+        threading.Thread(target=self.read_replies, args=(self.process, self.replies), daemon=True).start()
+
+        reply = self.get_reply(RenderWorker.START_TIMEOUT)
+
+        if reply.get('status') != 'ready':
+            self.stop()
+            raise error.Error('render-error', 'Render worker failed to start', self.filename)
+
+        return self
+
+    @staticmethod
+    def read_replies(process, replies):
+        """Reads replies from `process` into `replies` until it exits. Runs
+in its own thread; anything that isn't a reply is Blender's own output
+and is ignored."""
+
+        for line in process.stdout:
+            if not line.startswith(render_worker.MAGIC):
+                continue
+
+            try:
+                replies.put(json.loads(line[len(render_worker.MAGIC):]))
+            except ValueError:
+                continue
+
+        replies.put(None)
+
+    def get_reply(self, timeout=None):
+        """Returns the next reply from the worker. Raises
+`error.Error('render-error')` if it exits or doesn't reply within
+`timeout` seconds, in which case the worker is stopped. The worker's
+memory is sampled into `peak_memory` while waiting."""
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            wait = RenderWorker.SAMPLE_TIME
+
+            if deadline is not None:
+                wait = min(wait, max(0, deadline - time.monotonic()))
+
+            try:
+                reply = self.replies.get(timeout=wait)
+                break
+            except queue.Empty:
+                self.peak_memory = max(self.peak_memory, self.get_memory())
+
+                if deadline is not None and time.monotonic() >= deadline:
+                    reply = None
+                    break
+
+        if reply is None:
+            self.stop()
+
+            if self.aborted:
+                raise error.Error('render-aborted', 'Render was aborted', self.filename)
+
+            raise error.Error('render-error', 'Render worker crashed or timed out', self.filename)
+
+        return reply
+
+    def is_alive(self):
+        """Returns `True` if the worker process is running."""
+
+        return self.process is not None and self.process.poll() is None
+
+    def get_memory(self):
+        """Returns the current resident memory of the worker, in bytes."""
+
+        if not self.is_alive():
+            return 0
+
+        return get_process_memory(self.process.pid)
+
+    def render(self, request, timeout=None):
+        """Sends a single render `request` (see `render_worker.py`) and
+returns the reply once the frame has been written. The reply's
+`peak_memory` is replaced with the peak sampled during this request,
+since the worker can only report its lifetime peak. Raises
+`error.Error('render-error')` if the worker crashes, times out or
+reports an error."""
+
+        if not self.is_alive():
+            raise error.Error('render-error', 'Render worker is not running', self.filename)
+
+        self.peak_memory = self.get_memory()
+
+        try:
+            self.process.stdin.write(json.dumps(request) + '\n')
+            self.process.stdin.flush()
+        except (OSError, ValueError):
+            self.stop()
+            raise error.Error('render-error', 'Render worker crashed', self.filename)
+
+        reply = self.get_reply(timeout)
+
+        self.render_count += 1
+
+        if reply.get('status') != 'ok':
+            raise error.Error('render-error', reply.get('message', 'Render failed'), self.filename)
+
+        # Sampling isn't possible on platforms without `/proc`.
+        if self.peak_memory:
+            reply['peak_memory'] = self.peak_memory
+
+        return reply
+
+    def abort(self):
+        """Kills the worker from another thread; the render in progress, if
+any, fails with `error.Error('render-aborted')`."""
+
+        self.aborted = True
+
+        process = self.process
+
+        if process:
+            process.kill()
+
+    def stop(self):
+        """Stops the worker, killing it if it doesn't exit promptly."""
+
+        if not self.process:
+            return
+
+        process = self.process
+        self.process = None
+
+        try:
+            process.stdin.close()
+        except (OSError, ValueError):
+            pass
+
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+# # `RenderExecutor`
+
+class RenderExecutor:
+
+    """Renders tasks with long-lived workers, one per `.blend` file.
+
+`command` is a function that accepts a `.blend` filename and returns
+the command line for a worker with that file loaded; by default,
+Blender at `blender_path` running `render_worker.py`. A worker is
+restarted if it crashes, if its resident memory grows beyond
+`max_memory` bytes (`0` for no limit), or after `max_renders` frames
+(`0` for no limit). At most `max_workers` workers are kept; the least
+recently used one is stopped to make room. If `threads` is present,
+each render is limited to that many render threads."""
+
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, blender_path='blender', command=None, max_workers=1, max_memory=0, max_renders=0,
+                 threads=None):
+        self.blender_path = blender_path
+
+        self.threads = threads
+
+        self.command = command or self.get_blender_command
+
+        self.max_workers = max_workers
+        self.max_memory = max_memory
+        self.max_renders = max_renders
+
+        # Maps `.blend` filenames to `RenderWorker`s, least recently
+        # used first.
+        self.workers = collections.OrderedDict()
+
+        self.lock = threading.Lock()
+
+    def get_blender_command(self, filename):
+        """Returns the command line for a Blender worker with `filename` loaded."""
+
+        return [self.blender_path, '-b', filename, '--python', WORKER_SCRIPT, '--']
+
+    @staticmethod
+    def get_stub_command(filename):
+        """Returns the command line for a stand-in worker that renders
+placeholder images with a plain Python interpreter; useful for testing
+without Blender."""
+
+        return [sys.executable, WORKER_SCRIPT, filename, '--stub']
+
+    def get_worker(self, filename):
+        """Returns a running worker with `filename` loaded, starting one if
+necessary."""
+
+        with self.lock:
+            worker = self.workers.pop(filename, None)
+
+            if worker and not worker.is_alive():
+                worker = None
+
+            while len(self.workers) >= max(1, self.max_workers):
+                _, oldest_worker = self.workers.popitem(last=False)
+                oldest_worker.stop()
+
+        if not worker:
+            worker = RenderWorker(filename, self.command(filename)).start()
+
+        with self.lock:
+            self.workers[filename] = worker
+
+        return worker
+
+    def is_bloated(self, worker):
+        """Returns `True` if `worker` should be restarted before its next render."""
+
+        if self.max_renders and worker.render_count >= self.max_renders:
+            return True
+
+        if self.max_memory and worker.get_memory() > self.max_memory:
+            return True
+
+        return False
+
+    def render(self, filename, frame, output, resolution=None, samples=None, timeout=None, scale=None):
+        """Renders `frame` of the `.blend` file `filename` into `output`
+and returns a `RenderResult`. `resolution`, `samples` and `scale` (a
+fraction of the resolution) override the file's own settings, unless
+they're `None`. If the worker crashes, the render is
+retried once with a fresh worker. Raises `error.Error('render-error')`
+if it fails, or `error.Error('render-aborted')` if it's aborted (see
+`abort()`)."""
+
+        # pylint: disable=too-many-arguments
+
+        request = {
+            'frame': frame,
+            'output': os.path.abspath(output),
+            'resolution': resolution,
+            'scale': scale,
+            'samples': samples,
+            'threads': self.threads
+        }
+
+        for attempt in range(2):
+            worker = self.get_worker(filename)
+
+            try:
+                reply = worker.render(request, timeout)
+            except error.Error as exception:
+                if exception.code == 'render-aborted' or worker.is_alive() or attempt:
+                    raise
+
+                continue
+            finally:
+                if self.is_bloated(worker):
+                    self.stop_worker(filename)
+
+            return RenderResult(output, reply.get('elapsed', 0), reply.get('peak_memory', 0))
+
+    def render_task(self, task, filename, output, timeout=None):
+        """Renders the render `task` (see `task.TaskInfoRender`) of the job
+whose `.blend` file is `filename` into `output`. Returns a
+`RenderResult`."""
+
+        task_info = task.task_info
+
+        return self.render(filename, task_info.frame, output, task_info.resolution, task_info.samples, timeout,
+                           task_info.scale)
+
+    def abort(self, filename):
+        """Aborts the render in progress with `filename` loaded, if any,
+stopping its worker."""
+
+        with self.lock:
+            worker = self.workers.get(filename)
+
+        if worker:
+            worker.abort()
+
+    def stop_worker(self, filename):
+        """Stops the worker with `filename` loaded, if any."""
+
+        with self.lock:
+            worker = self.workers.pop(filename, None)
+
+        if worker:
+            worker.stop()
+
+    def stop(self):
+        """Stops every worker."""
+
+        with self.lock:
+            workers = list(self.workers.values())
+            self.workers.clear()
+
+        for worker in workers:
+            worker.stop()
@@ -0,0 +1,207 @@
+"""Render worker script. This runs *inside* Blender, with a single
+`.blend` file loaded, and renders frames on request so Blender's
+startup and file load cost is paid once per file instead of once per
+frame:
+
+    blender -b file.blend --python render_worker.py --
+
+It reads one JSON request per line on stdin and writes one JSON reply
+per line on stdout, prefixed with `MAGIC` (Blender writes plenty of its
+own output to stdout). Requests look like:
+
+    {"frame": 1, "output": "/tmp/1.png", "resolution": null, "scale": 0.25, "samples": 16, "threads": 8}
+
+`resolution`, `scale` (a fraction of the resolution), `samples` and
+`threads` are optional; the file's own settings are used for those
+that are missing or `null`.
+
+and replies like:
+
+    {"status": "ok", "elapsed": 12.5, "peak_memory": 2147483648}
+
+On startup, a `{"status": "ready"}` reply is written. Passing `--stub`
+after `--` (or running this file with a plain Python interpreter and
+`--stub`) renders placeholder images instead, for testing without
+Blender. This file must not import anything from `blenderfarm`, since
+Blender runs it as a standalone script."""
+
+import json
+import os
+import resource
+import struct
+import sys
+import time
+import zlib
+
+MAGIC = 'BLENDERFARM:'
+
+# Resolution of the placeholder images `render_stub()` writes when the
+# request doesn't set one.
+STUB_RESOLUTION = [64, 36]
+
+def reply(data):
+    """Writes the reply `data` to stdout."""
+
+    sys.stdout.write(MAGIC + json.dumps(data) + '\n')
+    sys.stdout.flush()
+
+def get_peak_memory():
+    """Returns the peak memory usage of this process over its whole
+lifetime, in bytes. `RenderWorker` replaces this with a per-render peak
+where it can sample the worker's memory itself."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # `ru_maxrss` is in kilobytes on Linux, but in bytes on macOS.
+    if sys.platform == 'darwin':
+        return peak
+
+    return peak * 1024
+
+# The loaded file's own render settings, saved by `render_blender()`
+# before its first request changes them.
+_FILE_SETTINGS = {}
+
+def get_scene_settings(scene):
+    """Returns the render settings of `scene` that requests override."""
+
+    render = scene.render
+
+    settings = {
+        'resolution': (render.resolution_x, render.resolution_y),
+        'resolution_percentage': render.resolution_percentage,
+        'threads_mode': render.threads_mode,
+        'threads': render.threads
+    }
+
+    if hasattr(scene, 'cycles'):
+        settings['cycles_samples'] = scene.cycles.samples
+
+    if hasattr(scene, 'eevee'):
+        settings['eevee_samples'] = scene.eevee.taa_render_samples
+
+    return settings
+
+def set_scene_settings(scene, settings):
+    """Puts back render settings returned by `get_scene_settings()`."""
+
+    render = scene.render
+
+    render.resolution_x, render.resolution_y = settings['resolution']
+    render.resolution_percentage = settings['resolution_percentage']
+    render.threads_mode = settings['threads_mode']
+    render.threads = settings['threads']
+
+    if 'cycles_samples' in settings:
+        scene.cycles.samples = settings['cycles_samples']
+
+    if 'eevee_samples' in settings:
+        scene.eevee.taa_render_samples = settings['eevee_samples']
+
+def render_blender(request):
+    """Renders `request['frame']` of the loaded file with Blender. The
+file's own settings are restored first, so each request's overrides
+apply to them rather than to whatever the previous request left."""
+
+    import bpy # pylint: disable=import-error
+
+    scene = bpy.context.scene
+    render = scene.render
+
+    if not _FILE_SETTINGS:
+        _FILE_SETTINGS.update(get_scene_settings(scene))
+
+    set_scene_settings(scene, _FILE_SETTINGS)
+
+    if request.get('resolution'):
+        render.resolution_x, render.resolution_y = request['resolution']
+        render.resolution_percentage = 100
+
+    if request.get('scale'):
+        render.resolution_percentage = max(1, int(round(render.resolution_percentage * request['scale'])))
+
+    if request.get('threads'):
+        render.threads_mode = 'FIXED'
+        render.threads = request['threads']
+
+    if request.get('samples'):
+        if render.engine == 'CYCLES':
+            scene.cycles.samples = request['samples']
+        elif hasattr(scene, 'eevee'):
+            scene.eevee.taa_render_samples = request['samples']
+
+    render.image_settings.file_format = 'PNG'
+    render.use_file_extension = False
+    render.filepath = request['output']
+
+    scene.frame_set(request['frame'])
+
+    bpy.ops.render.render(write_still=True)
+
+def render_stub(request):
+    """Writes a blank placeholder PNG of the requested resolution (or
+of `STUB_RESOLUTION`, standing in for the file's own) to
+`request['output']`. If the `BLENDERFARM_STUB_TIME` environment
+variable is set, waits that many seconds first, like a real render."""
+
+    time.sleep(float(os.environ.get('BLENDERFARM_STUB_TIME', 0)))
+
+    width, height = request.get('resolution') or STUB_RESOLUTION
+
+    if request.get('scale'):
+        width, height = [max(1, int(size * request['scale'])) for size in (width, height)]
+
+    def chunk(chunk_type, data):
+        return (struct.pack('>I', len(data)) + chunk_type + data +
+                struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    rows = b''.join(b'\x00' + b'\x00' * 3 * width for _ in range(height))
+
+    with open(request['output'], 'wb') as handle:
+        handle.write(b'\x89PNG\r\n\x1a\n')
+        handle.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        handle.write(chunk(b'IDAT', zlib.compress(rows)))
+        handle.write(chunk(b'IEND', b''))
+
+def run():
+    """Reads and performs render requests until stdin is closed."""
+
+    arguments = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+
+    render_function = render_blender
+
+    if '--stub' in arguments:
+        render_function = render_stub
+
+    reply({'status': 'ready'})
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+
+        start_time = time.monotonic()
+
+        try:
+            request = json.loads(line)
+
+            output_directory = os.path.dirname(request['output'])
+
+            if output_directory and not os.path.isdir(output_directory):
+                os.makedirs(output_directory, exist_ok=True)
+
+            render_function(request)
+        except Exception as exception: # pylint: disable=broad-except
+            reply({
+                'status': 'error',
+                'message': str(exception)
+            })
+            continue
+
+        reply({
+            'status': 'ok',
+            'elapsed': time.monotonic() - start_time,
+            'peak_memory': get_peak_memory()
+        })
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,543 @@
+"""Render node runner. A `NodeRunner` turns a `client.Client` into a
+render node with several render slots, so big machines can render
+several frames at once.
+
+Work is pipelined: tasks are leased and their job files downloaded
+ahead of time, while the slots render, so the network isn't idle
+during renders and the slots aren't idle during transfers:
+
+    lease -> download -> render (one per slot) -> outbox -> upload
+"""
+
+import os
+import queue
+import random
+import threading
+import time
+
+from . import error
+from . import outbox
+from . import render
+
+class NodeRunner:
+
+    """Runs render tasks in `slots` render slots at once (`0` picks a
+count from our cores and memory). Each slot has its own
+`render.RenderExecutor`, and so its own render worker process; `command`
+is passed on to them (see `render.RenderExecutor`). The slots share the
+client's download cache, a single `outbox.Outbox` that uploads results
+in the background, and the client's single connection to the server.
+A slot is free again as soon as its frame is in the outbox.
+
+Up to `lookahead` tasks beyond one per slot are leased and downloaded
+in advance. The lookahead is bounded by the lease time: no more tasks
+are held than the slots can start rendering before their leases would
+run out, based on how long renders have taken so far. Leases of held
+tasks are renewed with heartbeats."""
+
+    # pylint: disable=too-many-instance-attributes
+
+    # Automatic slot sizing: one slot per this many cores and this much
+    # memory (in bytes), whichever allows fewer slots.
+    CORES_PER_SLOT = 8
+    MEMORY_PER_SLOT = 8 * 1024 * 1024 * 1024
+
+    # Seconds to wait before asking the server again when it had
+    # nothing for us.
+    IDLE_TIME = 5
+
+    # Seconds the server may hold a task request until there's work.
+    # Heartbeats are sent from their own thread, so this only bounds
+    # how long a poll stays open before we ask again.
+    WAIT_TIME = 30
+
+    # Number of job files downloaded at once.
+    DOWNLOAD_THREADS = 2
+
+    def __init__(self, client, slots=0, command=None, lookahead=1):
+        self.client = client
+
+        self.slot_count = slots or self.get_auto_slot_count()
+
+        self.command = command
+
+        self.lookahead = lookahead
+
+        # Leased tasks waiting for their job file to be downloaded.
+        self.leased = queue.Queue()
+
+        # Tasks with their job file downloaded, waiting for a free slot.
+        self.ready = queue.Queue()
+
+        # Rendered results waiting to be uploaded.
+        self.outbox = outbox.Outbox(client, client.outbox_directory)
+        self.outbox.on_remove = self.uploaded
+
+        # Maps the `task_id` of every task we hold a lease on, from
+        # leasing until its render is finished, to the task.
+        self.held = {}
+
+        # IDs of rendered tasks whose results are in the outbox. Their
+        # leases are renewed along with those of held tasks until the
+        # upload is done, so they're not handed to another node in the
+        # meantime.
+        self.uploading = set()
+
+        # IDs of held tasks the server told us we lost; these are
+        # dropped instead of being rendered, and their renders are
+        # aborted if they're in progress.
+        self.lost = set()
+
+        # Maps the `task_id` of every task being rendered to the
+        # `render.RenderExecutor` rendering it.
+        self.rendering = {}
+
+        # Maps the `task_id` of every held task that isn't being
+        # rendered yet to the memory (in bytes) it'll need; their total
+        # is reported to the server as reserved (see
+        # `client.Client.reserved_memory`).
+        self.reserved = {}
+
+        # IDs of held tasks whose job file is pinned in the cache, so
+        # it isn't evicted before they're rendered.
+        self.pinned = set()
+
+        self.lock = threading.Lock()
+
+        # Set whenever a held task is finished or dropped.
+        self.task_done = threading.Event()
+
+        # Moving average of render times, in seconds; `None` until the
+        # first render finishes.
+        self.average_elapsed = None
+
+        # Tasks are offered to us over an event stream if the server
+        # supports it (`use_events`); while it's open (`streaming`), we
+        # neither poll for tasks nor send heartbeats, since the server
+        # asks us about our leases over the stream.
+        self.use_events = True
+        self.streaming = False
+
+        # Maps job file keys to `(lock, users)`: the lock held while
+        # downloading them, so the same file is never downloaded twice at
+        # once, and the number of threads using it. Entries are removed
+        # once no thread uses them.
+        self.download_locks = {}
+        self.download_locks_lock = threading.Lock()
+
+        self.executors = []
+        self.threads = []
+
+        self.running = False
+
+    def get_auto_slot_count(self):
+        """Returns the number of slots this machine can comfortably run."""
+
+        cores = os.cpu_count() or 1
+        memory = self.client.get_memory()
+
+        slots = cores // NodeRunner.CORES_PER_SLOT
+
+        if memory:
+            slots = min(slots, memory // NodeRunner.MEMORY_PER_SLOT)
+
+        return max(1, slots)
+
+    def get_lookahead(self):
+        """Returns the number of tasks to hold beyond one per slot: at most
+`lookahead`, and no more than the slots can start rendering before the
+lease time runs out."""
+
+        if not self.average_elapsed:
+            return self.lookahead
+
+        # A task queued behind `n` others waits about `n / slots`
+        # renders before it starts.
+        renders_per_lease = self.client.get_lease_time() / self.average_elapsed
+
+        return max(0, min(self.lookahead, int(self.slot_count * (renders_per_lease - 1))))
+
+    def get_held_count(self):
+        """Returns the number of tasks we currently hold leases for."""
+
+        with self.lock:
+            return len(self.held)
+
+    def release(self, task):
+        """Stops holding `task`; called when its render finishes or fails,
+or when it's dropped."""
+
+        with self.lock:
+            self.held.pop(task.task_id, None)
+            self.lost.discard(task.task_id)
+
+            self.unreserve(task)
+
+            pinned = task.task_id in self.pinned
+            self.pinned.discard(task.task_id)
+
+        if pinned:
+            self.client.release_job_file(task.job)
+
+        self.task_done.set()
+
+    def uploaded(self, task_id):
+        """Stops renewing the lease of `task_id` once its result has been
+uploaded (or discarded); called by the outbox."""
+
+        with self.lock:
+            self.uploading.discard(task_id)
+
+    def get_leased_task_ids(self):
+        """Returns the IDs of the tasks whose leases we keep renewing: held
+tasks, and rendered ones whose results are still in the outbox. Must
+be called with `lock` held."""
+
+        return list(self.held) + [task_id for task_id in self.uploading if task_id not in self.held]
+
+    def mark_lost(self, task_ids):
+        """Records that the server told us we no longer hold `task_ids`,
+aborting their renders if they're in progress."""
+
+        with self.lock:
+            self.uploading.difference_update(task_ids)
+
+            lost_task_ids = [task_id for task_id in task_ids if task_id in self.held]
+
+            self.lost.update(lost_task_ids)
+
+            aborted = [(self.rendering[task_id], self.held[task_id]) for task_id in lost_task_ids
+                       if task_id in self.rendering]
+
+        for executor, task in aborted:
+            print('aborting task "' + task.task_id + '"')
+            executor.abort(self.client.get_job_filename(task.job))
+
+    def is_lost(self, task):
+        """Returns `True` if the server told us we no longer hold `task`."""
+
+        with self.lock:
+            return task.task_id in self.lost
+
+    # ## Lifecycle
+
+    def start(self):
+        """Starts the render slots, downloaders, outbox and heartbeat, and
+the peer server if the client has a `peer_port`."""
+
+        self.running = True
+
+        if self.client.peer_port:
+            self.client.start_peer_server()
+
+        self.outbox.start()
+
+        # Results left over from a previous run may still be leased to us.
+        with self.lock:
+            self.uploading.update(self.outbox.get_task_ids())
+
+        threads = max(1, (os.cpu_count() or 1) // self.slot_count)
+
+        for index in range(self.slot_count):
+            executor = render.RenderExecutor(self.client.blender_path, self.command, threads=threads)
+
+            self.executors.append(executor)
+            self.threads.append(threading.Thread(target=self.run_slot, args=(executor,), daemon=True,
+                                                 name='slot-' + str(index)))
+
+        for index in range(NodeRunner.DOWNLOAD_THREADS):
+            self.threads.append(threading.Thread(target=self.run_downloader, daemon=True,
+                                                 name='downloader-' + str(index)))
+
+        self.threads.append(threading.Thread(target=self.run_heartbeat, daemon=True, name='heartbeat'))
+
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        """Starts the runner and leases tasks until `stop()` is called (or
+until interrupted with `^C`)."""
+
+        self.start()
+
+        print('running ' + str(self.slot_count) + ' render slot(s)')
+
+        try:
+            while self.running:
+                if self.use_events:
+                    self.run_events()
+                    continue
+
+                self.task_done.clear()
+
+                wanted = self.slot_count + self.get_lookahead() - self.get_held_count()
+
+                if wanted <= 0:
+                    self.task_done.wait(NodeRunner.IDLE_TIME)
+                    continue
+
+                started = time.monotonic()
+
+                if not self.lease(wanted, NodeRunner.WAIT_TIME):
+                    # Servers that can't wait for work answer right away.
+                    time.sleep(max(0, NodeRunner.IDLE_TIME - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stops leasing new tasks and stops every render worker. Results
+that haven't been uploaded yet stay in the outbox for the next run."""
+
+        self.running = False
+
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+        for executor in self.executors:
+            executor.stop()
+
+        self.outbox.stop()
+
+        self.client.stop_peer_server()
+
+        self.threads = []
+        self.executors = []
+
+    # ## Stages
+
+    def lease(self, count, wait=0):
+        """Leases up to `count` tasks from the server and queues them for
+download, letting the server wait up to `wait` seconds for work.
+Returns the number of tasks leased."""
+
+        try:
+            tasks = self.client.request_next_tasks(count, wait)
+        except error.Error as exception:
+            print('could not lease tasks: ' + str(exception))
+            return 0
+
+        self.hold(tasks)
+
+        return len(tasks)
+
+    def hold(self, tasks):
+        """Queues the newly leased `tasks` for download."""
+
+        for task in tasks:
+            with self.lock:
+                self.held[task.task_id] = task
+
+                self.reserved[task.task_id] = task.job.get_required_memory(task)
+                self.client.reserved_memory = sum(self.reserved.values())
+
+            self.leased.put(task)
+
+    def unreserve(self, task):
+        """Stops reserving memory for `task`, once it starts rendering (its
+usage then shows up in the free memory itself) or is dropped. Must be
+called with `lock` held."""
+
+        if self.reserved.pop(task.task_id, None) is not None:
+            self.client.reserved_memory = sum(self.reserved.values())
+
+    # ## Event stream
+
+    def get_wanted_count(self):
+        """Returns the number of tasks we want to hold at once."""
+
+        return self.slot_count + self.get_lookahead()
+
+    def run_events(self):
+        """Opens our event stream (see `events.py`) and handles its events
+until it drops. Falls back to polling for good if the server doesn't
+support event streams."""
+
+        with self.lock:
+            held_task_ids = self.get_leased_task_ids()
+
+        delay = NodeRunner.IDLE_TIME
+
+        try:
+            for event_id, event_type, data in self.client.request_events(self.get_wanted_count(), held_task_ids):
+                self.streaming = True
+
+                if not self.running:
+                    return
+
+                self.handle_event(event_id, event_type, data)
+        except error.Error as exception:
+            if exception.code == 'http-error':
+                print('server does not support event streams; polling for tasks')
+                self.use_events = False
+                return
+
+            # An overloaded server says when to come back.
+            if exception.code == 'overloaded':
+                delay = max(delay, float(exception.context) + random.uniform(0, 1))
+
+            print('lost event stream: ' + str(exception))
+        finally:
+            self.streaming = False
+
+        if self.running:
+            time.sleep(delay)
+
+    def handle_event(self, event_id, event_type, data):
+        """Handles a single event from our event stream."""
+
+        if event_type == 'offer':
+            tasks = self.client.api.parse_tasks(data['tasks'])
+
+            self.acknowledge(event_id)
+            self.hold(tasks)
+        elif event_type == 'renew':
+            with self.lock:
+                held_task_ids = [task_id for task_id in self.get_leased_task_ids() if task_id not in self.lost]
+
+            self.acknowledge(event_id, held_task_ids)
+        elif event_type == 'cancel':
+            self.mark_lost(data['task_ids'])
+
+    def acknowledge(self, event_id, held_task_ids=None):
+        """Acknowledges the event `event_id`, telling the server how many
+tasks we want and, for `renew` events, which ones we hold."""
+
+        try:
+            self.client.request_ack(event_id, held_task_ids, self.get_wanted_count())
+        except error.Error as exception:
+            print('could not acknowledge event ' + str(event_id) + ': ' + str(exception))
+
+    def download(self, task):
+        """Downloads the job file for `task` into the shared cache and pins
+it there, unless it's there already or another thread is downloading
+it. Returns the filename."""
+
+        key = task.job.get_file_key()
+
+        with self.download_locks_lock:
+            lock, users = self.download_locks.get(key, (None, 0))
+            lock = lock or threading.Lock()
+
+            self.download_locks[key] = (lock, users + 1)
+
+        try:
+            with lock:
+                filename = self.client.download_job_file(task.job, pin=True)
+        finally:
+            with self.download_locks_lock:
+                lock, users = self.download_locks.pop(key)
+
+                if users > 1:
+                    self.download_locks[key] = (lock, users - 1)
+
+        with self.lock:
+            self.pinned.add(task.task_id)
+
+        return filename
+
+    def run_downloader(self):
+        """Downloads job files of leased tasks, then hands the tasks to the
+slots, until the runner stops."""
+
+        while self.running:
+            try:
+                task = self.leased.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            if self.is_lost(task):
+                self.release(task)
+                continue
+
+            try:
+                self.download(task)
+            except error.Error as exception:
+                print('could not download file for task "' + task.task_id + '": ' + str(exception))
+                self.release(task)
+                continue
+
+            self.ready.put(task)
+
+    def run_slot(self, executor):
+        """Renders ready tasks one at a time until the runner stops."""
+
+        while self.running:
+            try:
+                task = self.ready.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            if self.is_lost(task):
+                self.release(task)
+                continue
+
+            with self.lock:
+                self.rendering[task.task_id] = executor
+
+                self.unreserve(task)
+
+            try:
+                result = executor.render_task(task, self.client.get_job_filename(task.job),
+                                              self.client.get_result_filename(task))
+            except error.Error as exception:
+                if exception.code != 'render-aborted':
+                    print('task "' + task.task_id + '" failed: ' + str(exception))
+
+                self.release(task)
+                continue
+            finally:
+                with self.lock:
+                    self.rendering.pop(task.task_id, None)
+
+            with self.lock:
+                if self.average_elapsed is None:
+                    self.average_elapsed = result.elapsed
+                else:
+                    self.average_elapsed += (result.elapsed - self.average_elapsed) * 0.2
+
+                # Its lease is renewed until the upload is done.
+                self.uploading.add(task.task_id)
+
+            try:
+                self.outbox.put(task, result)
+            except OSError as exception:
+                print('could not store result of task "' + task.task_id + '": ' + str(exception))
+
+                self.uploaded(task.task_id)
+
+            self.release(task)
+
+    def run_heartbeat(self):
+        """Renews the leases of held tasks and of results waiting in the
+outbox, three times per lease time, until the runner stops."""
+
+        last_heartbeat = time.monotonic()
+
+        while self.running:
+            time.sleep(1)
+
+            if self.streaming:
+                last_heartbeat = time.monotonic()
+                continue
+
+            if time.monotonic() - last_heartbeat < self.client.get_lease_time() / 3:
+                continue
+
+            last_heartbeat = time.monotonic()
+
+            with self.lock:
+                task_ids = self.get_leased_task_ids()
+
+            if not task_ids:
+                continue
+
+            try:
+                lost_task_ids = self.client.request_heartbeat(task_ids)
+            except error.Error as exception:
+                print('could not renew leases: ' + str(exception))
+                continue
+
+            self.mark_lost(lost_task_ids)
@@ -3,10 +3,21 @@
 
 import json
 
+from . import wire
+
 class Serializable:
 
     """A class which can be serialized and deserialized."""
 
+    def get_revision(self, *args): # pylint: disable=no-self-use
+        """Returns a value that changes whenever the output of
+`serialize(*args)` does, so its encoding can be reused until then;
+`None` (the default) means it's never reused."""
+
+        _ = args
+
+        return None
+
     def unserialize(self, data):
         """Unserializes the data returned by the `serialize()` method."""
 
@@ -29,3 +40,52 @@ class Serializable:
 method. Inverse of the `serialize_json()` method."""
 
         self.unserialize(json.loads(json_data))
+
+    def serialize_wire(self, *args):
+        """Returns the binary wire encoding (see `wire.py`) of
+`serialize(*args)`. If `get_revision()` hasn't changed since the last
+call with the same `args`, the last encoding is returned as is."""
+
+        revision = self.get_revision(*args)
+
+        cached = getattr(self, '_wire_cache', None)
+
+        if revision is not None and cached and cached[0] == (revision, args):
+            return cached[1]
+
+        data = wire.dumps(self.serialize(*args))
+
+        if revision is not None:
+            self._wire_cache = ((revision, args), data) # pylint: disable=attribute-defined-outside-init
+
+        return data
+
+class Deferred:
+
+    """Stands in for `serializable.serialize(*args)` in a response, so the
+response's encoder serializes it: JSON through `serialize()`, and the
+binary wire encoding through `serialize_wire()`, which reuses the
+object's encoding across responses."""
+
+    def __init__(self, serializable, *args):
+        self.serializable = serializable
+        self.args = args
+
+    def serialize(self):
+        """Returns `serializable.serialize(*args)`."""
+
+        return self.serializable.serialize(*self.args)
+
+    def serialize_wire(self):
+        """Returns `serializable.serialize_wire(*args)`."""
+
+        return self.serializable.serialize_wire(*self.args)
+
+def serialize_default(value):
+    """`default` function for `json.dumps()`, which serializes `Deferred`
+and `Serializable` values."""
+
+    if hasattr(value, 'serialize'):
+        return value.serialize()
+
+    raise TypeError('cannot serialize ' + type(value).__name__)
@@ -1,7 +1,11 @@
 
 """Blenderfarm Server implementation."""
 
+import collections
+import heapq
 import json
+import random
+import threading
 import time
 import traceback
 
@@ -9,14 +13,143 @@ from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 
 from . import api
+from . import blob
+from . import compression
 from . import db
+from . import events
 from . import job
+from . import node
+from . import serializable
+from . import tracker
+from . import version
+from . import wire
+
+class RequestBody:
+
+    """The body of a request, `length` bytes long, read from the file
+object `rfile`. Routes read it in place of the connection itself, so
+reads can't run into the next request on a persistent connection."""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        """Reads up to `size` bytes; by default, the rest of the body."""
+
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.rfile.read(size)
+
+        self.remaining -= len(data)
+
+        if len(data) < size:
+            raise OSError('connection closed during request body')
+
+        return data
+
+    def drain(self, max_size):
+        """Reads and discards what's left of the body, if that's at most
+`max_size` bytes. Returns `True` if the body was read to its end."""
+
+        if self.remaining > max_size:
+            return False
+
+        while self.remaining:
+            self.read(min(self.remaining, 64 * 1024))
+
+        return True
 
 class BlenderfarmHTTPServerRequestHandler(BaseHTTPRequestHandler):
 
     """Blenderfarm HTTP request handler. This has to manage the different
 API versions and provide generic fallbacks in case the APIs mess
-up. This class should always catch every exception."""
+up. This class should always catch every exception.
+
+Connections are persistent (HTTP/1.1): every response has a
+`Content-Length`, except event streams, which close the connection
+when they end."""
+
+    protocol_version = 'HTTP/1.1'
+
+    # Seconds a persistent connection may sit idle between requests
+    # before we close it.
+    IDLE_TIME = 30
+
+    # Seconds we wait for a request to make progress (for the next
+    # block of an upload, say) once it has started.
+    REQUEST_TIME = 5 * 60
+
+    # A request body this big (in bytes) that the route left unread is
+    # read to its end, so the connection can be reused; the connection
+    # is closed after bigger ones.
+    MAX_DRAIN = 1024 * 1024
+
+    # Requests turned away under load are told to retry in
+    # `RETRY_TIME` seconds, plus up to `RETRY_JITTER`, so a farm of
+    # nodes doesn't come back all at once.
+    RETRY_TIME = 2
+    RETRY_JITTER = 4
+
+    @staticmethod
+    def get_retry_after():
+        """Returns the seconds a client turned away should wait before
+retrying."""
+
+        return random.randint(BlenderfarmHTTPServerRequestHandler.RETRY_TIME,
+                              BlenderfarmHTTPServerRequestHandler.RETRY_TIME +
+                              BlenderfarmHTTPServerRequestHandler.RETRY_JITTER)
+
+    def setup(self):
+        super().setup()
+
+        # `True` while this connection holds one of the server's
+        # keep-alive slots (see `ThreadedHTTPServer`).
+        self.keepalive = False
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            if self.keepalive:
+                self.server.release_keepalive()
+                self.keepalive = False
+
+    def handle_one_request(self):
+        """Waits up to `IDLE_TIME` seconds for the next request on the
+connection, then handles it."""
+
+        self.connection.settimeout(self.IDLE_TIME)
+
+        super().handle_one_request()
+
+    def parse_request(self):
+        # The request line is in, so the connection isn't idle anymore.
+        self.connection.settimeout(self.REQUEST_TIME)
+
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        """Sends the status line and common headers; asks the client to
+close the connection once the server's keep-alive slots are taken.
+Responses that close the connection (like event streams) give up the
+connection's slot right away instead of holding it until they end."""
+
+        super().send_response(code, message)
+
+        if self.close_connection:
+            if self.keepalive:
+                self.server.release_keepalive()
+                self.keepalive = False
+
+            return
+
+        if not self.keepalive:
+            self.keepalive = self.server.acquire_keepalive()
+
+        if not self.keepalive:
+            self.send_header('Connection', 'close')
 
     def send_text(self, text_data):
         """This method encodes `text_data` as UTF-8, then responds with it."""
@@ -25,29 +158,82 @@ up. This class should always catch every exception."""
 
     def send_json(self, json_data):
         """This method automatically converts the Python object into a JSON
-string, then encodes it as UTF-8 and responds with it."""
+string, then encodes it as UTF-8 and responds with it. `Deferred`
+values (see `serializable.py`) are serialized on the way."""
 
-        self.send_text(json.dumps(json_data))
+        self.send_text(json.dumps(json_data, default=serializable.serialize_default))
 
     def respond_json(self, json_data, status=200):
-        """Sets the HTTP status code and calls `send_json()`."""
+        """Sets the HTTP status code and responds with `json_data` as JSON;
+or, if the request's `Accept` header asks for it, in the binary wire
+encoding instead (see `wire.py`). Large responses are compressed if
+the request's `Accept-Encoding` header allows it (see
+`compression.py`)."""
+
+        if wire.accepts(self.headers.get('Accept')):
+            content_type = wire.CONTENT_TYPE
+            body = wire.dumps(json_data)
+        else:
+            content_type = 'application/json'
+            body = bytes(json.dumps(json_data, default=serializable.serialize_default), 'utf8')
+
+        encoding = None
+
+        if len(body) >= compression.MIN_SIZE:
+            encoding = compression.choose_encoding(self.headers.get('Accept-Encoding'))
+
+        if encoding:
+            body = compression.compress(body, encoding)
 
         self.send_response(status)
-        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+
+        self.send_header('Vary', 'Accept, Accept-Encoding')
         self.end_headers()
 
-        self.send_json(json_data)
+        if self.command != 'HEAD':
+            self.wfile.write(body)
 
         return
 
+    def respond_overloaded(self, status=429):
+        """Turns the request away with `status` (`429` or `503`) and a
+`Retry-After` header, without touching the server lock."""
+
+        retry_after = self.get_retry_after()
+
+        body = bytes(json.dumps({
+            'status': 'error',
+            'code': 'overloaded',
+            'message': 'Server is busy, retry later',
+            'context': str(retry_after)
+        }), 'utf8')
+
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Retry-After', str(retry_after))
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
     def respond_error(self, status):
         """Responds with an HTTP error."""
 
+        body = bytes(str(status), 'utf8')
+
         self.send_response(status)
         self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
 
-        self.send_text(str(status))
+        if self.command != 'HEAD':
+            self.wfile.write(body)
 
         return
 
@@ -69,7 +255,40 @@ element."""
 
     # pylint: disable=invalid-name
     def do_method(self, method):
-        """Responds to `method` requests."""
+        """Responds to `method` requests. The route reads the request body
+from `rfile`, which stands for a `RequestBody` until it's done."""
+
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            # We can't tell where a chunked body ends.
+            self.close_connection = True
+            self.respond_error(411)
+            return
+
+        try:
+            length = max(0, int(self.headers.get('Content-Length') or 0))
+        except ValueError:
+            self.close_connection = True
+            self.respond_error(400)
+            return
+
+        connection_rfile = self.rfile
+
+        self.rfile = RequestBody(connection_rfile, length)
+
+        try:
+            self.handle_route(method)
+        finally:
+            body = self.rfile
+            self.rfile = connection_rfile
+
+        try:
+            if not body.drain(self.MAX_DRAIN):
+                self.close_connection = True
+        except OSError:
+            self.close_connection = True
+
+    def handle_route(self, method):
+        """Hands the request to its route."""
 
         try:
 
@@ -89,24 +308,48 @@ element."""
 
             api_handler = self.api_handlers[api_version]
 
-            # `API.get_route()` should *always* return a valid route; if
-            # the requested route is missing, it should return its default
-            # error handler route.
-            route_handler = api_handler.get_route(method, path)
+            # `API.get_context()` should *always* find a route; if the
+            # requested route is missing, it falls back to its default
+            # error handler route. Routes read the parsed request from
+            # `context`.
+            self.context = api_handler.get_context(method, path)
+
+            route = self.context.route
 
             # If the API handler has truly messed up, fall back to our
             # generic HTTP error response and respond with 500.
-            if not route_handler:
+            if not route:
                 self.respond_error(500)
                 return
 
-            # `request, response`.
-            route_handler(self, self)
+            # Routes that are already as busy as they may be turn
+            # requests away, rather than queue them behind the others.
+            if not api_handler.admit(route):
+                self.respond_overloaded(429)
+                return
+
+            # `request, response`. Requests are handled in threads; those
+            # that touch shared state hold the server lock.
+            try:
+                if route.locked:
+                    with api_handler.server.lock:
+                        route.handler(self, self)
+                else:
+                    route.handler(self, self)
+            finally:
+                api_handler.release(route)
             
         except Exception as _: # pylint: disable=broad-except
             print('Exception during "do_' + method + '":')
             traceback.print_exc()
-            self.respond_error(500)
+
+            # We can't tell how much of a response was already sent.
+            self.close_connection = True
+
+            try:
+                self.respond_error(500)
+            except OSError:
+                pass
 
     # pylint: disable=invalid-name
     def do_GET(self):
@@ -120,6 +363,12 @@ element."""
 
         self.do_method('POST')
 
+    # pylint: disable=invalid-name
+    def do_HEAD(self):
+        """Responds to `HEAD` requests."""
+
+        self.do_method('HEAD')
+
     def log_message(self, _format, *args):
         """Inhibit logging."""
 
@@ -128,18 +377,114 @@ element."""
         return
 
 
-#from . import api_v1
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """Handle requests in a separate thread. At most `MAX_KEEPALIVE`
+connections are kept open between requests; beyond that, connections
+are closed after each response. At most `MAX_CONNECTIONS` are served at
+once; beyond that, new connections are answered with a canned `503`
+and closed, and connections the kernel hasn't accepted yet queue up to
+`request_queue_size`."""
+
+    daemon_threads = True
+
+    MAX_KEEPALIVE = 256
+
+    MAX_CONNECTIONS = 1024
+
+    request_queue_size = 128
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.keepalive_count = 0
+        self.keepalive_lock = threading.Lock()
+
+        self.connection_count = 0
+        self.connection_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.connection_lock:
+            overloaded = self.connection_count >= self.MAX_CONNECTIONS
+
+            if not overloaded:
+                self.connection_count += 1
+
+        if not overloaded:
+            super().process_request(request, client_address)
+            return
+
+        # Answered from the accepting thread, so it has to be cheap.
+        retry_after = self.RequestHandlerClass.get_retry_after()
+
+        try:
+            request.sendall(bytes('HTTP/1.1 503 Service Unavailable\r\n'
+                                  'Retry-After: ' + str(retry_after) + '\r\n'
+                                  'Content-Length: 0\r\n'
+                                  'Connection: close\r\n\r\n', 'ascii'))
+        except OSError:
+            pass
+
+        self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.connection_lock:
+                self.connection_count -= 1
+
+    def acquire_keepalive(self):
+        """Takes a keep-alive slot, if one is free; returns `True` if it
+did."""
+
+        with self.keepalive_lock:
+            if self.keepalive_count >= self.MAX_KEEPALIVE:
+                return False
+
+            self.keepalive_count += 1
+
+            return True
 
-#class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-#    """Handle requests in a separate thread."""
+    def release_keepalive(self):
+        """Frees a slot taken by `acquire_keepalive()`."""
 
-class ThreadedHTTPServer(HTTPServer):
-    """Handle requests in a separate thread."""
+        with self.keepalive_lock:
+            self.keepalive_count -= 1
 
 class Server:
 
     """The server. Keeps track of jobs and clients."""
 
+    # Seconds a node may hold a task without renewing its lease (see
+    # `renew_leases()`); after that, the task is handed out again.
+    LEASE_TIME = 15 * 60
+
+    # Longest a task request may wait for work, in seconds (see
+    # `wait_for_tasks()`).
+    MAX_WAIT = 60
+
+    # Seconds between checks for expired leases and for jobs added by
+    # other processes.
+    REAP_TIME = 1
+
+    # ## Throughput-weighted dispatch
+
+    # Nodes that made a request within this many seconds count as
+    # active.
+    ACTIVE_TIME = 10 * 60
+
+    # A node at the farm's average speed is handed up to this many
+    # tasks per request; faster nodes get proportionally more.
+    CHUNK_SIZE = 2
+
+    # Nodes slower than this fraction of the fastest active node are
+    # not handed the last tasks of a job.
+    TAIL_SPEED = 0.5
+
+    # The fleet speed statistics are recomputed at most this often, in
+    # seconds.
+    FLEET_REFRESH_TIME = 10
+
     def __init__(self, host='localhost', port=44363):
 
         # Server information.
@@ -153,13 +498,66 @@ class Server:
 
         self.jobs = job.JobList()
         self.users = db.Users()
+        self.nodes = node.NodeList()
+
+        # Job files hosted by the server itself, and the nodes sharing
+        # them with each other.
+        self.blobs = blob.BlobStore()
+        self.tracker = tracker.Tracker(self.nodes)
+
+        # Guards every piece of shared state: requests are handled in
+        # threads (see `BlenderfarmHTTPServerRequestHandler.do_method()`).
+        self.lock = threading.RLock()
+
+        # Held by `save()` from taking its snapshots until they're
+        # written, so an older snapshot never overwrites a newer one.
+        # Never taken while holding `lock`.
+        self.save_lock = threading.Lock()
+
+        # Task requests waiting for work, oldest first (see
+        # `wait_for_tasks()`).
+        self.waiters = collections.deque()
+
+        # Heap of `(lease_expires, task_id)` of every lease handed out or
+        # renewed; entries of leases renewed since are skipped.
+        self.leases = []
+
+        # Maps the `node_id` of every node with an event stream open to
+        # its `events.EventStream`.
+        self.streams = {}
+
+        self.jobs.on_add = lambda _: self.dispatch_waiters()
+        self.jobs.on_status = self.job_status_changed
+
+        # Bandwidth limits imposed on every node, over their own (see
+        # `bandwidth.py`); empty to leave it to the nodes.
+        self.download_limit = ''
+        self.upload_limit = ''
 
         self.start_time = time.monotonic()
 
+        # See `get_fleet_speed()`.
+        self.fleet_speed = None
+        self.fleet_speed_time = 0
+
     def get_uptime(self):
         """Returns our uptime, in fractional seconds."""
         return time.monotonic() - self.start_time
 
+    def get_bandwidth_limits(self):
+        """Returns the bandwidth limits we impose on nodes, as a dictionary
+with the `download_limit` and `upload_limit` that are set."""
+
+        limits = {}
+
+        if self.download_limit:
+            limits['download_limit'] = self.download_limit
+
+        if self.upload_limit:
+            limits['upload_limit'] = self.upload_limit
+
+        return limits
+
     def init_api_handlers(self):
         """Initializes our API handlers."""
         
@@ -186,8 +584,507 @@ class Server:
     def start(self):
         """Starts the server."""
 
+        threading.Thread(target=self.run_reaper, daemon=True, name='reaper').start()
+
         self.httpd.serve_forever()
 
+    def run_reaper(self):
+        """Picks up jobs added by other processes and hands out the tasks
+of expired leases to waiting requests, every `REAP_TIME` seconds."""
+
+        while True:
+            time.sleep(Server.REAP_TIME)
+
+            with self.lock:
+                # Wakes waiters through `jobs.on_add`.
+                self.jobs.merge()
+
+                if self.expire_leases():
+                    self.dispatch_waiters()
+
+                self.check_streams()
+
+    def expire_leases(self):
+        """Returns `True` if any lease ran out since the last call, making
+its task available again."""
+
+        now = time.time()
+
+        expired = False
+
+        while self.leases and self.leases[0][0] <= now:
+            lease_expires, task_id = heapq.heappop(self.leases)
+
+            task = self.jobs.get_task(task_id)
+
+            if task and task.in_progress and not task.complete and task.lease_expires == lease_expires:
+                # Its task can be handed out again.
+                task.job.update_task(task)
+                expired = True
+
+        return expired
+
+    # ## Waiting for tasks
+
+    def wait_for_tasks(self, parameters, timeout):
+        """Waits up to `timeout` seconds for tasks matching `parameters`
+(see `get_next_tasks()`) to become available, and returns them; returns
+an empty list if none did. Waiting requests are handed tasks in the
+order they arrived. The server lock is released while waiting."""
+
+        waiter = {
+            'parameters': parameters,
+            'tasks': None,
+            'condition': threading.Condition(self.lock)
+        }
+
+        with self.lock:
+            self.waiters.append(waiter)
+
+            try:
+                waiter['condition'].wait_for(lambda: waiter['tasks'] is not None, min(timeout, Server.MAX_WAIT))
+            finally:
+                if waiter['tasks'] is None:
+                    self.waiters.remove(waiter)
+
+        return waiter['tasks'] or []
+
+    def dispatch_waiters(self):
+        """Hands available tasks to waiting requests, oldest first; requests
+nothing fits keep waiting."""
+
+        with self.lock:
+            for waiter in list(self.waiters):
+                if not self.jobs.get_next_job():
+                    break
+
+                tasks = self.get_next_tasks(waiter['parameters'])
+
+                if not tasks:
+                    continue
+
+                waiter['tasks'] = tasks
+
+                self.waiters.remove(waiter)
+
+                waiter['condition'].notify()
+
+            self.offer_tasks()
+
+    def job_status_changed(self, job):
+        """Called when `job` was paused, resumed or cancelled (see
+`job.JobList.merge()`). Takes the tasks of inactive jobs back from the
+nodes working on them; nodes with an event stream open are told to
+stop right away, the others at their next heartbeat. Either way, the
+freed (or resumed) capacity is handed out again."""
+
+        with self.lock:
+            if not job.is_active():
+                for task in job.tasks:
+                    if task.complete or not task.in_progress:
+                        continue
+
+                    for node_id in task.nodes_working:
+                        self.cancel_tasks(node_id, [task.task_id])
+
+                    task.release()
+
+            print('job ' + job.job_id + ' is now ' + job.status)
+
+            self.dispatch_waiters()
+
+    # ## Event streams
+
+    def open_stream(self, node_id, slots, parameters, held_task_ids=()):
+        """Opens the event stream of the node `node_id` (see `events.py`),
+replacing any stream it had open, and offers it tasks. `held_task_ids`
+are tasks the node already holds, from before it (re)connected.
+Returns the `events.EventStream`."""
+
+        with self.lock:
+            if node_id in self.streams:
+                self.close_stream(self.streams[node_id])
+
+            stream = events.EventStream(node_id, slots, parameters)
+            stream.task_ids.update(held_task_ids)
+
+            self.streams[node_id] = stream
+
+            stream.send('info', dict({
+                'version': version.__version__,
+                'uptime': self.get_uptime(),
+                'time': time.time(),
+                'lease_time': Server.LEASE_TIME
+            }, **self.get_bandwidth_limits()))
+
+            self.offer_tasks()
+
+            return stream
+
+    def close_stream(self, stream):
+        """Closes `stream`; offers it never acknowledged are taken back."""
+
+        with self.lock:
+            if self.streams.get(stream.node_id) is stream:
+                del self.streams[stream.node_id]
+
+            stream.close()
+
+            for _, task_ids in stream.offers.values():
+                self.release_tasks(stream.node_id, task_ids)
+
+            stream.offers = {}
+
+    def release_tasks(self, node_id, task_ids):
+        """Takes the tasks `task_ids` back from `node_id`, unless they're
+complete or have been handed to another node since. Returns `True` if
+any was taken back."""
+
+        released = False
+
+        for task_id in task_ids:
+            task = self.jobs.get_task(task_id)
+
+            if task and not task.complete and task.in_progress and node_id in task.nodes_working:
+                task.release()
+                released = True
+
+        return released
+
+    def cancel_tasks(self, node_id, task_ids):
+        """Tells `node_id`, if it has an event stream open, to stop working
+on the tasks `task_ids`."""
+
+        stream = self.streams.get(node_id)
+
+        if not stream or not task_ids:
+            return
+
+        stream.task_ids.difference_update(task_ids)
+
+        stream.send('cancel', {
+            'task_ids': list(task_ids)
+        })
+
+    def get_stream_task_ids(self, stream):
+        """Returns the IDs of the tasks `stream`'s node holds, forgetting
+the ones it finished or lost."""
+
+        for task_id in list(stream.task_ids):
+            task = self.jobs.get_task(task_id)
+
+            if not task or task.complete or not task.in_progress or stream.node_id not in task.nodes_working:
+                stream.task_ids.discard(task_id)
+
+        return stream.task_ids
+
+    def get_committed_memory(self, stream):
+        """Returns the memory (in bytes) the tasks of `stream`'s
+unacknowledged offers will need. The node's last reported
+`memory_free` doesn't account for them yet; once it acknowledges an
+offer, it reserves their memory itself (see
+`client.Client.reserved_memory`)."""
+
+        committed = 0
+
+        for _, task_ids in stream.offers.values():
+            for task_id in task_ids:
+                task = self.jobs.get_task(task_id)
+
+                if task:
+                    committed += task.job.get_required_memory(task)
+
+        return committed
+
+    def offer_tasks(self):
+        """Offers available tasks to every node with an event stream open
+and room for more. Memory committed to offers the node hasn't
+acknowledged yet is subtracted from its reported `memory_free`."""
+
+        with self.lock:
+            for stream in list(self.streams.values()):
+                while self.jobs.get_next_job():
+                    room = stream.slots - len(self.get_stream_task_ids(stream))
+
+                    if room <= 0:
+                        break
+
+                    parameters = dict(stream.parameters, node_id=stream.node_id, count=str(room))
+
+                    if 'memory_free' in parameters:
+                        memory_free = int(parameters['memory_free']) - self.get_committed_memory(stream)
+                        parameters['memory_free'] = str(max(0, memory_free))
+
+                    tasks = self.get_next_tasks(parameters)
+
+                    if not tasks:
+                        break
+
+                    task_ids = [task.task_id for task in tasks]
+
+                    event_id = stream.send('offer', {
+                        'lease_time': Server.LEASE_TIME,
+                        'tasks': [{
+                            'job': task.job.serialize(net=True),
+                            'task': task.serialize()
+                        } for task in tasks]
+                    })
+
+                    stream.task_ids.update(task_ids)
+                    stream.offers[event_id] = (time.monotonic() + events.EventStream.ACK_TIME, task_ids)
+
+    def acknowledge(self, stream, event_id, held_task_ids=None):
+        """Handles the acknowledgement of the event `event_id` by `stream`'s
+node. For `renew` events, `held_task_ids` are the tasks the node still
+holds: their leases are renewed, and every other task it was thought
+to hold is handed out again."""
+
+        with self.lock:
+            stream.offers.pop(event_id, None)
+
+            if held_task_ids is None:
+                self.offer_tasks()
+                return
+
+            held_task_ids = set(held_task_ids)
+
+            offered_task_ids = set()
+
+            for _, task_ids in stream.offers.values():
+                offered_task_ids.update(task_ids)
+
+            dropped_task_ids = self.get_stream_task_ids(stream) - held_task_ids - offered_task_ids
+
+            stream.task_ids.difference_update(dropped_task_ids)
+
+            lost_task_ids = self.renew_leases(stream.node_id, list(held_task_ids))
+
+            self.cancel_tasks(stream.node_id, lost_task_ids)
+
+            self.release_tasks(stream.node_id, dropped_task_ids)
+
+            # Dropped tasks, and any room the node has left, go out again.
+            self.dispatch_waiters()
+
+    def check_streams(self):
+        """Takes back offers that weren't acknowledged in time, and asks
+nodes to confirm the tasks they hold three times per lease time."""
+
+        now = time.monotonic()
+
+        released = False
+
+        for stream in list(self.streams.values()):
+            for event_id, (deadline, task_ids) in list(stream.offers.items()):
+                if deadline <= now:
+                    del stream.offers[event_id]
+
+                    stream.task_ids.difference_update(task_ids)
+
+                    released = self.release_tasks(stream.node_id, task_ids) or released
+
+            if now - stream.renew_time >= Server.LEASE_TIME / 3:
+                stream.renew_time = now
+
+                stream.send('renew', dict({
+                    'lease_time': Server.LEASE_TIME,
+                    'task_ids': list(self.get_stream_task_ids(stream))
+                }, **self.get_bandwidth_limits()))
+
+        if released:
+            self.dispatch_waiters()
+
     def get_next_task(self, parameters):
-        """Finds a new task that matches `parameters` as closely as possible."""
-        pass
+        """Finds a new task that matches `parameters` as closely as
+possible, marks it as in-progress and returns it; returns `None` if
+there is nothing to do. See `get_next_tasks()`."""
+
+        tasks = self.get_next_tasks(dict(parameters, count='1'))
+
+        if not tasks:
+            return None
+
+        return tasks[0]
+
+    def get_next_tasks(self, parameters):
+        """Finds up to `parameters['count']` (default 1) new tasks that
+match `parameters` as closely as possible, marks them as in-progress
+and returns them.
+
+If `parameters` contains a `node_id`, only tasks that node is capable
+of performing are considered, and the node's reported capabilities are
+updated first. If it contains `memory_free`, tasks are only handed out
+while their estimated peak memory fits in it; tasks of jobs whose
+memory usage hasn't been reported yet are handed out one at a time."""
+
+        render_node = None
+
+        if parameters.get('node_id'):
+            render_node = self.nodes.get_node(parameters['node_id'])
+
+            if render_node:
+                render_node.update_capabilities(parameters)
+
+        count = max(1, int(parameters.get('count', 1)))
+
+        memory_free = None
+
+        if 'memory_free' in parameters:
+            memory_free = int(parameters['memory_free'])
+
+        tail_size = 0
+
+        if render_node:
+            speed = self.get_node_speed(render_node)
+            _, max_speed, active_count = self.get_fleet_speed()
+
+            count = min(count, max(1, int(round(speed * Server.CHUNK_SIZE))))
+
+            if speed < max_speed * Server.TAIL_SPEED:
+                tail_size = active_count
+
+        tasks = []
+
+        while len(tasks) < count:
+            next_job = self.jobs.get_next_job(render_node, memory_free, tail_size)
+
+            if not next_job:
+                break
+
+            task = next_job.get_next_task()
+
+            # Its lease ran out; whoever held it should stop working on it.
+            for node_id in task.nodes_working:
+                if not render_node or node_id != render_node.node_id:
+                    self.cancel_tasks(node_id, [task.task_id])
+
+            if render_node:
+                task.lease(render_node.node_id, Server.LEASE_TIME)
+                render_node.last_job_id = next_job.job_id
+            else:
+                task.lease(None, Server.LEASE_TIME)
+
+            heapq.heappush(self.leases, (task.lease_expires, task.task_id))
+
+            tasks.append(task)
+
+            estimate = next_job.get_memory_estimate(task)
+
+            if estimate is None:
+                break
+
+            if memory_free is not None:
+                memory_free -= estimate * (1 + job.Job.MEMORY_MARGIN)
+
+        return tasks
+
+    def renew_leases(self, node_id, task_ids):
+        """Renews the leases `node_id` holds on the tasks `task_ids`.
+Returns a list of the task IDs it no longer holds (because they were
+completed, or their lease expired and they were handed out again)."""
+
+        lost_task_ids = []
+
+        for task_id in task_ids:
+            task = self.jobs.get_task(task_id)
+
+            if not task or not task.renew_lease(node_id, Server.LEASE_TIME):
+                lost_task_ids.append(task_id)
+                continue
+
+            heapq.heappush(self.leases, (task.lease_expires, task.task_id))
+
+        return lost_task_ids
+
+    def save(self):
+        """Saves the jobs and nodes databases. They're encoded under `lock`
+but written to disk outside it, so other requests don't wait on the
+disk; must not be called with `lock` held."""
+
+        with self.save_lock:
+            while True:
+                with self.lock:
+                    jobs_snapshot = self.jobs.snapshot()
+                    nodes_snapshot = self.nodes.snapshot()
+
+                # Another process (such as `bf.py job pause`) changed
+                # the jobs in the meantime; the next snapshot merges that.
+                if self.jobs.write(jobs_snapshot):
+                    break
+
+            self.nodes.write(nodes_snapshot)
+
+    def write_task_result(self, task, data, elapsed, peak_memory):
+        """Stores `data`, the rendered result of `task`, which took a node
+`elapsed` seconds and `peak_memory` bytes of memory (`0` if unknown)."""
+
+        # pylint: disable=no-self-use
+
+        _ = elapsed, peak_memory
+
+        task.write_result(data)
+
+    # ## Node speed
+
+    def get_fleet_speed(self):
+        """Returns `(mean_calibration, max_speed, active_count)` for the
+currently active nodes: their mean calibration score (`0` if none is
+calibrated), the speed factor of the fastest one (see
+`get_node_speed()`), and how many there are. Cached for
+`FLEET_REFRESH_TIME` seconds."""
+
+        if self.fleet_speed and time.monotonic() - self.fleet_speed_time < Server.FLEET_REFRESH_TIME:
+            return self.fleet_speed
+
+        active_nodes = self.nodes.get_active_nodes(time.time() - Server.ACTIVE_TIME)
+
+        calibrations = [render_node.calibration for render_node in active_nodes if render_node.calibration]
+
+        mean_calibration = 0
+
+        if calibrations:
+            mean_calibration = sum(calibrations) / len(calibrations)
+
+        max_speed = 1.0
+
+        if active_nodes:
+            max_speed = max(self.get_node_speed(render_node, mean_calibration) for render_node in active_nodes)
+
+        self.fleet_speed = (mean_calibration, max_speed, len(active_nodes))
+        self.fleet_speed_time = time.monotonic()
+
+        return self.fleet_speed
+
+    def get_node_speed(self, render_node, mean_calibration=None):
+        """Returns the speed factor of `render_node` relative to the farm's
+average (`2.0` means twice as fast). Starts out as the node's
+calibration score relative to the active nodes' mean, and shifts
+towards its measured task times as results come in."""
+
+        if mean_calibration is None:
+            mean_calibration = self.get_fleet_speed()[0]
+
+        speed = 1.0
+
+        if render_node.calibration and mean_calibration:
+            speed = render_node.calibration / mean_calibration
+
+        # After ten results, measured times outweigh the calibration entirely.
+        weight = min(render_node.elapsed_samples, 10) / 10
+
+        return speed * (1 - weight) + render_node.elapsed_ratio * weight
+
+    def record_task_elapsed(self, task, elapsed):
+        """Records that `task` took `elapsed` seconds; updates the job's
+statistics and the speed of the node that performed it."""
+
+        average = task.job.get_average_elapsed(task)
+
+        if average and elapsed > 0:
+            for node_id in task.nodes_working:
+                render_node = self.nodes.get_node(node_id)
+
+                if render_node:
+                    render_node.record_elapsed_ratio(average / elapsed)
+
+        task.job.record_elapsed(task, elapsed)
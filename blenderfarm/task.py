@@ -2,6 +2,7 @@
 """Task."""
 
 import os
+import time
 
 from . import db
 from . import serializable
@@ -16,6 +17,12 @@ class TaskInfo(serializable.Serializable):
     def get_info_type(self):
         return "none"
 
+    def get_priority(self): # pylint: disable=no-self-use
+        """Returns the dispatch priority of tasks with this info; higher
+priorities are handed out first, across every job."""
+
+        return Task.PRIORITY_NORMAL
+
     def unserialize(self, data):
         return self
 
@@ -30,17 +37,29 @@ class TaskInfoRender(TaskInfo):
     def __init__(self, task):
         super().__init__(task)
         
-        self.resolution = [1920, 1080]
+        # `[width, height]`; `None` uses whatever the `.blend` file
+        # says.
+        self.resolution = None
+
+        # Fraction the resolution is scaled by (through Blender's
+        # resolution percentage); `None` for no scaling.
+        self.scale = None
+
         self.frame = 0
 
+        # Render samples; `None` uses whatever the `.blend` file says.
+        self.samples = None
+
     def get_info_type(self):
         return "render"
 
     def unserialize(self, data):
         super().unserialize(data)
 
-        self.resolution = data['resolution']
+        self.resolution = data.get('resolution')
+        self.scale = data.get('scale')
         self.frame = data['frame']
+        self.samples = data.get('samples')
 
         return self
 
@@ -48,17 +67,44 @@ class TaskInfoRender(TaskInfo):
         out = super().serialize()
 
         out['resolution'] = self.resolution
+        out['scale'] = self.scale
         out['frame'] = self.frame
+        out['samples'] = self.samples
 
         return out
 
     def get_result_filename(self):
         return os.path.join('result', self.task.job.job_id, str(self.frame) + '.png')
-    
+
+
+class TaskInfoPreview(TaskInfoRender):
+
+    """`TaskInfo` for a scaled-down, low-sample preview render of a single
+frame. Preview tasks are dispatched before every other task, so
+artists can catch broken shots before the full-quality pass starts."""
+
+    def get_info_type(self):
+        return "preview"
+
+    def get_priority(self):
+        return Task.PRIORITY_PREVIEW
+
+    def get_result_filename(self):
+        return os.path.join('result', self.task.job.job_id, 'preview', str(self.frame) + '.png')
+
+
 class Task(serializable.Serializable):
 
     """A single task, executed by render nodes."""
 
+    # ## Priorities
+
+    # Regular, full-quality tasks.
+    PRIORITY_NORMAL = 0
+
+    # Preview tasks; nothing preempts these.
+    PRIORITY_PREVIEW = 100
+
     # ## Statuses
 
     def __init__(self, job, task_info=None):
@@ -85,6 +131,10 @@ class Task(serializable.Serializable):
 
         self.in_progress = False
 
+        # Epoch time the lease of the node performing this task runs out;
+        # after that, the task is handed out again.
+        self.lease_expires = 0
+
         self.task_info = task_info or None
 
         # A list of nodes that are currently processing this task.
@@ -98,7 +148,7 @@ otherwise."""
         if self.complete:
             return False
 
-        if self.in_progress:
+        if self.in_progress and not self.is_lease_expired():
             return False
 
         if self.ignore:
@@ -106,6 +156,87 @@ otherwise."""
 
         return True
 
+    # ## Leases
+
+    def lease(self, node_id, lease_time):
+        """Marks this task as in-progress on the node `node_id` (which may be
+`None`) for `lease_time` seconds."""
+
+        self.in_progress = True
+        self.lease_expires = time.time() + lease_time
+
+        self.nodes_working = [node_id] if node_id else []
+
+        self.update_job()
+
+    def renew_lease(self, node_id, lease_time):
+        """Extends the lease of `node_id` by `lease_time` seconds from now.
+Returns `False` if the task is no longer leased to that node. A lease
+that ran out can still be renewed as long as the task hasn't been
+handed to another node yet."""
+
+        if self.complete or not self.in_progress:
+            return False
+
+        if node_id not in self.nodes_working:
+            return False
+
+        self.lease_expires = time.time() + lease_time
+
+        # It may have been expired (and made available again) already.
+        self.update_job()
+
+        return True
+
+    def release(self):
+        """Takes the task back from the node holding it, so it's handed out
+again."""
+
+        self.in_progress = False
+        self.lease_expires = 0
+
+        self.nodes_working = []
+
+        self.update_job()
+
+    def set_complete(self):
+        """Marks this task complete; it's never handed out again."""
+
+        self.in_progress = False
+        self.complete = True
+
+        self.update_job()
+
+    def set_ignore(self, ignore):
+        """Sets whether this task is ignored (never handed out)."""
+
+        self.ignore = ignore
+
+        if ignore:
+            self.in_progress = False
+            self.nodes_working = []
+
+        self.update_job()
+
+    def update_job(self):
+        """Tells our job our state changed (see `job.Job.update_task()`)."""
+
+        if self.job:
+            self.job.update_task(self)
+
+    def is_lease_expired(self):
+        """Returns `True` if this task was leased, but the lease ran out."""
+
+        return bool(self.lease_expires) and time.time() >= self.lease_expires
+
+    def get_priority(self):
+        """Returns the dispatch priority of this task (see `PRIORITY_*`)."""
+
+        if not self.task_info:
+            return Task.PRIORITY_NORMAL
+
+        return self.task_info.get_priority()
+
     def unserialize(self, data):
         super().unserialize(data)
 
@@ -119,6 +250,8 @@ otherwise."""
         
         if task_info_type == 'render':
             self.task_info = TaskInfoRender(self)
+        elif task_info_type == 'preview':
+            self.task_info = TaskInfoPreview(self)
         else:
             print("oh god we don't know what to do with a 'TaskInfo' of type '" + task_info_type + "'; things will break")
             return
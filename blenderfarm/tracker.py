@@ -0,0 +1,178 @@
+"""Peer-to-peer job file distribution tracker. Render nodes that hold
+(or are downloading) a file from the server's blob store serve its
+chunks to other nodes (see `peer.py`); the tracker arranges the nodes
+downloading the same file into a tree rooted at the server, so every
+node only feeds a few others and the time it takes to get a file to
+every node grows with the logarithm of the number of nodes instead of
+linearly.
+
+Nodes download chunks in order and serve every chunk as soon as they
+have it, so the tree is pipelined: a child is never more than a few
+chunks behind its parent."""
+
+import threading
+import time
+
+class Tracker:
+
+    """Keeps track of which nodes hold which files. `nodes` is the
+server's `node.NodeList`; nodes that haven't been seen for
+`ACTIVE_TIME` seconds are never handed out as parents."""
+
+    # Nodes the server feeds directly, per file.
+    SEED_SLOTS = 2
+
+    # Nodes every downloading node feeds at most, per file. Nodes that
+    # already hold the whole file feed up to `COMPLETE_SLOTS`.
+    FANOUT = 2
+    COMPLETE_SLOTS = 4
+
+    ACTIVE_TIME = 10 * 60
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+        # Maps file hashes to dictionaries mapping the `node_id` of every
+        # node that holds or downloads the file to a dictionary with its
+        # `address`, `port`, `parent` (a `node_id`, or `None` for the
+        # server), `depth` in the tree and whether it's `complete`.
+        self.swarms = {}
+
+        self.lock = threading.Lock()
+
+    def is_active(self, node_id):
+        """Returns `True` if the node `node_id` has been seen recently."""
+
+        render_node = self.nodes.get_node(node_id)
+
+        return bool(render_node and render_node.last_seen >= time.time() - Tracker.ACTIVE_TIME)
+
+    def get_children(self, swarm, parent_id):
+        """Returns the `node_id`s of the nodes in `swarm` being fed by
+`parent_id` (`None` for the server)."""
+
+        return [node_id for node_id, peer in swarm.items() if peer['parent'] == parent_id and not peer['complete']]
+
+    def get_descendants(self, swarm, node_id):
+        """Returns the set of nodes in `swarm` fed, directly or not, by `node_id`."""
+
+        descendants = set()
+        pending = [node_id]
+
+        while pending:
+            for child_id in self.get_children(swarm, pending.pop()):
+                if child_id not in descendants:
+                    descendants.add(child_id)
+                    pending.append(child_id)
+
+        return descendants
+
+    def get_parent(self, swarm, node_id):
+        """Picks the node that should feed `node_id`, or `None` for the
+server. Nodes that hold the whole file come first, then the server,
+then the shallowest downloading nodes; the server is the last resort
+when everyone is busy."""
+
+        excluded = self.get_descendants(swarm, node_id)
+        excluded.add(node_id)
+
+        candidates = []
+
+        if len(self.get_children(swarm, None)) < Tracker.SEED_SLOTS:
+            candidates.append((0, 1, None))
+
+        for peer_id, peer in swarm.items():
+            if peer_id in excluded or not self.is_active(peer_id):
+                continue
+
+            slots = Tracker.COMPLETE_SLOTS if peer['complete'] else Tracker.FANOUT
+
+            if len(self.get_children(swarm, peer_id)) >= slots:
+                continue
+
+            if peer['complete']:
+                candidates.append((0, 0, peer_id))
+            else:
+                candidates.append((peer['depth'], 0, peer_id))
+
+        if not candidates:
+            return None
+
+        return min(candidates, key=lambda candidate: candidate[:2])[2]
+
+    def announce(self, file_hash, node_id, address, port, complete=False, failed_id=None):
+        """Records that `node_id`, whose peer server listens at `address`
+and `port`, is downloading the file `file_hash` (or holds all of it if
+`complete` is `True`). If it's downloading, returns the peer it should
+download from as a dictionary with its `node_id`, `address` and
+`port`, or `None` if it should download from the server. `failed_id`
+is a peer that couldn't be reached; it's dropped from the swarm."""
+
+        # pylint: disable=too-many-arguments
+
+        with self.lock:
+            swarm = self.swarms.setdefault(file_hash, {})
+
+            if failed_id and failed_id != node_id:
+                swarm.pop(failed_id, None)
+
+                # Its children are fed by the server until they ask again.
+                for peer in swarm.values():
+                    if peer['parent'] == failed_id:
+                        peer['parent'] = None
+
+            # Taken out of the swarm while we pick its parent, so it
+            # doesn't count against its old parent's slots.
+            peer = swarm.pop(node_id, None) or {
+                'parent': None,
+                'depth': 1,
+                'complete': False
+            }
+
+            peer['address'] = address
+            peer['port'] = port
+
+            if complete:
+                peer['complete'] = True
+                peer['parent'] = None
+                peer['depth'] = 0
+
+                swarm[node_id] = peer
+                return None
+
+            peer['complete'] = False
+
+            parent_id = self.get_parent(swarm, node_id)
+
+            peer['parent'] = parent_id
+
+            swarm[node_id] = peer
+
+            if parent_id is None:
+                peer['depth'] = 1
+                return None
+
+            parent = swarm[parent_id]
+
+            peer['depth'] = parent['depth'] + 1
+
+            return {
+                'node_id': parent_id,
+                'address': parent['address'],
+                'port': parent['port']
+            }
+
+    def remove(self, file_hash, node_id):
+        """Records that `node_id` no longer holds or downloads `file_hash`."""
+
+        with self.lock:
+            swarm = self.swarms.get(file_hash, {})
+
+            swarm.pop(node_id, None)
+
+            for peer in swarm.values():
+                if peer['parent'] == node_id:
+                    peer['parent'] = None
+
+            if not swarm:
+                self.swarms.pop(file_hash, None)
@@ -0,0 +1,284 @@
+"""Binary wire encoding. API responses are JSON by default; clients
+that send an `Accept` header listing `CONTENT_TYPE` get them encoded
+in the MessagePack format instead (the subset covering JSON's types,
+plus raw bytes), which is smaller and can carry binary data as is.
+Implemented in plain Python, so Blender's bundled interpreter can use
+it without extra packages.
+
+Plain Python can't outrun the C JSON encoder value by value, so the
+savings come from reuse: encodings simply concatenate, so the
+encoding of a `serializable.Serializable` object is spliced into every
+response that includes it (see `Serializable.serialize_wire()`), and
+short strings such as dictionary keys are only encoded once."""
+
+import struct
+
+CONTENT_TYPE = 'application/x-msgpack'
+
+_UINT16 = struct.Struct('>H')
+_UINT32 = struct.Struct('>I')
+_UINT64 = struct.Struct('>Q')
+_INT8 = struct.Struct('>b')
+_INT16 = struct.Struct('>h')
+_INT32 = struct.Struct('>i')
+_INT64 = struct.Struct('>q')
+_FLOAT32 = struct.Struct('>f')
+_FLOAT64 = struct.Struct('>d')
+
+# Encodings of short strings, and the most we remember.
+_STRINGS = {}
+_STRING_CACHE_SIZE = 4096
+
+def accepts(accept_header):
+    """Returns `True` if the `Accept` header `accept_header` lists our
+binary encoding."""
+
+    return bool(accept_header) and CONTENT_TYPE in accept_header
+
+# # Encoding
+
+def _pack_header(out, length, fix_prefix, fix_limit, prefixes):
+    """Writes a length header: `fix_prefix | length` if it's below
+`fix_limit`, or else one of `prefixes` (for 8-, 16- and 32-bit lengths,
+`None` where the format has none) followed by the length."""
+
+    # pylint: disable=too-many-arguments
+
+    if length < fix_limit:
+        out.append(fix_prefix | length)
+    elif length <= 0xff and prefixes[0]:
+        out.append(prefixes[0])
+        out.append(length)
+    elif length <= 0xffff:
+        out.append(prefixes[1])
+        out += _UINT16.pack(length)
+    else:
+        out.append(prefixes[2])
+        out += _UINT32.pack(length)
+
+def _pack_string(value):
+    """Returns the encoding of the string `value`."""
+
+    data = value.encode('utf8')
+
+    out = bytearray()
+
+    _pack_header(out, len(data), 0xa0, 32, (0xd9, 0xda, 0xdb))
+
+    out += data
+
+    return bytes(out)
+
+def _pack_int(out, value):
+    """Writes the integer `value` in its shortest form."""
+
+    # pylint: disable=too-many-branches
+
+    if 0 <= value < 0x80:
+        out.append(value)
+    elif -0x20 <= value < 0:
+        out.append(value & 0xff)
+    elif value >= 0:
+        if value <= 0xff:
+            out.append(0xcc)
+            out.append(value)
+        elif value <= 0xffff:
+            out.append(0xcd)
+            out += _UINT16.pack(value)
+        elif value <= 0xffffffff:
+            out.append(0xce)
+            out += _UINT32.pack(value)
+        else:
+            out.append(0xcf)
+            out += _UINT64.pack(value)
+    elif value >= -0x80:
+        out.append(0xd0)
+        out += _INT8.pack(value)
+    elif value >= -0x8000:
+        out.append(0xd1)
+        out += _INT16.pack(value)
+    elif value >= -0x80000000:
+        out.append(0xd2)
+        out += _INT32.pack(value)
+    else:
+        out.append(0xd3)
+        out += _INT64.pack(value)
+
+def _pack(out, value):
+    """Appends the encoding of `value` to the `bytearray` `out`."""
+
+    # pylint: disable=too-many-branches
+
+    # Checked in order of how common they are in API responses.
+    value_type = type(value)
+
+    if value_type is str:
+        data = _STRINGS.get(value)
+
+        if data is None:
+            data = _pack_string(value)
+
+            if len(data) <= 32 and len(_STRINGS) < _STRING_CACHE_SIZE:
+                _STRINGS[value] = data
+
+        out += data
+    elif value_type is dict:
+        _pack_header(out, len(value), 0x80, 16, (None, 0xde, 0xdf))
+
+        for key, item in value.items():
+            _pack(out, key)
+            _pack(out, item)
+    elif value_type is int:
+        _pack_int(out, value)
+    elif value_type is list or value_type is tuple:
+        _pack_header(out, len(value), 0x90, 16, (None, 0xdc, 0xdd))
+
+        for item in value:
+            _pack(out, item)
+    elif value is None:
+        out.append(0xc0)
+    elif value is False:
+        out.append(0xc2)
+    elif value is True:
+        out.append(0xc3)
+    elif value_type is float:
+        out.append(0xcb)
+        out += _FLOAT64.pack(value)
+    elif value_type is bytes or value_type is bytearray:
+        _pack_header(out, len(value), 0, 0, (0xc4, 0xc5, 0xc6))
+
+        out += value
+    elif hasattr(value, 'serialize_wire'):
+        out += value.serialize_wire()
+    elif isinstance(value, int):
+        _pack_int(out, int(value))
+    else:
+        raise TypeError('cannot encode ' + value_type.__name__)
+
+def dumps(value):
+    """Returns the binary encoding of `value`."""
+
+    out = bytearray()
+
+    _pack(out, value)
+
+    return bytes(out)
+
+# # Decoding
+
+# Prefixes followed by a length, as `(kind, length struct)`.
+_LENGTHS = {
+    0xd9: ('str', None),
+    0xda: ('str', _UINT16),
+    0xdb: ('str', _UINT32),
+    0xc4: ('bin', None),
+    0xc5: ('bin', _UINT16),
+    0xc6: ('bin', _UINT32),
+    0xdc: ('array', _UINT16),
+    0xdd: ('array', _UINT32),
+    0xde: ('map', _UINT16),
+    0xdf: ('map', _UINT32)
+}
+
+# Prefixes followed by a number.
+_NUMBERS = {
+    0xca: _FLOAT32,
+    0xcb: _FLOAT64,
+    0xcc: struct.Struct('>B'),
+    0xcd: _UINT16,
+    0xce: _UINT32,
+    0xcf: _UINT64,
+    0xd0: _INT8,
+    0xd1: _INT16,
+    0xd2: _INT32,
+    0xd3: _INT64
+}
+
+def loads(data):
+    """Returns the value encoded in `data`. Raises `ValueError` if it's
+malformed."""
+
+    # pylint: disable=too-many-statements
+
+    offset = 0
+
+    def take(size):
+        nonlocal offset
+
+        start = offset
+
+        offset += size
+
+        if offset > len(data):
+            raise ValueError('truncated data')
+
+        return data[start:offset]
+
+    def decode():
+        # pylint: disable=too-many-return-statements,too-many-branches
+
+        nonlocal offset
+
+        prefix = data[offset]
+
+        offset += 1
+
+        if prefix < 0x80:
+            return prefix
+
+        if prefix >= 0xe0:
+            return prefix - 0x100
+
+        if prefix >= 0xa0 and prefix <= 0xbf:
+            return take(prefix & 0x1f).decode('utf8')
+
+        if prefix <= 0x8f:
+            return {decode(): decode() for _ in range(prefix & 0x0f)}
+
+        if prefix <= 0x9f:
+            return [decode() for _ in range(prefix & 0x0f)]
+
+        if prefix == 0xc0:
+            return None
+
+        if prefix == 0xc2:
+            return False
+
+        if prefix == 0xc3:
+            return True
+
+        if prefix in _LENGTHS:
+            kind, length_struct = _LENGTHS[prefix]
+
+            if length_struct:
+                length = length_struct.unpack(take(length_struct.size))[0]
+            else:
+                length = take(1)[0]
+
+            if kind == 'str':
+                return take(length).decode('utf8')
+
+            if kind == 'bin':
+                return bytes(take(length))
+
+            if kind == 'map':
+                return {decode(): decode() for _ in range(length)}
+
+            return [decode() for _ in range(length)]
+
+        if prefix in _NUMBERS:
+            number_struct = _NUMBERS[prefix]
+
+            return number_struct.unpack(take(number_struct.size))[0]
+
+        raise ValueError('unsupported type 0x' + format(prefix, '02x'))
+
+    try:
+        value = decode()
+    except (IndexError, UnicodeDecodeError, RecursionError) as exception:
+        raise ValueError('malformed data: ' + str(exception))
+
+    if offset != len(data):
+        raise ValueError('trailing data')
+
+    return value